@@ -1,6 +1,16 @@
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, PlainTextResponse
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastui import prebuilt_html
+from sqlalchemy.exc import OperationalError
+
+try:
+    # optional: brotli compression, falling back to gzip for clients without `br`
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
 
 from .main import router as main_router
 from .samples import router as samples_router
@@ -10,8 +20,23 @@ from .subjects import router as subjects_router
 from .cohorts import router as cohorts_router
 from .visualizations import router as visualizations_router
 from .datasets import router as datasets_router
+from .database import IN_MEMORY, load_into_memory
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if IN_MEMORY:
+        report = load_into_memory()
+        memory = f', peak resident memory {report.peak_rss_bytes / 1e6:.0f} MB' if report.peak_rss_bytes is not None else ''
+        print(f'Loaded {report.database_bytes / 1e6:.0f} MB database into memory in {report.seconds:.2f}s{memory}; writes are disabled.')
+    yield
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# FastUI component trees are repetitive JSON and compress well; small responses are not worth it
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=1000)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=1000)
 
 app.include_router(main_router, prefix="/api")
 app.include_router(samples_router, prefix="/api/samples")
@@ -22,6 +47,12 @@ app.include_router(cohorts_router, prefix="/api/cohorts")
 app.include_router(visualizations_router, prefix="/api/visualizations")
 app.include_router(datasets_router, prefix="/api/datasets")
 
+@app.exception_handler(OperationalError)
+async def read_only_database(request: Request, error: OperationalError):
+    if IN_MEMORY and 'readonly' in str(error.orig):
+        return JSONResponse({'detail': 'The server is serving a read-only in-memory copy of the database; writes are disabled.'}, status_code=403)
+    raise error
+
 @app.get('/favicon.ico', status_code=404, response_class=PlainTextResponse)
 async def favicon_ico() -> str:
     return 'page not found'
@@ -0,0 +1,106 @@
+'''
+Optional analytical backend for read-only aggregate queries.
+
+By default every query runs on SQLite. With the environment variable
+CYTOMETRY_ANALYTICS_BACKEND=duckdb (requires the `duckdb` package), queries
+passed to `read_frame` run on an embedded DuckDB instead, over a Parquet
+mirror of the analytical tables that is rebuilt once per data version.
+Transactional writes always stay on SQLite.
+'''
+import os
+import shutil
+import threading
+
+import pandas as pd
+import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite
+from sqlmodel import Session
+
+from app.cache import remove_older_versions, versioned_name
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+ANALYTICS_BACKEND = os.environ.get('CYTOMETRY_ANALYTICS_BACKEND', 'sqlite')
+PARQUET_DIR = os.path.join('cache', 'parquet')
+# tables referenced by cohort/dataset predicates (including QC exclusion), summaries and statistics
+MIRRORED_TABLES = ['project', 'subject', 'sample', 'samplecount', 'population', 'populationrollup', 'sampleqc']
+
+if ANALYTICS_BACKEND not in ('sqlite', 'duckdb'):
+    raise ValueError(f'Invalid CYTOMETRY_ANALYTICS_BACKEND {ANALYTICS_BACKEND!r}')
+if ANALYTICS_BACKEND == 'duckdb' and duckdb is None:
+    raise ImportError('CYTOMETRY_ANALYTICS_BACKEND=duckdb requires the duckdb package')
+
+_lock = threading.Lock()
+_duckdb_version: tuple[str, int] | None = None
+_duckdb_connection = None
+
+def _data_version(session: Session) -> tuple[str, int]:
+    '''Database identity and data version (see `DataVersion`), which restarts when the database is recreated.'''
+    # raw SQL keeps this module free of imports from app.models
+    row = session.connection().exec_driver_sql('SELECT database_id, version FROM dataversion WHERE id = 1').first()
+    return (row[0] or '', row[1]) if row else ('', 0)
+
+def _build_mirror(session: Session, connection, database_id: str, version: int) -> str:
+    path = os.path.join(PARQUET_DIR, versioned_name('', database_id, version))
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(temporary_path, exist_ok=True)
+    sqlite_connection = session.connection()
+    for table in MIRRORED_TABLES:
+        frame = pd.read_sql_query(sa.text(f'SELECT * FROM {table}'), sqlite_connection, dtype_backend='numpy_nullable')
+        connection.register('mirror_frame', frame)
+        connection.execute(f"COPY (SELECT * FROM mirror_frame) TO '{os.path.join(temporary_path, table)}.parquet' (FORMAT parquet)")
+        connection.unregister('mirror_frame')
+    try:
+        os.rename(temporary_path, path)
+    except OSError: # built concurrently by another worker
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    remove_older_versions(PARQUET_DIR, '', database_id, version)
+    return path
+
+def _get_duckdb(session: Session):
+    '''DuckDB connection with one view per mirrored table, for the current data version.'''
+    global _duckdb_version, _duckdb_connection
+    version = _data_version(session)
+    with _lock:
+        if _duckdb_connection is None or _duckdb_version != version:
+            connection = duckdb.connect()
+            path = os.path.join(PARQUET_DIR, versioned_name('', *version))
+            if not os.path.exists(path):
+                path = _build_mirror(session, connection, *version)
+            for table in MIRRORED_TABLES:
+                connection.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{os.path.join(path, table)}.parquet')")
+            _duckdb_connection, _duckdb_version = connection, version
+        return _duckdb_connection.cursor()
+
+def compile_sql(statement) -> str:
+    '''Render a SQLAlchemy statement as SQLite-dialect SQL with inlined parameters.'''
+    return str(statement.compile(dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True}))
+
+def read_frame(session: Session, statement, columns: list[str], analytical: bool = True) -> pd.DataFrame:
+    '''
+    Run a read-only SELECT and return its rows as a DataFrame. Enum columns
+    hold enum values (or None) on either backend. Only committed data is
+    visible on DuckDB, so queries that must see the current transaction
+    pass analytical=False to stay on SQLite.
+    '''
+    enum_columns = {
+        name: column.type.enum_class
+        for name, column in zip(columns, statement.selected_columns)
+        if isinstance(column.type, sa.Enum) and column.type.enum_class
+    }
+    if analytical and ANALYTICS_BACKEND == 'duckdb':
+        frame = pd.DataFrame(_get_duckdb(session).execute(compile_sql(statement)).fetchall(), columns=columns)
+        # SQLAlchemy stores the names of enum members
+        decode = lambda enum_class: {member.name: member.value for member in enum_class}
+    else:
+        # rows are fetched through the Core connection, skipping the ORM's per-row loading
+        session.flush()
+        frame = pd.DataFrame(session.connection().execute(statement).fetchall(), columns=columns)
+        decode = lambda enum_class: {member: member.value for member in enum_class}
+    for name, enum_class in enum_columns.items():
+        values = frame[name].map(decode(enum_class)).astype(object)
+        frame[name] = values.where(values.notna(), None)
+    return frame
@@ -0,0 +1,78 @@
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+class VersionedCache:
+    '''
+    In-process cache for results derived from the database.
+    Every entry is tagged with the version it was computed for: the data
+    version (see `app.database.get_data_version`), which any write to
+    samples or subjects moves, or for results derived from one dataset,
+    the dataset's version (see `app.running_stats.get_dataset_version`),
+    which only writes to the samples it selects move. Entries go stale
+    when their version moves and are recomputed on the next request.
+    With `max_entries`, for keys taken from requests, the least recently
+    used entries are evicted beyond that number.
+    '''
+    def __init__(self, max_entries: int | None = None):
+        self._entries: OrderedDict[Hashable, tuple[Hashable, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+    def get(self, key: Hashable, version: Hashable) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: Hashable, version: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            if self.max_entries is not None and len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: Hashable, version: Hashable, compute: Callable[[], Any]) -> Any:
+        value = self.get(key, version)
+        if value is None:
+            value = compute()
+            self.set(key, version, value)
+        return value
+
+    def invalidate(self, key: Hashable | None = None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+def versioned_name(prefix: str, database_id: str, version: int, suffix: str = '') -> str:
+    '''
+    Name of a file or directory derived from version `version` of the data
+    of database `database_id` (see `app.database.get_database_id`).
+    '''
+    return f'{prefix}{database_id}_v{version}{suffix}'
+
+def remove_older_versions(directory: str, prefix: str, database_id: str, version: int, suffix: str = ''):
+    '''
+    Remove the entries of `directory` named by `versioned_name` that are
+    older than `version` or derived from another database. Newer versions
+    are kept, another worker may just have published them.
+    '''
+    pattern = re.compile(rf'{re.escape(prefix)}([0-9a-f]*)_v(\d+){re.escape(suffix)}')
+    for entry in os.listdir(directory):
+        match = pattern.fullmatch(entry)
+        if match and (match.group(1) != database_id or int(match.group(2)) < version):
+            path = os.path.join(directory, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError: # removed concurrently by another worker
+                    pass
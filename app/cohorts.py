@@ -1,36 +1,80 @@
 from typing import Annotated, Literal, TypeAlias
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import Response
 from fastui import components as c
 from fastui import AnyComponent, FastUI
 from fastui.components.display import DisplayLookup
 from fastui.events import GoToEvent, PageEvent
 from fastui.forms import fastui_form
-from sqlmodel import select
+from pydantic import BaseModel
+from sqlmodel import Session, select
 
-from app.database import SessionDep, add_cohort
-from app.models import Cohort, CohortForm, DatasetForm, Sample, Subject
-from app.shared import base_page
+from app.database import SessionDep, add_cohort, add_composite_cohort
+from app.models import Cohort, CohortForm, CohortOperatorEnum, CompositeCohortForm, DatasetForm, Sample, SexEnum, Subject, TreatmentEnum
+from app.projects import summary_table
+from app.samples import sample_table
+from app.shared import cached_component, components_response, form_error, page_response, paginate
+from app.subjects import subject_table
+from app.trajectories import SubjectTrajectory, TrajectorySummary, get_cohort_trajectories, subject_trajectories, summarize_trajectories
 
 router = APIRouter()
 
+class CohortRow(BaseModel):
+    id: int
+    name: str
+    condition: str | None = None
+    sex: SexEnum | None = None
+    treatment: TreatmentEnum | None = None
+    operator: CohortOperatorEnum | None = None
 
 @router.get("/", response_model=FastUI, response_model_exclude_none=True)
-def api_index(session: SessionDep, page: int = 1) -> list[AnyComponent]:
+def api_index(session: SessionDep, page: int = 1) -> Response:
     page_size = 20
-    cohorts = session.exec(select(Cohort)).all()
-    return base_page(
+    rows, num_cohorts = paginate(
+        session,
+        select(Cohort.id, Cohort.name, Cohort.condition, Cohort.sex, Cohort.treatment, Cohort.operator).order_by(Cohort.id),
+        page,
+        page_size,
+    )
+    return page_response(
         c.Heading(text='Cohorts', level=2),
         c.Paragraph(text=f'To create a new cohort, visit the Subjects page'),
+        c.Button(text='New Composite Cohort', on_click=PageEvent(name='modal-new-composite-cohort')),
+        cached_component('modal-new-composite-cohort', lambda: c.Modal(
+            title="New Composite Cohort",
+            body=[
+                c.Paragraph(
+                    text="Combine two existing cohorts. A difference keeps the subjects of the first cohort that are not in the other."
+                ),
+                c.ModelForm(
+                    model=CompositeCohortForm,
+                    submit_url='/api/cohorts/new-composite',
+                    submit_trigger=PageEvent(name='post-new-composite-cohort'),
+                    footer=[],
+                ),
+            ],
+            footer=[
+                c.Button(
+                    text='Cancel', 
+                    named_style='secondary', 
+                    on_click=PageEvent(name='modal-new-composite-cohort', clear=True)
+                ),
+                c.Button(text='Submit', on_click=PageEvent(name='post-new-composite-cohort')),
+            ],
+            open_trigger=PageEvent(name='modal-new-composite-cohort'),
+        )),
         c.Table(
-            data=cohorts[(page - 1) * page_size: page * page_size],
-            data_model=Cohort,
+            data=[CohortRow(**row._asdict()) for row in rows],
+            data_model=CohortRow,
             columns=[
                 DisplayLookup(field='name', on_click=GoToEvent(url='/cohorts/{id}/details')),
                 DisplayLookup(field='condition'),
                 DisplayLookup(field='sex'),
                 DisplayLookup(field='treatment'),
+                DisplayLookup(field='operator'),
             ]
-        )
+        ),
+        c.Pagination(page=page, page_size=page_size, total=num_cohorts),
     )
 
 @router.post("/new", response_model=FastUI, response_model_exclude_none=True)
@@ -40,17 +84,52 @@ def new_cohort(form: Annotated[CohortForm, fastui_form(CohortForm)], session: Se
         c.FireEvent(event=PageEvent(name='modal-new-cohort', clear=True)),
     ]
 
-CohortViewKind: TypeAlias = Literal['details', 'samples', 'subjects']
+@router.post("/new-composite", response_model=FastUI, response_model_exclude_none=True)
+def new_composite_cohort(form: Annotated[CompositeCohortForm, fastui_form(CompositeCohortForm)], session: SessionDep) -> list[AnyComponent]:
+    for field in ('left_cohort_id', 'right_cohort_id'):
+        if not session.get(Cohort, getattr(form, field)):
+            raise form_error(field, 'Cohort not found')
+    add_composite_cohort(form, session)
+    return [
+        c.FireEvent(event=PageEvent(name='modal-new-composite-cohort', clear=True)),
+        c.FireEvent(event=GoToEvent(url='/cohorts/')),
+    ]
+
+# declared before `/{id}/{kind}`, which would otherwise match these paths
+@router.get('/trajectories/{id}', response_model=TrajectorySummary)
+def cohort_trajectories(id: int, session: SessionDep, sample_type: str | None = None) -> TrajectorySummary:
+    '''Change of population frequencies from baseline over time, per response.'''
+    cohort = session.get(Cohort, id)
+    if not cohort:
+        raise HTTPException(status_code=404, detail=f"Cohort {id} not found")
+    return summarize_trajectories(get_cohort_trajectories(cohort, session, sample_type), id, sample_type)
+
+@router.get('/trajectories/{id}/subjects', response_model=list[SubjectTrajectory])
+def cohort_subject_trajectories(
+        id: int,
+        session: SessionDep,
+        sample_type: str | None = None,
+        page: Annotated[int, Query(ge=1)] = 1,
+        page_size: Annotated[int, Query(ge=1, le=1000)] = 100,
+    ) -> list[SubjectTrajectory]:
+    '''Per-subject frequencies and deltas from baseline, a page of subjects at a time.'''
+    cohort = session.get(Cohort, id)
+    if not cohort:
+        raise HTTPException(status_code=404, detail=f"Cohort {id} not found")
+    trajectories = get_cohort_trajectories(cohort, session, sample_type)
+    return subject_trajectories(trajectories, (page - 1) * page_size, page_size)
+
+CohortViewKind: TypeAlias = Literal['details', 'samples', 'subjects', 'summary']
 
 @router.get('/{id}/{kind}', response_model=FastUI, response_model_exclude_none=True)
-def cohort_view(id: int, kind: CohortViewKind, session: SessionDep) -> list[AnyComponent]:
+def cohort_view(id: int, kind: CohortViewKind, session: SessionDep) -> Response:
     cohort = session.get(Cohort, id)
     if not cohort:
-        return base_page(
+        return page_response(
             c.Heading(text='Cohort not found', level=2),
             c.Paragraph(text='The requested cohort does not exist.')
         )
-    return base_page(
+    return page_response(
         c.Heading(text=f'Cohort: {cohort.name}', level=2),
         c.LinkList(
             links=[
@@ -90,6 +169,18 @@ def cohort_view(id: int, kind: CohortViewKind, session: SessionDep) -> list[AnyC
                     ),
                     active=f'/cohorts/{id}/subjects',
                 ),
+                c.Link(
+                    components=[c.Text(text='Summary')],
+                    on_click=PageEvent(
+                        name='change-content', 
+                        push_path=f'/cohorts/{id}/summary', 
+                        context={
+                            'kind': 'summary',
+                            'id': id
+                        }
+                    ),
+                    active=f'/cohorts/{id}/summary',
+                ),
             ],
             mode='tabs',
             class_name='+ mb-4',
@@ -97,7 +188,7 @@ def cohort_view(id: int, kind: CohortViewKind, session: SessionDep) -> list[AnyC
         c.ServerLoad(
             path='/cohorts/content/{id}/{kind}',
             load_trigger=PageEvent(name='change-content'),
-            components=cohort_content(id, kind, session),
+            components=cohort_components(id, kind, session),
         ),
     )
 
@@ -107,7 +198,17 @@ def cohort_content(
         kind: CohortViewKind, 
         session: SessionDep, 
         page: int = 1,
+    ) -> Response:
+    # the samples tab holds a cached component, spliced in by components_response
+    return components_response(cohort_components(id, kind, session, page))
+
+def cohort_components(
+        id: int,
+        kind: CohortViewKind,
+        session: Session,
+        page: int = 1,
     ) -> list[AnyComponent]:
+    '''Content of a tab of the cohort page; see `cohort_content`.'''
     cohort = session.get(Cohort, id)
     match kind:
         case 'details':
@@ -116,34 +217,17 @@ def cohort_content(
             ]
         case 'samples':
             page_size = 20
-            subjects = cohort.get_subjects(session)
-            query = select(Sample).where(Sample.subject_id.in_([s.id for s in subjects]))
-            samples = session.exec(query).all()
+            query = select(Sample).where(Sample.subject_id.in_(cohort.get_subject_query(session))).order_by(Sample.id)
+            samples, num_samples = paginate(session, query, page, page_size)
             return [
                 c.Button(
                     text='New Dataset',
                     on_click=PageEvent(name='modal-new-dataset'),
                 ),
-                c.Paragraph(text=f'There are {len(samples)} samples associated with subjects in this cohort.'),
-                c.Table(
-                    data=samples[(page - 1) * page_size : page * page_size],
-                    data_model=Sample,
-                    no_data_message="No samples found. Are filters applied?",
-                    columns=[
-                        DisplayLookup(
-                            field='name', 
-                            on_click=GoToEvent(url='/samples/{id}'),
-                        ),
-                        DisplayLookup(field='type'),
-                        DisplayLookup(field='time_from_treatment_start'),
-                        DisplayLookup(field='b_cell'),
-                        DisplayLookup(field='cd8_t_cell'),
-                        DisplayLookup(field='cd4_t_cell'),
-                        DisplayLookup(field='nk_cell'),
-                        DisplayLookup(field='monocyte'),
-                    ],
-                ),
-                c.Modal( # TODO: form should not include a field for cohort. Cohort should be pre-filled. That, or this form should be moved to the Dataset page.
+                c.Paragraph(text=f'There are {num_samples} samples associated with subjects in this cohort.'),
+                sample_table(session, samples, "No samples found. Are filters applied?"),
+                # TODO: form should not include a field for cohort. Cohort should be pre-filled. That, or this form should be moved to the Dataset page.
+                cached_component('modal-new-dataset', lambda: c.Modal(
                     title="New Dataset",
                     body=[
                         c.ModelForm(
@@ -162,26 +246,32 @@ def cohort_content(
                         c.Button(text='Submit', on_click=PageEvent(name='post-new-dataset')),
                     ],
                     open_trigger=PageEvent(name='modal-new-dataset'),
-                ),
-                c.Pagination(page=page, page_size=page_size, total=len(samples)),
+                )),
+                c.Pagination(page=page, page_size=page_size, total=num_samples),
             ]
         case 'subjects':
-            subjects = cohort.get_subjects(session)
+            page_size = 20
+            conditions = [Subject.id.in_(cohort.get_subject_query(session))] if cohort.is_composite() else cohort.get_conditions()
+            table, num_subjects = subject_table(session, conditions, page, page_size, "No subjects in this cohort.")
             return [
-                c.Paragraph(text=f'There are {len(subjects)} subjects in this cohort.'),
-                c.Table(
-                    data=subjects, # TODO: paginate this
-                    data_model=Subject,
-                    no_data_message="No subjects in this cohort.",
-                    columns=[
-                        DisplayLookup(field='name', on_click=GoToEvent(url='/subjects/{id}')),
-                        DisplayLookup(field='sex'),
-                        DisplayLookup(field='response'),
-                        DisplayLookup(field='treatment'),
-                        DisplayLookup(field='age'),
-                        DisplayLookup(field='condition'),
-                    ]
-                ),
+                c.Paragraph(text=f'There are {num_subjects} subjects in this cohort.'),
+                table,
+                c.Pagination(page=page, page_size=page_size, total=num_subjects),
+            ]
+        case 'summary':
+            if cohort.is_composite():
+                return [c.Paragraph(text='Summary statistics are not available for composite cohorts.')]
+            # the rollups are keyed by the same subject attributes that define a cohort
+            filters = {}
+            if cohort.condition and cohort.condition != 'Any':
+                filters['condition'] = cohort.condition
+            if cohort.sex and cohort.sex != SexEnum.ANY:
+                filters['sex'] = cohort.sex.value
+            if cohort.treatment and cohort.treatment != TreatmentEnum.ANY:
+                filters['treatment'] = cohort.treatment.value
+            return [
+                c.Paragraph(text='Relative frequency of each population across the samples of this cohort.'),
+                summary_table(session, ['response', 'sample_type', 'time_from_treatment_start'], filters),
             ]
         case _:
             raise ValueError(f'Invalid kind {kind!r}')
@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from sqlmodel import Session, select
+
+from app.analytics import read_frame
+from app.cache import remove_older_versions, versioned_name
+from app.database import get_data_version, get_database_id
+from app.models import Population, ResponseEnum, Sample, SampleCount, Subject
+
+COLUMNAR_DIR = os.path.join('cache', 'columnar')
+ARRAYS = ['sample_id', 'subject_id', 'project_id', 'type_code', 'time_from_treatment_start', 'response_code', 'counts']
+
+class ColumnarSnapshot:
+    '''
+    Column arrays of sample metadata and population counts for one data
+    version, stored as .npy files and memory-mapped read-only. Every worker
+    maps the same files, so the data is shared through the page cache
+    rather than copied into each process.
+
+    Rows are samples ordered by id. `counts` is a samples x populations
+    int32 matrix with -1 where a population was not measured.
+    '''
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        self.path = path
+        self.version: int = meta['version']
+        self.populations: list[str] = meta['populations']
+        self.sample_types: list[str] = meta['sample_types']
+        self.responses: list[str | None] = meta['responses']
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+
+    def __len__(self) -> int:
+        return len(self.sample_id)
+
+    def frequencies(self, mask: np.ndarray) -> pd.DataFrame:
+        '''Relative frequency (%) per population of the selected rows, indexed by sample id.'''
+        counts = self.counts[mask].astype(np.float64)
+        counts[counts < 0] = np.nan
+        totals = np.nansum(counts, axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frequencies = np.where(totals > 0, counts / totals * 100, np.where(np.isnan(counts), np.nan, 0.0))
+        return pd.DataFrame(frequencies, index=pd.Index(self.sample_id[mask], name='sample_id'), columns=self.populations)
+
+    def response(self, mask: np.ndarray) -> pd.Series:
+        '''Subject response of the selected rows, indexed by sample id.'''
+        return pd.Series(
+            np.asarray(self.responses, dtype=object)[self.response_code[mask]],
+            index=pd.Index(self.sample_id[mask], name='sample_id'),
+        )
+
+def build_snapshot(session: Session, version: int) -> str:
+    '''Write the arrays for `version` to disk and return their directory.'''
+    database_id = get_database_id(session)
+    samples = read_frame(
+        session,
+        select(Sample.id, Sample.subject_id, Sample.project_id, Sample.type, Sample.time_from_treatment_start, Subject.response)
+        .outerjoin(Subject, Sample.subject_id == Subject.id)
+        .order_by(Sample.id),
+        ['sample_id', 'subject_id', 'project_id', 'type', 'time_from_treatment_start', 'response'],
+    )
+    populations = read_frame(session, select(Population.id, Population.label).order_by(Population.id), ['id', 'label'])
+    counts = read_frame(
+        session,
+        select(SampleCount.sample_id, SampleCount.population_id, SampleCount.count),
+        ['sample_id', 'population_id', 'count'],
+    )
+    sample_ids = samples['sample_id'].to_numpy(dtype=np.int64)
+    population_ids = populations['id'].to_numpy(dtype=np.int64)
+    count_matrix = np.full((len(sample_ids), len(population_ids)), -1, dtype=np.int32)
+    count_matrix[
+        np.searchsorted(sample_ids, counts['sample_id'].to_numpy()),
+        np.searchsorted(population_ids, counts['population_id'].to_numpy()),
+    ] = counts['count'].to_numpy()
+    sample_types, type_codes = np.unique(samples['type'].to_numpy(dtype=str), return_inverse=True)
+    responses = [None, ResponseEnum.YES.value, ResponseEnum.NO.value]
+    response_codes = samples['response'].map({ResponseEnum.YES.value: 1, ResponseEnum.NO.value: 2}).fillna(0)
+
+    arrays = {
+        'sample_id': sample_ids,
+        'subject_id': samples['subject_id'].fillna(-1).to_numpy(dtype=np.int64),
+        'project_id': samples['project_id'].fillna(-1).to_numpy(dtype=np.int64),
+        'type_code': type_codes.astype(np.int32),
+        'time_from_treatment_start': samples['time_from_treatment_start'].to_numpy(dtype=np.int64),
+        'response_code': response_codes.to_numpy(dtype=np.int8),
+        'counts': count_matrix,
+    }
+    path = os.path.join(COLUMNAR_DIR, versioned_name('', database_id, version))
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(temporary_path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary_path, f'{name}.npy'), array)
+    with open(os.path.join(temporary_path, 'meta.json'), 'w') as meta_file:
+        json.dump({
+            'version': version,
+            'populations': populations['label'].tolist(),
+            'sample_types': sample_types.tolist(),
+            'responses': responses,
+        }, meta_file)
+    try:
+        # atomic publish; another worker may have built the same version first
+        os.rename(temporary_path, path)
+    except OSError:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    return path
+
+_snapshot: ColumnarSnapshot | None = None
+
+def get_snapshot(session: Session) -> ColumnarSnapshot:
+    '''
+    Snapshot for the current data version, mapping the files another worker
+    already built when possible and building them otherwise.
+    '''
+    global _snapshot
+    version = get_data_version(session)
+    # versions restart when the database is recreated
+    database_id = get_database_id(session)
+    path = os.path.join(COLUMNAR_DIR, versioned_name('', database_id, version))
+    if _snapshot is not None and _snapshot.path == path:
+        return _snapshot
+    if not os.path.exists(path):
+        path = build_snapshot(session, version)
+        # mapped files stay readable after removal, for the workers still using them
+        remove_older_versions(COLUMNAR_DIR, '', database_id, version)
+    _snapshot = ColumnarSnapshot(path)
+    return _snapshot
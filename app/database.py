@@ -1,16 +1,37 @@
 import os
-import csv
+import sqlite3
+import sys
+import time
+import uuid
+from contextlib import closing
 from typing import Annotated
 
 from fastapi import Depends
-from sqlmodel import SQLModel, Session, create_engine, select
+from pydantic import BaseModel
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateTable
+from sqlmodel import SQLModel, Session, create_engine, delete, func, insert, select, update
+import numpy as np
 import pandas as pd
 
-from app.models import Dataset, DatasetForm, Project, Subject, Sample, SampleForm, SubjectForm, Cohort, CohortForm
+try:
+    # Unix only: peak resident memory reported by `load_into_memory`
+    import resource
+except ImportError:
+    resource = None
+
+from app.models import chunked, DataVersion, Dataset, DatasetForm, DatasetSnapshot, DatasetVersion, EventFile, Population, Project, Subject, Sample, SampleCount, SampleForm, SampleQC, SubjectForm, Cohort, CohortForm, CompositeCohortForm
+from app.rollups import rebuild_rollups, update_rollups
+from app.running_stats import recompute_dataset_statistics, update_dataset_statistics
 
 DB_FILE = 'db.sqlite3'
 CSV_FILE = 'cell-count.csv'
 engine = create_engine(f'sqlite:///{DB_FILE}')
+# with CYTOMETRY_IN_MEMORY=1 (`python run.py --in-memory`), the web application serves a read-only in-memory copy of DB_FILE
+IN_MEMORY = os.environ.get('CYTOMETRY_IN_MEMORY') == '1'
+# the memdb VFS lets every connection of the pool open the same in-memory database
+MEMORY_URI = 'file:/cytometry?vfs=memdb'
+_memory_database: sqlite3.Connection | None = None
 
 def get_session():
     with Session(engine) as session:
@@ -18,96 +39,384 @@ def get_session():
 
 SessionDep = Annotated[Session, Depends(get_session)]
 
+class MemoryLoadReport(BaseModel):
+    seconds: float
+    database_bytes: int
+    # peak resident memory of the process after loading, None where not available
+    peak_rss_bytes: int | None = None
+
+def load_into_memory() -> MemoryLoadReport:
+    '''
+    Copy DB_FILE into memory with SQLite's backup API and make `get_session`
+    serve from the copy. Its connections are read-only (PRAGMA query_only),
+    so writes fail, and changes made to the file afterwards are not seen.
+    '''
+    global engine, _memory_database
+    start = time.perf_counter()
+    memory_database = sqlite3.connect(MEMORY_URI, uri=True, check_same_thread=False)
+    with closing(sqlite3.connect(DB_FILE)) as source:
+        source.backup(memory_database)
+
+    def connect():
+        connection = sqlite3.connect(MEMORY_URI, uri=True, check_same_thread=False)
+        connection.execute('PRAGMA query_only = ON')
+        return connection
+
+    # the in-memory database lives as long as one connection to it is open
+    _memory_database = memory_database
+    engine = create_engine('sqlite://', creator=connect, poolclass=QueuePool)
+    seconds = time.perf_counter() - start
+    peak_rss_bytes = None
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return MemoryLoadReport(seconds=seconds, database_bytes=os.path.getsize(DB_FILE), peak_rss_bytes=peak_rss_bytes)
+
+# keep `Project.num_samples` exact for every write, including bulk and set-based statements
+NUM_SAMPLES_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS sample_insert_num_samples AFTER INSERT ON sample BEGIN
+        UPDATE project SET num_samples = num_samples + 1 WHERE id = NEW.project_id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS sample_delete_num_samples AFTER DELETE ON sample BEGIN
+        UPDATE project SET num_samples = num_samples - 1 WHERE id = OLD.project_id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS sample_move_num_samples AFTER UPDATE OF project_id ON sample
+    WHEN OLD.project_id IS NOT NEW.project_id BEGIN
+        UPDATE project SET num_samples = num_samples - 1 WHERE id = OLD.project_id;
+        UPDATE project SET num_samples = num_samples + 1 WHERE id = NEW.project_id;
+    END''',
+]
+
+# population count columns of `sample` in databases created before counts moved to `SampleCount`
+LEGACY_COUNT_COLUMNS = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+
+def _table_columns(connection, table: str) -> list[str]:
+    return [row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info({table})')]
+
+def _add_missing_columns(connection, table: str, definitions: dict[str, str]):
+    columns = _table_columns(connection, table)
+    for name, definition in definitions.items():
+        if name not in columns:
+            connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+def _migrate_legacy_counts(connection) -> list[str]:
+    '''
+    Copy the count columns of a `sample` table created with one column per
+    population into `SampleCount`, registering the populations. Returns
+    the copied columns, which the `sample` rebuild then drops.
+    '''
+    columns = [column for column in LEGACY_COUNT_COLUMNS if column in _table_columns(connection, 'sample')]
+    for column in columns:
+        connection.exec_driver_sql(
+            'INSERT OR IGNORE INTO population (name, label) VALUES (?, ?)',
+            (column, Population.label_for(column)),
+        )
+        connection.exec_driver_sql(
+            f'INSERT OR IGNORE INTO samplecount (sample_id, population_id, count) '
+            f'SELECT sample.id, population.id, sample.{column} FROM sample JOIN population ON population.name = ? '
+            f'WHERE sample.{column} IS NOT NULL',
+            (column,),
+        )
+    return columns
+
+def _migrate_legacy_dataset_filters(connection) -> bool:
+    '''
+    Move the single sample type and time of datasets created before they
+    became lists and ranges to the new columns, keeping their meaning
+    (an empty type or a time of 0 selected any). Returns whether there
+    was anything to migrate.
+    '''
+    columns = _table_columns(connection, 'dataset')
+    if 'sample_type' not in columns:
+        return False
+    connection.exec_driver_sql("UPDATE dataset SET sample_types = json_array(sample_type) WHERE sample_type != ''")
+    connection.exec_driver_sql(
+        'UPDATE dataset SET min_time_from_treatment_start = time_from_treatment_start, '
+        'max_time_from_treatment_start = time_from_treatment_start WHERE time_from_treatment_start != 0'
+    )
+    connection.exec_driver_sql('ALTER TABLE dataset DROP COLUMN sample_type')
+    connection.exec_driver_sql('ALTER TABLE dataset DROP COLUMN time_from_treatment_start')
+    return True
+
+def _rebuild_sample_table(connection, dropped: list[str]):
+    '''
+    Rebuild `sample` with the current model: AUTOINCREMENT, so that SQLite
+    never reuses the highest deleted id, and without the `dropped` columns,
+    whose data must have been migrated. Columns the model does not know are
+    never dropped; the rebuild refuses instead. The sequence starts above
+    every id still referenced by a snapshot. Triggers are recreated by
+    `init_db`.
+    '''
+    table = Sample.__table__
+    unknown = set(_table_columns(connection, 'sample')) - {column.name for column in table.columns} - set(dropped)
+    if unknown:
+        raise RuntimeError(
+            f'The sample table of {DB_FILE} has columns this version does not know ({", ".join(sorted(unknown))}); '
+            f'delete {DB_FILE} to have it re-created.'
+        )
+    columns = ', '.join(column.name for column in table.columns)
+    ddl = str(CreateTable(table).compile(connection)).replace('CREATE TABLE sample ', 'CREATE TABLE sample_autoincrement ', 1)
+    connection.exec_driver_sql(ddl)
+    connection.exec_driver_sql(f'INSERT INTO sample_autoincrement ({columns}) SELECT {columns} FROM sample')
+    connection.exec_driver_sql('DROP TABLE sample')
+    connection.exec_driver_sql('ALTER TABLE sample_autoincrement RENAME TO sample')
+    for index in table.indexes:
+        index.create(connection)
+    max_id = connection.exec_driver_sql('SELECT max(id) FROM sample').scalar() or 0
+    for (encoded_sample_ids,) in connection.execute(select(DatasetSnapshot.encoded_sample_ids)):
+        frozen = DatasetSnapshot(encoded_sample_ids=encoded_sample_ids).get_sample_ids()
+        max_id = max(max_id, int(frozen[-1]) if len(frozen) else 0)
+    connection.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'sample'")
+    connection.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES ('sample', ?)", (max_id,))
+
 def init_db():
+    '''
+    Create missing tables and triggers and migrate databases created by
+    earlier versions, in one transaction. Safe to run on an existing
+    database.
+    '''
     SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        legacy_counts = _migrate_legacy_counts(connection)
+        sample_ddl = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'sample'").scalar()
+        if legacy_counts or 'AUTOINCREMENT' not in sample_ddl.upper():
+            _rebuild_sample_table(connection, legacy_counts)
+        for trigger in NUM_SAMPLES_TRIGGERS:
+            connection.exec_driver_sql(trigger)
+        # columns added to existing tables since the database was created
+        _add_missing_columns(connection, 'cohort', {
+            'operator': 'VARCHAR(12)',
+            'left_cohort_id': 'INTEGER REFERENCES cohort (id)',
+            'right_cohort_id': 'INTEGER REFERENCES cohort (id)',
+        })
+        _add_missing_columns(connection, 'dataset', {
+            'sample_types': 'JSON',
+            'project_ids': 'JSON',
+            'min_time_from_treatment_start': 'INTEGER',
+            'max_time_from_treatment_start': 'INTEGER',
+            'exclude_flagged': 'BOOLEAN NOT NULL DEFAULT 0',
+        })
+        legacy_datasets = _migrate_legacy_dataset_filters(connection)
+        _add_missing_columns(connection, 'dataversion', {'database_id': 'VARCHAR'})
+        connection.exec_driver_sql('INSERT OR IGNORE INTO dataversion (id, version) VALUES (1, 0)')
+        connection.exec_driver_sql('UPDATE dataversion SET database_id = ? WHERE id = 1 AND database_id IS NULL', (uuid.uuid4().hex,))
+        # datasets created before versions were tracked start out stale
+        connection.exec_driver_sql(
+            'INSERT INTO datasetversion (dataset_id, version, refreshed_version) '
+            'SELECT id, 1, 0 FROM dataset WHERE id NOT IN (SELECT dataset_id FROM datasetversion)'
+        )
+        if legacy_counts or legacy_datasets:
+            # derived tables did not exist, or were computed from the old filters; sample counts were not maintained
+            with Session(bind=connection) as session:
+                rebuild_rollups(session)
+                for dataset in session.exec(select(Dataset)).all():
+                    recompute_dataset_statistics(dataset, session)
+                session.flush()
+                reconcile_num_samples(session, fix=True)
+
+def get_data_version(session: Session) -> int:
+    data_version = session.get(DataVersion, 1)
+    return data_version.version if data_version else 0
+
+def get_database_id(session: Session) -> str:
+    '''Identity of the database (see `DataVersion`), for keys of files derived from it.'''
+    data_version = session.get(DataVersion, 1)
+    return data_version.database_id if data_version and data_version.database_id else ''
+
+def bump_data_version(session: Session):
+    '''Invalidate derived results. Call as part of a write, before committing.'''
+    data_version = session.get(DataVersion, 1) or DataVersion(id=1)
+    data_version.version += 1
+    session.add(data_version)
+
+# every other column of an import holds the count of a population
+METADATA_COLUMNS = [
+    'project', 'subject', 'condition', 'age', 'sex', 'treatment', 'response',
+    'sample', 'sample_type', 'time_from_treatment_start',
+]
+
+def get_population_columns(header: list[str]) -> list[str]:
+    return [column for column in header if column not in METADATA_COLUMNS]
+
+def get_or_create_populations(session: Session, names: list[str]) -> dict[str, Population]:
+    '''Map population names to `Population` rows, registering unknown names. Does not commit.'''
+    populations = {
+        population.name: population
+        for population in session.exec(select(Population).where(Population.name.in_(names))).all()
+    }
+    for name in names:
+        if name not in populations:
+            populations[name] = Population(name=name, label=Population.label_for(name))
+            session.add(populations[name])
+    session.flush()
+    return populations
+
+def find_populations(session: Session, names: list[str]) -> dict[str, Population]:
+    '''
+    Map population names typed by a user to registered populations, matching
+    `Population.name` or `Population.label` case-insensitively, so that
+    `B Cell` is `b_cell`. Names without a match are left out.
+    '''
+    registered = {}
+    for population in session.exec(select(Population)).all():
+        registered.setdefault(population.label.casefold(), population)
+        registered[population.name.casefold()] = population
+    return {name: registered[name.casefold()] for name in names if name.casefold() in registered}
 
 def load_csv():
+    '''
+    Load CSV_FILE through the validated bulk ingestion path (see
+    app/ingest.py): rows with invalid values, duplicate sample names or
+    subjects described inconsistently are skipped and reported. The loaded
+    samples are then scored for QC (see app/qc.py).
+    '''
+    from app.ingest import IngestReport, insert_samples, prepare_samples, read_upload
+    from app.qc import refresh_sample_qc
+
     if not os.path.exists(CSV_FILE):
         raise FileNotFoundError(f"{CSV_FILE} not found.")
-
-    projects = {}
-    subjects = {}
-    samples = []
-    project_sample_counts = {}
-
-    with open(CSV_FILE, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            # Project
-            project_name = row['project']
-            if project_name not in projects:
-                projects[project_name] = Project(name=project_name, num_samples=0)
-                project_sample_counts[project_name] = 0
-            project_sample_counts[project_name] += 1
-            # Subject (unique by subject name)
-            subject_key = row['subject']
-            if subject_key not in subjects:
-                subjects[subject_key] = Subject(
-                    name=row['subject'],
-                    condition=row['condition'],
-                    age=int(row['age']),
-                    sex=row['sex'],
-                    treatment=row['treatment'],
-                    response=row['response'] if row['response'] else None
-                )
-            # Sample (store for later, after IDs are assigned)
-            samples.append(row)
-
+    with open(CSV_FILE, 'rb') as csvfile:
+        frame = read_upload(csvfile, CSV_FILE)
     with Session(engine) as session:
-        # Insert projects and set num_samples
-        for project_name, project in projects.items():
-            project.num_samples = project_sample_counts[project_name]
-            session.add(project)
-        session.commit()
-        # Refresh to get IDs
-        for project in projects.values():
-            session.refresh(project)
-        # Insert subjects
-        for subject in subjects.values():
-            session.add(subject)
-        session.commit()
-        for subject in subjects.values():
-            session.refresh(subject)
-        # Map for quick lookup
-        project_id_map = {p.name: p.id for p in projects.values()}
-        subject_id_map = {s.name: s.id for s in subjects.values()}
-        # Insert samples
-        for row in samples:
-            sample = Sample(
-                name=row['sample'],
-                subject_id=subject_id_map[row['subject']],
-                project_id=project_id_map[row['project']],
-                type=row['sample_type'],
-                time_from_treatment_start=int(row['time_from_treatment_start']),
-                b_cell=int(row['b_cell']),
-                cd8_t_cell=int(row['cd8_t_cell']),
-                cd4_t_cell=int(row['cd4_t_cell']),
-                nk_cell=int(row['nk_cell']),
-                monocyte=int(row['monocyte'])
-            )
-            session.add(sample)
+        clean, errors = prepare_samples(frame, session)
+        sample_ids = insert_samples(clean, session)
+        if sample_ids:
+            bump_data_version(session)
         session.commit()
+        if sample_ids:
+            refresh_sample_qc(session)
+            session.commit()
+    return IngestReport(total_rows=len(frame), inserted=len(sample_ids), errors=errors)
 
 
 def add_sample(form: SampleForm, session: Session):
     '''
     Assuming that subject and project IDs are correct since 
     the options in the form are populated from the database.
+    Raises ValueError for counts of unknown populations, which are only
+    registered by imports (see `get_or_create_populations`).
     '''
+    counts = form.get_counts()
+    populations = find_populations(session, list(counts))
+    unknown = [name for name in counts if name not in populations]
+    if unknown:
+        raise ValueError(f'Unknown population {", ".join(map(repr, unknown))}; new populations are registered by importing a CSV file')
+    if len({population.id for population in populations.values()}) < len(counts):
+        raise ValueError('A population is given more than once')
     sample = Sample(
         name=form.name,
-        subject_id=form.subject_id,
-        project_id=form.project_id,
+        subject_id=int(form.subject_id),
+        project_id=int(form.project_id),
         type=form.type,
         time_from_treatment_start=form.time_from_treatment_start,
-        b_cell=form.b_cell,
-        cd8_t_cell=form.cd8_t_cell,
-        cd4_t_cell=form.cd4_t_cell,
-        nk_cell=form.nk_cell,
-        monocyte=form.monocyte
     )
+    sample.counts = [SampleCount(population=populations[name], count=count) for name, count in counts.items()]
     session.add(sample)
+    session.flush()
+    update_rollups(session, [sample.id])
+    update_dataset_statistics(session, [sample.id])
+    bump_data_version(session)
+    session.commit()
+
+def replace_sample_counts(session: Session, population_counts: dict[int, dict[str, int]]):
+    '''
+    Set the counts of the given populations per sample id, e.g. from
+    gating, keeping rollups and dataset statistics in sync.
+    '''
+    sample_ids = list(population_counts)
+    if not sample_ids:
+        return
+    populations = get_or_create_populations(session, sorted({name for counts in population_counts.values() for name in counts}))
+    update_rollups(session, sample_ids, sign=-1)
+    update_dataset_statistics(session, sample_ids, sign=-1)
+    session.flush()
+    for chunk in chunked(sample_ids):
+        session.exec(delete(SampleCount).where(
+            SampleCount.sample_id.in_(chunk),
+            SampleCount.population_id.in_([population.id for population in populations.values()]),
+        ))
+    rows = [
+        {'sample_id': sample_id, 'population_id': populations[name].id, 'count': count}
+        for sample_id, counts in population_counts.items()
+        for name, count in counts.items()
+    ]
+    # an empty parameter list would compile to INSERT ... DEFAULT VALUES
+    if rows:
+        session.exec(insert(SampleCount), params=rows)
+    # counts were changed behind the ORM's back
+    session.expire_all()
+    # the new counts are scored by the next QC refresh
+    for chunk in chunked(sample_ids):
+        session.exec(delete(SampleQC).where(SampleQC.sample_id.in_(chunk)))
+    update_rollups(session, sample_ids)
+    update_dataset_statistics(session, sample_ids)
+    bump_data_version(session)
+    session.commit()
+
+def remove_sample(sample: Sample, session: Session):
+    update_rollups(session, [sample.id], sign=-1)
+    update_dataset_statistics(session, [sample.id], sign=-1)
+    event_path = sample.event_file.path if sample.event_file else None
+    # with the sample, so that its QC result never carries over to a later sample
+    session.exec(delete(SampleQC).where(SampleQC.sample_id == sample.id))
+    session.delete(sample)
+    bump_data_version(session)
+    session.commit()
+    if event_path and os.path.exists(event_path):
+        os.remove(event_path)
+
+def delete_samples(session: Session, conditions: list) -> int:
+    '''
+    Delete every sample matching `conditions` (predicates on `Sample`) with
+    set-based DELETEs, along with its counts, QC result and event data.
+    Rollups and dataset statistics are corrected in the same transaction
+    (project sample counts by triggers). Returns the number of deleted
+    samples.
+    '''
+    sample_ids = session.exec(select(Sample.id).where(*conditions)).all()
+    if not sample_ids:
+        return 0
+    update_rollups(session, sample_ids, sign=-1)
+    update_dataset_statistics(session, sample_ids, sign=-1)
+    event_paths = []
+    for chunk in chunked(sample_ids):
+        event_paths += session.exec(select(EventFile.path).where(EventFile.sample_id.in_(chunk))).all()
+        session.exec(delete(EventFile).where(EventFile.sample_id.in_(chunk)))
+        session.exec(delete(SampleCount).where(SampleCount.sample_id.in_(chunk)))
+        session.exec(delete(SampleQC).where(SampleQC.sample_id.in_(chunk)))
+        session.exec(delete(Sample).where(Sample.id.in_(chunk)))
+    bump_data_version(session)
+    session.commit()
+    for path in event_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    return len(sample_ids)
+
+# sample columns that can be set in bulk
+BULK_UPDATE_COLUMNS = ['type', 'time_from_treatment_start', 'project_id', 'subject_id']
+
+def update_samples(session: Session, conditions: list, values: dict) -> int:
+    '''
+    Set `values` (see `BULK_UPDATE_COLUMNS`) on every sample matching
+    `conditions` with set-based UPDATEs, keeping rollups and dataset
+    statistics in sync. Returns the number of updated samples.
+    '''
+    unknown = set(values) - set(BULK_UPDATE_COLUMNS)
+    if unknown:
+        raise ValueError(f'Cannot update {", ".join(sorted(unknown))} in bulk')
+    sample_ids = session.exec(select(Sample.id).where(*conditions)).all()
+    if not sample_ids or not values:
+        return 0
+    update_rollups(session, sample_ids, sign=-1)
+    update_dataset_statistics(session, sample_ids, sign=-1)
+    # the ids were selected up front, as `conditions` may depend on the updated columns
+    for chunk in chunked(sample_ids):
+        session.exec(update(Sample).where(Sample.id.in_(chunk)).values(**values))
+    update_rollups(session, sample_ids)
+    update_dataset_statistics(session, sample_ids)
+    bump_data_version(session)
     session.commit()
+    return len(sample_ids)
 
 def add_subject(form: SubjectForm, session: Session):
     subject = Subject(
@@ -119,6 +428,7 @@ def add_subject(form: SubjectForm, session: Session):
         response=form.response
     )
     session.add(subject)
+    bump_data_version(session)
     session.commit()
 
 def add_cohort(form: CohortForm, session: Session):
@@ -131,17 +441,83 @@ def add_cohort(form: CohortForm, session: Session):
     session.add(cohort)
     session.commit()
 
+def add_composite_cohort(form: CompositeCohortForm, session: Session):
+    cohort = Cohort(
+        name=form.name,
+        condition=None,
+        sex=None,
+        treatment=None,
+        operator=form.operator,
+        left_cohort_id=form.left_cohort_id,
+        right_cohort_id=form.right_cohort_id,
+    )
+    session.add(cohort)
+    session.commit()
+
 def add_dataset(form: DatasetForm, session: Session):
     dataset = Dataset(
         name=form.name,
         cohort_id=form.cohort_id,
-        sample_type=form.sample_type,
-        time_from_treatment_start=form.time_from_treatment_start
+        sample_types=form.sample_types,
+        project_ids=[int(project_id) for project_id in form.project_ids] if form.project_ids else None,
+        min_time_from_treatment_start=form.min_time_from_treatment_start,
+        max_time_from_treatment_start=form.max_time_from_treatment_start,
+        exclude_flagged=form.exclude_flagged,
     )
     session.add(dataset)
+    session.flush()
+    recompute_dataset_statistics(dataset, session)
+    session.add(DatasetVersion(dataset_id=dataset.id))
     session.commit()
 
+def freeze_dataset(dataset: Dataset, name: str, session: Session) -> DatasetSnapshot:
+    '''Store the samples currently selected by `dataset` as a named snapshot.'''
+    sample_ids = session.exec(select(Sample.id).where(*dataset.get_conditions(session))).all()
+    snapshot = DatasetSnapshot(
+        dataset_id=dataset.id,
+        name=name,
+        data_version=get_data_version(session),
+        num_samples=len(sample_ids),
+        encoded_sample_ids=DatasetSnapshot.encode_sample_ids(np.fromiter(sample_ids, dtype=np.int64, count=len(sample_ids))),
+    )
+    session.add(snapshot)
+    session.commit()
+    session.refresh(snapshot)
+    return snapshot
+
+class NumSamplesMismatch(BaseModel):
+    project_id: int
+    name: str
+    stored: int
+    actual: int
+
+def reconcile_num_samples(session: Session, fix: bool = False) -> list[NumSamplesMismatch]:
+    '''
+    Compare `Project.num_samples` with a GROUP BY count of the samples (one
+    scan of the project_id column) and, with `fix`, overwrite the mismatches.
+    '''
+    actual = dict(session.exec(select(Sample.project_id, func.count(Sample.id)).group_by(Sample.project_id)).all())
+    mismatches = [
+        NumSamplesMismatch(project_id=project.id, name=project.name, stored=project.num_samples, actual=actual.get(project.id, 0))
+        for project in session.exec(select(Project)).all()
+        if project.num_samples != actual.get(project.id, 0)
+    ]
+    if fix and mismatches:
+        for mismatch in mismatches:
+            session.exec(update(Project).where(Project.id == mismatch.project_id).values(num_samples=mismatch.actual))
+        session.commit()
+    return mismatches
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['reconcile']:
+        init_db()
+        fix = '--fix' in sys.argv
+        with Session(engine) as session:
+            mismatches = reconcile_num_samples(session, fix)
+        for mismatch in mismatches:
+            print(f'{mismatch.name}: num_samples is {mismatch.stored}, counted {mismatch.actual}' + (' (fixed)' if fix else ''))
+        print(f'{len(mismatches)} projects with a wrong sample count.')
+        sys.exit(1 if mismatches and not fix else 0)
     init_db()
     load_csv()
     print('Database initialized and CSV loaded.')
@@ -1,29 +1,45 @@
+from datetime import datetime
 from typing import Annotated, Literal, TypeAlias
+from urllib.parse import urlencode
 from fastapi import APIRouter
+from fastapi.responses import Response
 from fastui import components as c
 from fastui import AnyComponent, FastUI
 from fastui.components.display import DisplayLookup
 from fastui.events import GoToEvent, PageEvent
 from fastui.forms import fastui_form
-from sqlmodel import select
+from fastapi import HTTPException, Query, Request
+from sqlmodel import Session, func, select
+from sqlalchemy import nulls_last
 from sqlalchemy.orm import selectinload
 from pydantic import BaseModel
+import numpy as np
+import pandas as pd
 
-from app.database import SessionDep, add_dataset
-from app.models import Cohort, Dataset, DatasetForm, DatasetSampleFilterForm, Subject, ResponseEnum
-from app.shared import base_page
+from app.analytics import read_frame
+from app.cache import VersionedCache
+from app.columnar import get_snapshot
+from app.database import SessionDep, add_dataset, freeze_dataset, get_data_version
+from app.refresh import RefreshReport, StaleDataset, get_stale_datasets, refresh_stale_analyses
+from app.rollups import UNKNOWN
+from app.running_stats import PopulationStatistic, check_dataset_statistics, get_dataset_statistics, get_dataset_version
+from app.samples import bulk_action_modal
+from app.models import Cohort, Dataset, DatasetForm, DatasetSnapshot, DatasetSnapshotForm, DatasetSampleFilterForm, Project, ResponseType, Sample, SexEnum, SexType, Subject, ResponseEnum
+from app.shared import components_response, page_response, paginate
+from app.visualizations import get_dataset_chart_spec
 
 router = APIRouter()
 
 class DatasetRow(BaseModel):
     id: int | None = None # make all fields optional to avoid trivial errors
     name: str | None = None
-    sample_type: str | None = None
+    sample_types: str | None = None
+    cohort_id: int | None = None
     cohort_name: str | None = None
-    time_from_treatment_start: int | None = None
+    time_from_treatment_start: str | None = None
 
 @router.get("/", response_model=FastUI, response_model_exclude_none=True)
-def api_index(session: SessionDep, page: int = 1) -> list[AnyComponent]:
+def api_index(session: SessionDep, page: int = 1) -> Response:
     page_size = 20
     datasets = session.exec(select(Dataset).options(selectinload(Dataset.cohort))).all()
     dataset_rows = []
@@ -32,11 +48,12 @@ def api_index(session: SessionDep, page: int = 1) -> list[AnyComponent]:
         dataset_rows.append(DatasetRow(
             id=dataset.id,
             name=dataset.name,
+            cohort_id=dataset.cohort_id,
             cohort_name=cohort_name,
-            sample_type=dataset.sample_type,
-            time_from_treatment_start=dataset.time_from_treatment_start
+            sample_types=dataset.describe_sample_types(),
+            time_from_treatment_start=dataset.describe_time_range()
         ))
-    return base_page(
+    return page_response(
         c.Heading(text='Datasets', level=2),
         c.Paragraph(text=f'To create a new dataset, visit the Cohorts page, select a cohort, and visit the "Samples" tab.'),
         c.Table(
@@ -44,7 +61,7 @@ def api_index(session: SessionDep, page: int = 1) -> list[AnyComponent]:
             data_model=DatasetRow,
             columns=[
                 DisplayLookup(field='name', on_click=GoToEvent(url='/datasets/{id}/details')),
-                DisplayLookup(field='sample_type'),
+                DisplayLookup(field='sample_types', title='Sample Types'),
                 DisplayLookup(field='cohort_name', title='Cohort', on_click=GoToEvent(url='/cohorts/{cohort_id}/details')),
                 DisplayLookup(field='time_from_treatment_start', title='Time from Treatment Start'),
             ]
@@ -59,25 +76,293 @@ def new_dataset(form: Annotated[DatasetForm, fastui_form(DatasetForm)], session:
         c.FireEvent(event=GoToEvent(url='/datasets/'))
     ]
 
-DatasetViewKind: TypeAlias = Literal['details', 'samples', 'visualizations']
+class BreakdownRow(BaseModel):
+    group: str
+    count: int
+
+class DatasetBreakdown(BaseModel):
+    dataset_id: int
+    # the dataset's version (see `DatasetVersion`) the counts were computed for
+    dataset_version: int
+    num_samples: int
+    num_subjects: int
+    samples_by_project: list[BreakdownRow]
+    subjects_by_response: list[BreakdownRow]
+    subjects_by_sex: list[BreakdownRow]
+
+_breakdown_cache = VersionedCache()
+
+def get_dataset_breakdown(dataset: Dataset, session: Session) -> DatasetBreakdown:
+    '''
+    Counts of samples per project and of subjects per response and sex.
+    Each count is a GROUP BY over the dataset predicate, so no samples are
+    loaded; results are cached until a write touches the dataset's samples.
+    '''
+    dataset_version = get_dataset_version(session, dataset.id)
+
+    def compute() -> DatasetBreakdown:
+        conditions = dataset.get_conditions(session)
+        totals = read_frame(
+            session,
+            select(func.count(Sample.id), func.count(Sample.subject_id.distinct())).where(*conditions),
+            ['num_samples', 'num_subjects'],
+        )
+        samples_by_project = read_frame(
+            session,
+            select(Project.name, func.count(Sample.id))
+            .join(Project, Sample.project_id == Project.id)
+            .where(*conditions)
+            .group_by(Project.id, Project.name)
+            .order_by(Project.name),
+            ['group', 'count'],
+        )
+
+        def subjects_by(column) -> pd.DataFrame:
+            return read_frame(
+                session,
+                select(column, func.count(Sample.subject_id.distinct()))
+                .join(Subject, Sample.subject_id == Subject.id)
+                .where(*conditions)
+                .group_by(column)
+                .order_by(nulls_last(column)),
+                ['group', 'count'],
+            )
+
+        def rows(groups: pd.DataFrame) -> list[BreakdownRow]:
+            return [
+                BreakdownRow(group=group or 'Unknown', count=count)
+                for group, count in groups.itertuples(index=False)
+            ]
+
+        return DatasetBreakdown(
+            dataset_id=dataset.id,
+            dataset_version=dataset_version,
+            num_samples=int(totals['num_samples'].iloc[0]),
+            num_subjects=int(totals['num_subjects'].iloc[0]),
+            samples_by_project=rows(samples_by_project),
+            subjects_by_response=rows(subjects_by(Subject.response)),
+            subjects_by_sex=rows(subjects_by(Subject.sex)),
+        )
+
+    return _breakdown_cache.get_or_compute(dataset.id, dataset_version, compute)
+
+# declared before `/{id}/{kind}`, which would otherwise match this path
+@router.get('/breakdown/{id}', response_model=DatasetBreakdown)
+def dataset_breakdown(id: int, session: SessionDep) -> DatasetBreakdown:
+    dataset = session.get(Dataset, id)
+    if not dataset:
+        raise HTTPException(status_code=404, detail=f"Dataset {id} not found")
+    return get_dataset_breakdown(dataset, session)
+
+class DatasetStatisticsCheck(BaseModel):
+    dataset_id: int
+    consistent: bool
+    max_difference: float
+
+@router.get('/statistics/{id}', response_model=list[PopulationStatistic])
+def dataset_statistics(id: int, session: SessionDep) -> list[PopulationStatistic]:
+    dataset = session.get(Dataset, id)
+    if not dataset:
+        raise HTTPException(status_code=404, detail=f"Dataset {id} not found")
+    return get_dataset_statistics(dataset, session)
+
+@router.get('/statistics/{id}/check', response_model=DatasetStatisticsCheck)
+def dataset_statistics_check(id: int, session: SessionDep) -> DatasetStatisticsCheck:
+    '''Compare the running statistics against a full recompute.'''
+    dataset = session.get(Dataset, id)
+    if not dataset:
+        raise HTTPException(status_code=404, detail=f"Dataset {id} not found")
+    max_difference = check_dataset_statistics(dataset, session)
+    return DatasetStatisticsCheck(dataset_id=id, consistent=max_difference < 1e-6, max_difference=max_difference)
+
+class DatasetComparisonStatistic(BaseModel):
+    dataset_id: int
+    dataset_name: str
+    response: str
+    population: str
+    count: int
+    mean: float
+    std: float | None = None
+    median: float
+
+# keyed by the set of compared datasets, which requests choose freely
+_comparison_cache = VersionedCache(max_entries=64)
+
+def compare_datasets(datasets: list[Dataset], session: Session) -> list[DatasetComparisonStatistic]:
+    '''
+    Frequency statistics per dataset, response and population for many
+    datasets at once. The datasets are masks over one columnar snapshot
+    (cohorts shared between datasets are resolved once), frequencies are
+    computed once for the union of their samples, and every statistic
+    comes out of a single group-by over (dataset, response). Results are
+    cached per set of datasets and ordered as `datasets`.
+    '''
+    order = {dataset.id: position for position, dataset in enumerate(datasets)}
+    datasets = sorted({dataset.id: dataset for dataset in datasets}.values(), key=lambda dataset: dataset.id)
+
+    def compute():
+        snapshot = get_snapshot(session)
+        subject_masks = {}
+        membership = np.stack([dataset.get_sample_mask(snapshot, session, subject_masks) for dataset in datasets])
+        union = membership.any(axis=0)
+        frequencies = snapshot.frequencies(union)
+        responses = snapshot.response(union).to_numpy()
+        # one row per (dataset, sample) pair; samples in several datasets are repeated
+        dataset_index, row_index = np.nonzero(membership[:, union])
+        pairs = pd.DataFrame(frequencies.to_numpy()[row_index], columns=frequencies.columns)
+        # samples without a response are grouped as in the running statistics
+        pairs.insert(0, 'response', pd.Series(responses[row_index]).fillna(UNKNOWN))
+        pairs.insert(0, 'dataset_id', np.array([dataset.id for dataset in datasets])[dataset_index])
+        grouped = pairs.groupby(['dataset_id', 'response'], sort=False).agg(['count', 'mean', 'std', 'median'])
+        statistics = grouped.stack(level=0).rename_axis(['dataset_id', 'response', 'population']).reset_index()
+        statistics = statistics[statistics['count'] > 0].astype({'count': int})
+        statistics['std'] = statistics['std'].astype(object).where(statistics['std'].notna(), None)
+        names = {dataset.id: dataset.name for dataset in datasets}
+        positions = {dataset.id: position for position, dataset in enumerate(datasets)}
+        statistics = (
+            statistics.assign(position=statistics['dataset_id'].map(positions))
+            .sort_values(['position', 'population', 'response'])
+            .drop(columns='position')
+        )
+        return [
+            DatasetComparisonStatistic(dataset_name=names[row['dataset_id']], **row)
+            for row in statistics.to_dict('records')
+        ]
+    versions = tuple(get_dataset_version(session, dataset.id) for dataset in datasets)
+    statistics = _comparison_cache.get_or_compute(tuple(dataset.id for dataset in datasets), versions, compute)
+    # a stable sort keeps the population and response order within each dataset
+    return sorted(statistics, key=lambda statistic: order[statistic.dataset_id])
+
+@router.get('/compare', response_model=list[DatasetComparisonStatistic])
+def dataset_comparison(ids: Annotated[list[int], Query()], session: SessionDep) -> list[DatasetComparisonStatistic]:
+    '''Statistics matrix of several datasets side by side, e.g. `/api/datasets/compare?ids=1&ids=2`.'''
+    datasets = session.exec(select(Dataset).where(Dataset.id.in_(ids))).all()
+    by_id = {dataset.id: dataset for dataset in datasets}
+    missing = [id for id in ids if id not in by_id]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Datasets {', '.join(map(str, missing))} not found")
+    return compare_datasets([by_id[id] for id in dict.fromkeys(ids)], session)
+
+class DatasetSnapshotInfo(BaseModel):
+    id: int
+    dataset_id: int
+    name: str
+    created_at: datetime
+    data_version: int
+    num_samples: int
+
+class SnapshotDiff(BaseModel):
+    snapshot_id: int
+    dataset_id: int
+    snapshot_data_version: int
+    current_data_version: int
+    # samples the live dataset selects that are not in the snapshot, and the reverse
+    added: list[int]
+    removed: list[int]
+
+def get_dataset_snapshots(dataset_id: int, session: Session) -> list[DatasetSnapshotInfo]:
+    rows = session.exec(
+        select(
+            DatasetSnapshot.id, DatasetSnapshot.dataset_id, DatasetSnapshot.name, DatasetSnapshot.created_at,
+            DatasetSnapshot.data_version, DatasetSnapshot.num_samples,
+        )
+        .where(DatasetSnapshot.dataset_id == dataset_id)
+        .order_by(DatasetSnapshot.id)
+    ).all()
+    return [DatasetSnapshotInfo(**row._asdict()) for row in rows]
+
+def diff_dataset_snapshot(snapshot: DatasetSnapshot, session: Session) -> SnapshotDiff:
+    '''
+    Samples added to and removed from the dataset since `snapshot` was
+    taken. Membership only changes with the data version, so an unchanged
+    version needs no comparison; otherwise the live dataset is a mask over
+    the columnar snapshot and the difference two sorted set operations.
+    '''
+    version = get_data_version(session)
+    added = removed = np.empty(0, dtype=np.int64)
+    if version != snapshot.data_version:
+        columnar = get_snapshot(session)
+        live = np.asarray(columnar.sample_id)[session.get(Dataset, snapshot.dataset_id).get_sample_mask(columnar, session)]
+        frozen = snapshot.get_sample_ids()
+        added = np.setdiff1d(live, frozen, assume_unique=True)
+        removed = np.setdiff1d(frozen, live, assume_unique=True)
+    return SnapshotDiff(
+        snapshot_id=snapshot.id,
+        dataset_id=snapshot.dataset_id,
+        snapshot_data_version=snapshot.data_version,
+        current_data_version=version,
+        added=added.tolist(),
+        removed=removed.tolist(),
+    )
+
+# declared before `/{id}/{kind}`, which would otherwise match this path
+@router.get('/snapshots/{id}', response_model=list[DatasetSnapshotInfo])
+def dataset_snapshots(id: int, session: SessionDep) -> list[DatasetSnapshotInfo]:
+    if not session.get(Dataset, id):
+        raise HTTPException(status_code=404, detail=f"Dataset {id} not found")
+    return get_dataset_snapshots(id, session)
+
+@router.post('/snapshots/{id}', response_model=FastUI, response_model_exclude_none=True)
+def new_dataset_snapshot(id: int, form: Annotated[DatasetSnapshotForm, fastui_form(DatasetSnapshotForm)], session: SessionDep) -> list[AnyComponent]:
+    '''Freeze the samples the dataset currently selects.'''
+    dataset = session.get(Dataset, id)
+    if not dataset:
+        raise HTTPException(status_code=404, detail=f"Dataset {id} not found")
+    snapshot = freeze_dataset(dataset, form.name, session)
+    return [c.Paragraph(text=f'Saved snapshot {snapshot.name!r} of {snapshot.num_samples} samples.')]
+
+@router.get('/snapshot/{snapshot_id}/samples', response_model=list[int])
+def dataset_snapshot_samples(snapshot_id: int, session: SessionDep) -> list[int]:
+    '''Ids of the samples frozen in a snapshot.'''
+    snapshot = session.get(DatasetSnapshot, snapshot_id)
+    if not snapshot:
+        raise HTTPException(status_code=404, detail=f"Snapshot {snapshot_id} not found")
+    return snapshot.get_sample_ids().tolist()
+
+@router.get('/snapshot/{snapshot_id}/diff', response_model=SnapshotDiff)
+def dataset_snapshot_diff(snapshot_id: int, session: SessionDep) -> SnapshotDiff:
+    snapshot = session.get(DatasetSnapshot, snapshot_id)
+    if not snapshot:
+        raise HTTPException(status_code=404, detail=f"Snapshot {snapshot_id} not found")
+    return diff_dataset_snapshot(snapshot, session)
+
+@router.get('/stale', response_model=list[StaleDataset])
+def stale_datasets(session: SessionDep) -> list[StaleDataset]:
+    '''Datasets whose samples changed since their analyses were last refreshed.'''
+    return get_stale_datasets(session)
+
+@router.post('/refresh', response_model=RefreshReport)
+def refresh_datasets(session: SessionDep, refresh_all: bool = False) -> RefreshReport:
+    '''Recompute the statistics and images of the stale datasets, and warm this process's caches for them.'''
+    # images are rendered here: forking a threaded server holding SQLite connections is unsafe,
+    # the process pool is left to `python -m app.refresh`
+    report = refresh_stale_analyses(session, workers=1, refresh_all=refresh_all)
+    for entry in report.refreshed:
+        dataset = session.get(Dataset, entry.dataset_id)
+        get_dataset_breakdown(dataset, session)
+        get_dataset_chart_spec(dataset, session)
+    return report
+
+DatasetViewKind: TypeAlias = Literal['details', 'samples', 'breakdown', 'visualizations']
 
 @router.get('/{id}/{kind}', response_model=FastUI, response_model_exclude_none=True)
 def dataset_view(
     id: int, 
     kind: DatasetViewKind, 
     session: SessionDep,
-    response: str | None = None,
-    sex: str | None = None,
+    request: Request,
+    response: ResponseType | None = None,
+    sex: SexType | None = None,
     page: int = 1
-) -> list[AnyComponent]:
+) -> Response:
     dataset = session.get(Dataset, id)
     if not dataset:
-        return base_page(
+        return page_response(
             c.Heading(text='Dataset not found', level=2),
             c.Paragraph(text='The requested dataset does not exist.')
         )
     
-    return base_page(
+    return page_response(
         c.Heading(text=f'Dataset: {dataset.name}', level=2),
         c.LinkList(
             links=[
@@ -105,6 +390,18 @@ def dataset_view(
                     ),
                     active=f'/datasets/{id}/samples',
                 ),
+                c.Link(
+                    components=[c.Text(text='Breakdown')],
+                    on_click=PageEvent(
+                        name='change-content', 
+                        push_path=f'/datasets/{id}/breakdown', 
+                        context={
+                            'kind': 'breakdown',
+                            'id': id
+                        }
+                    ),
+                    active=f'/datasets/{id}/breakdown',
+                ),
                 c.Link(
                     components=[c.Text(text='Visualizations')],
                     on_click=PageEvent(
@@ -124,7 +421,7 @@ def dataset_view(
         c.ServerLoad(
             path='/datasets/content/{id}/{kind}',
             load_trigger=PageEvent(name='change-content'),
-            components=dataset_content(id, kind, session, response, sex, page),
+            components=dataset_components(id, kind, session, request, response, sex, page),
         )
     )
 
@@ -133,8 +430,10 @@ class DatasetDetails(BaseModel):
     name: str | None = None
     cohort_id: int | None = None
     cohort_name: str | None = None
-    sample_type: str | None = None
-    time_from_treatment_start: int | None = None
+    sample_types: str | None = None
+    projects: str | None = None
+    time_from_treatment_start: str | None = None
+    qc_flagged_samples: str | None = None
 
 class DatasetSampleRow(BaseModel):
     id: int | None = None
@@ -149,66 +448,110 @@ def dataset_content(
         id: int, 
         kind: DatasetViewKind, 
         session: SessionDep,
-        response: str | None = None,  # for filtering samples
-        sex: str | None = None,
+        request: Request,
+        response: ResponseType | None = None,  # for filtering samples
+        sex: SexType | None = None,
+        page: int = 1,
+    ) -> Response:
+    # the samples tab holds a cached component, spliced in by components_response
+    return components_response(dataset_components(id, kind, session, request, response, sex, page))
+
+def dataset_components(
+        id: int,
+        kind: DatasetViewKind,
+        session: Session,
+        request: Request,
+        response: ResponseType | None = None,
+        sex: SexType | None = None,
         page: int = 1,
     ) -> list[AnyComponent]:
+    '''Content of a tab of the dataset page; see `dataset_content`.'''
     dataset = session.get(Dataset, id)
     if not dataset:
-        return base_page(
+        return [
             c.Heading(text='Dataset not found', level=2),
             c.Paragraph(text='The requested dataset does not exist.')
-        )
+        ]
 
     match kind:
         case 'details':
             cohort = session.get(Cohort, dataset.cohort_id)
             cohort_name = cohort.name if cohort else 'Unknown'
+            projects = 'Any'
+            if dataset.project_ids:
+                project_names = session.exec(select(Project.name).where(Project.id.in_(dataset.project_ids))).all()
+                projects = ', '.join(project_names)
             dataset_details = DatasetDetails(
                 id=dataset.id,
                 name=dataset.name,
+                cohort_id=dataset.cohort_id,
                 cohort_name=cohort_name,
-                sample_type=dataset.sample_type,
-                time_from_treatment_start=dataset.time_from_treatment_start
+                sample_types=dataset.describe_sample_types(),
+                projects=projects,
+                time_from_treatment_start=dataset.describe_time_range(),
+                qc_flagged_samples='Excluded' if dataset.exclude_flagged else 'Included',
             )
             return [
                 c.Details(
                     data=dataset_details,
                     fields=[
                         DisplayLookup(field='name'),
-                        DisplayLookup(field='cohort_name', title='Cohort', on_click=GoToEvent(url='/cohorts/{id}/details')),
-                        DisplayLookup(field='sample_type'),
-                        DisplayLookup(field='time_from_treatment_start')
+                        DisplayLookup(field='cohort_name', title='Cohort', on_click=GoToEvent(url='/cohorts/{cohort_id}/details')),
+                        DisplayLookup(field='sample_types', title='Sample Types'),
+                        DisplayLookup(field='projects'),
+                        DisplayLookup(field='time_from_treatment_start'),
+                        DisplayLookup(field='qc_flagged_samples', title='QC-flagged Samples'),
                     ]
-                )
+                ),
+                c.Heading(text='Snapshots', level=4),
+                c.Paragraph(text='A snapshot freezes the samples this dataset currently selects, so that an analysis can be reproduced later.'),
+                c.Table(
+                    data=get_dataset_snapshots(id, session),
+                    data_model=DatasetSnapshotInfo,
+                    no_data_message='No snapshots of this dataset.',
+                    columns=[
+                        DisplayLookup(field='name'),
+                        DisplayLookup(field='created_at', title='Created'),
+                        DisplayLookup(field='num_samples', title='Samples'),
+                        DisplayLookup(field='data_version', title='Data Version'),
+                    ],
+                ),
+                c.ModelForm(model=DatasetSnapshotForm, submit_url=f'/api/datasets/snapshots/{id}'),
             ]
-        case 'samples': # FIXME: filtering doesn't work
+        case 'samples':
             page_size = 20
-            samples = dataset.get_samples(session) # TODO: performance (perceptable lag on UI)
-            sample_rows = []
-            for sample in samples: # TODO: performance (perceptable lag on UI)
-                subject = session.get(Subject, sample.subject_id)
-                sample_response = subject.response.value if subject and subject.response else None
-                if response and sample_response != response: # filter by response
-                    continue
-                sample_sex = subject.sex.value if subject and subject.sex else None
-                if sex and sample_sex != sex: # filter by sex
-                    continue
-                sample_rows.append(DatasetSampleRow(
-                    id=sample.id,
-                    name=sample.name,
-                    subject_id=sample.subject_id,
-                    subject_name=subject.name if subject else 'Unknown',
-                    sex=sample_sex,
-                    response=sample_response
-                ))
+            conditions = dataset.get_conditions(session)
+            num_samples = session.exec(select(func.count(Sample.id)).where(*conditions)).one()
+            if response:
+                conditions.append(Subject.response == ResponseEnum(response))
+            if sex:
+                conditions.append(Subject.sex == SexEnum(sex))
+            query = (
+                select(Sample.id, Sample.name, Sample.subject_id, Subject.name.label('subject_name'), Subject.sex, Subject.response)
+                .outerjoin(Subject, Sample.subject_id == Subject.id)
+                .where(*conditions)
+                .order_by(Sample.id)
+            )
+            rows, num_filtered = paginate(session, query, page, page_size)
+            sample_rows = [
+                DatasetSampleRow(
+                    id=row.id,
+                    name=row.name,
+                    subject_id=row.subject_id,
+                    subject_name=row.subject_name or 'Unknown',
+                    sex=row.sex.value if row.sex else None,
+                    response=row.response.value if row.response else None,
+                )
+                for row in rows
+            ]
             filter_form_initial = {}
             if sex:
                 filter_form_initial['sex'] = sex
             if response:
                 filter_form_initial['response'] = response
             return [
-                c.Paragraph(text=f'There are {len(samples)} samples associated with this dataset (currently showing {len(sample_rows)} after filtering).'),
+                c.Paragraph(text=f'There are {num_samples} samples associated with this dataset (currently showing {num_filtered} after filtering).'),
+                *bulk_action_modal('/api/samples/bulk-action?' + urlencode({'dataset_id': id, **filter_form_initial})),
                 c.ModelForm(
                     model=DatasetSampleFilterForm,
                     submit_url='.',
@@ -218,7 +561,7 @@ def dataset_content(
                     display_mode='inline',
                 ),
                 c.Table(
-                    data=sample_rows[(page - 1) * page_size : page * page_size],
+                    data=sample_rows,
                     data_model=DatasetSampleRow,
                     columns=[
                         DisplayLookup(field='name', on_click=GoToEvent(url='/samples/{id}')),
@@ -227,13 +570,53 @@ def dataset_content(
                         DisplayLookup(field='response'),
                     ]
                 ),
-                c.Pagination(page=page, page_size=page_size, total=len(sample_rows)),
+                c.Pagination(page=page, page_size=page_size, total=num_filtered),
+            ]
+        case 'breakdown':
+            breakdown = get_dataset_breakdown(dataset, session)
+            columns = [DisplayLookup(field='group'), DisplayLookup(field='count')]
+            return [
+                c.Paragraph(text=f'This dataset contains {breakdown.num_samples} samples from {breakdown.num_subjects} subjects.'),
+                c.Heading(text='Samples per project', level=4),
+                c.Table(data=breakdown.samples_by_project, data_model=BreakdownRow, columns=columns),
+                c.Heading(text='Subjects by response', level=4),
+                c.Table(data=breakdown.subjects_by_response, data_model=BreakdownRow, columns=columns),
+                c.Heading(text='Subjects by sex', level=4),
+                c.Table(data=breakdown.subjects_by_sex, data_model=BreakdownRow, columns=columns),
             ]
         case 'visualizations':
+            statistics = [
+                statistic.model_copy(update={
+                    'mean': round(statistic.mean, 2),
+                    'std': round(statistic.std, 2) if statistic.std is not None else None,
+                })
+                for statistic in get_dataset_statistics(dataset, session)
+            ]
             return [
-                c.Image(
-                    src=f'/api/visualizations/dataset/{id}',
-                )
+                # drawn by the browser from precomputed boxplot statistics; the PNG is rendered only on export
+                c.Iframe(
+                    src=str(request.url_for('get_dataset_chart', id=id)),
+                    title='Population frequencies by response',
+                    width='100%',
+                    height=400,
+                ),
+                c.Link(
+                    components=[c.Text(text='Download as PNG')],
+                    on_click=GoToEvent(url=f'/api/visualizations/dataset/{id}', target='_blank'),
+                ),
+                c.Heading(text='Population frequencies by response', level=4),
+                c.Table(
+                    data=statistics,
+                    data_model=PopulationStatistic,
+                    no_data_message='No samples in this dataset.',
+                    columns=[
+                        DisplayLookup(field='population'),
+                        DisplayLookup(field='response'),
+                        DisplayLookup(field='count', title='Samples'),
+                        DisplayLookup(field='mean', title='Mean (%)'),
+                        DisplayLookup(field='std', title='Std (%)'),
+                    ],
+                ),
             ]
         case _:
             raise ValueError(f'Invalid kind {kind!r}')
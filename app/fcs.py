@@ -0,0 +1,175 @@
+'''
+Parsing of FCS 3.0/3.1 list-mode files into memory-mapped event arrays.
+
+The DATA segment is streamed in chunks into a float32 .npy file of shape
+(events, channels), so ingestion needs memory for one chunk regardless
+of the file size. The arrays are then read with `load_events`, which
+maps the file instead of loading it.
+'''
+import math
+import os
+import sys
+from typing import BinaryIO
+
+import numpy as np
+from sqlmodel import Session, select
+
+from app.models import EventFile, Sample
+
+EVENTS_DIR = 'events'
+CHUNK_BYTES = 8 * 1024 * 1024
+
+class FCSError(ValueError):
+    pass
+
+def read_header(file: BinaryIO) -> dict:
+    file.seek(0)
+    header = file.read(58)
+    version = header[:6].decode('ascii', errors='replace')
+    if not version.startswith('FCS3'):
+        raise FCSError(f'Unsupported FCS version {version!r}, only FCS 3.x is supported')
+    try:
+        offsets = [int(header[10 + 8 * i: 18 + 8 * i].strip() or 0) for i in range(6)]
+    except ValueError:
+        raise FCSError('Malformed FCS header')
+    text_start, text_end, data_start, data_end, _, _ = offsets
+    return {'version': version, 'text_start': text_start, 'text_end': text_end, 'data_start': data_start, 'data_end': data_end}
+
+def read_text(file: BinaryIO, start: int, end: int) -> dict[str, str]:
+    '''Keyword/value pairs of the TEXT segment, with upper-case keywords.'''
+    file.seek(start)
+    text = file.read(end - start + 1).decode('utf-8', errors='replace')
+    if not text:
+        raise FCSError('Empty TEXT segment')
+    delimiter, text = text[0], text[1:]
+    # a doubled delimiter is an escaped delimiter character inside a value
+    placeholder = '\0'
+    fields = text.replace(delimiter * 2, placeholder).split(delimiter)
+    fields = [field.replace(placeholder, delimiter) for field in fields]
+    if fields and fields[-1] == '':
+        fields.pop()
+    return {fields[i].strip().upper(): fields[i + 1].strip() for i in range(0, len(fields) - 1, 2)}
+
+def number(keywords: dict[str, str], keyword: str, kind: type = int, minimum: float = 0):
+    '''Numeric value of a required keyword, as an FCSError when missing or malformed.'''
+    if keyword not in keywords:
+        raise FCSError(f'Missing keyword {keyword}')
+    try:
+        value = kind(keywords[keyword])
+    except ValueError:
+        raise FCSError(f'Invalid {keyword} value {keywords[keyword]!r}')
+    if not math.isfinite(value) or value < minimum:
+        raise FCSError(f'Invalid {keyword} value {keywords[keyword]!r}')
+    return value
+
+def channel_metadata(keywords: dict[str, str]) -> list[dict]:
+    return [
+        {
+            'name': keywords.get(f'$P{i}N', f'P{i}'),
+            'stain': keywords.get(f'$P{i}S') or None,
+            'bits': number(keywords, f'$P{i}B') if keywords.get(f'$P{i}B', '*') != '*' else None,
+            'range': number(keywords, f'$P{i}R', float) if f'$P{i}R' in keywords else None,
+        }
+        for i in range(1, number(keywords, '$PAR', minimum=1) + 1)
+    ]
+
+def data_dtype(keywords: dict[str, str], channels: list[dict]) -> np.dtype:
+    byte_order = keywords.get('$BYTEORD', '1,2,3,4').replace(' ', '')
+    endian = '>' if byte_order in ('4,3,2,1', '2,1') else '<'
+    match keywords.get('$DATATYPE', '').upper():
+        case 'F':
+            return np.dtype(f'{endian}f4')
+        case 'D':
+            return np.dtype(f'{endian}f8')
+        case 'I':
+            bits = {channel['bits'] for channel in channels}
+            if len(bits) != 1 or next(iter(bits)) not in (8, 16, 32, 64):
+                raise FCSError(f'Unsupported integer bit widths {sorted(bits, key=str)}')
+            return np.dtype(f'{endian}u{next(iter(bits)) // 8}')
+        case datatype:
+            raise FCSError(f'Unsupported $DATATYPE {datatype!r}')
+
+def parse_fcs(file: BinaryIO, output_path: str) -> dict:
+    '''
+    Stream the events of an FCS file into a float32 .npy file at
+    `output_path`. Returns the version, event count and channel metadata.
+    '''
+    header = read_header(file)
+    keywords = read_text(file, header['text_start'], header['text_end'])
+    if keywords.get('$MODE', 'L').upper() != 'L':
+        raise FCSError('Only list mode ($MODE L) data is supported')
+    channels = channel_metadata(keywords)
+    dtype = data_dtype(keywords, channels)
+    num_events = number(keywords, '$TOT')
+    num_channels = len(channels)
+    # offsets above 99,999,999 do not fit in the header and are only given in TEXT
+    data_start = header['data_start'] or (number(keywords, '$BEGINDATA') if '$BEGINDATA' in keywords else 0)
+    data_end = header['data_end'] or (number(keywords, '$ENDDATA') if '$ENDDATA' in keywords else 0)
+    if data_end - data_start + 1 < num_events * num_channels * dtype.itemsize:
+        raise FCSError('DATA segment is shorter than $TOT x $PAR values')
+    # checked before the output file is allocated for the declared size
+    file.seek(0, os.SEEK_END)
+    if num_events and data_end >= file.tell():
+        raise FCSError('DATA segment extends past the end of the file')
+    # integer channels may carry bits above their range, which must be masked off
+    masks = None
+    if dtype.kind == 'u':
+        masks = np.array([
+            int(channel['range']) - 1 if channel['range'] and int(channel['range']) & (int(channel['range']) - 1) == 0 else np.iinfo(dtype).max
+            for channel in channels
+        ], dtype=dtype.newbyteorder('='))
+
+    events = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=(num_events, num_channels))
+    events_per_chunk = max(1, CHUNK_BYTES // (num_channels * dtype.itemsize))
+    file.seek(data_start)
+    for start in range(0, num_events, events_per_chunk):
+        count = min(events_per_chunk, num_events - start)
+        buffer = file.read(count * num_channels * dtype.itemsize)
+        if len(buffer) != count * num_channels * dtype.itemsize:
+            raise FCSError('File ends inside the DATA segment')
+        chunk = np.frombuffer(buffer, dtype=dtype).reshape(count, num_channels)
+        if masks is not None:
+            chunk = chunk & masks
+        events[start:start + count] = chunk
+    events.flush()
+    del events
+    return {'version': header['version'], 'num_events': num_events, 'channels': channels}
+
+def ingest_fcs(sample: Sample, file: BinaryIO, filename: str, session: Session) -> EventFile:
+    '''Parse an FCS file into the event store and link it to `sample`, replacing earlier events.'''
+    os.makedirs(EVENTS_DIR, exist_ok=True)
+    path = os.path.join(EVENTS_DIR, f'sample_{sample.id}.npy')
+    temporary_path = f'{path}.{os.getpid()}.tmp.npy'
+    try:
+        parsed = parse_fcs(file, temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    event_file = session.exec(select(EventFile).where(EventFile.sample_id == sample.id)).first() or EventFile(sample_id=sample.id)
+    event_file.path = path
+    event_file.filename = filename
+    event_file.fcs_version = parsed['version']
+    event_file.num_events = parsed['num_events']
+    event_file.channels = parsed['channels']
+    session.add(event_file)
+    session.commit()
+    return event_file
+
+def load_events(event_file: EventFile) -> np.ndarray:
+    '''Read-only memory map of the (events, channels) float32 array.'''
+    return np.load(event_file.path, mmap_mode='r')
+
+if __name__ == '__main__':
+    from app.database import engine
+
+    if len(sys.argv) != 3:
+        sys.exit('Usage: python -m app.fcs <sample name> <file.fcs>')
+    sample_name, fcs_path = sys.argv[1:]
+    with Session(engine) as session:
+        sample = session.exec(select(Sample).where(Sample.name == sample_name)).first()
+        if not sample:
+            sys.exit(f'Sample {sample_name!r} not found.')
+        with open(fcs_path, 'rb') as fcs_file:
+            event_file = ingest_fcs(sample, fcs_file, os.path.basename(fcs_path), session)
+        print(f'Loaded {event_file.num_events} events x {len(event_file.channels)} channels for sample {sample_name!r}.')
@@ -0,0 +1,204 @@
+'''
+Gating engine deriving population counts from event-level data.
+
+A gating strategy is an ordered hierarchy of rectangle, polygon and
+threshold gates. Each gate is evaluated as a NumPy boolean mask over the
+memory-mapped event array of a sample (see app/fcs.py), restricted to the
+events of its parent gate. Gates with a `population` produce the count
+of that population, which is written back to the sample's counts.
+Samples are gated in parallel across a process pool.
+'''
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Annotated, Literal, Union
+
+import numpy as np
+import pydantic
+from matplotlib.path import Path
+from sqlmodel import Session, select
+
+from app.models import EventFile, GatingStrategy
+
+# events evaluated at once, bounding the memory used for masks per worker
+CHUNK_EVENTS = 1 << 18
+
+class BaseGate(pydantic.BaseModel):
+    name: str
+    parent: str | None = None
+    # population whose count is the number of events in this gate
+    population: str | None = None
+
+class RectangleGate(BaseGate):
+    kind: Literal['rectangle'] = 'rectangle'
+    x_channel: str
+    y_channel: str
+    x_min: float | None = None
+    x_max: float | None = None
+    y_min: float | None = None
+    y_max: float | None = None
+
+class PolygonGate(BaseGate):
+    kind: Literal['polygon'] = 'polygon'
+    x_channel: str
+    y_channel: str
+    vertices: list[tuple[float, float]] = pydantic.Field(min_length=3)
+
+class ThresholdGate(BaseGate):
+    kind: Literal['threshold'] = 'threshold'
+    channel: str
+    min: float | None = None
+    max: float | None = None
+
+Gate = Annotated[Union[RectangleGate, PolygonGate, ThresholdGate], pydantic.Field(discriminator='kind')]
+
+class GatingStrategyForm(pydantic.BaseModel):
+    name: str
+    gates: list[Gate]
+
+    @pydantic.model_validator(mode='after')
+    def check_hierarchy(self):
+        seen = set()
+        for gate in self.gates:
+            if gate.name in seen:
+                raise ValueError(f'Duplicate gate name {gate.name!r}')
+            if gate.parent is not None and gate.parent not in seen:
+                raise ValueError(f'Parent {gate.parent!r} of gate {gate.name!r} must be defined before it')
+            seen.add(gate.name)
+        if not any(gate.population for gate in self.gates):
+            raise ValueError('At least one gate must set a population, otherwise gating produces no counts')
+        return self
+
+def strategy_gates(strategy: GatingStrategy) -> list[Gate]:
+    return GatingStrategyForm(name=strategy.name, gates=strategy.gates).gates
+
+def _between(values: np.ndarray, low: float | None, high: float | None) -> np.ndarray:
+    mask = np.ones(len(values), dtype=bool)
+    if low is not None:
+        mask &= values >= low
+    if high is not None:
+        mask &= values <= high
+    return mask
+
+def gate_mask(gate: Gate, events: np.ndarray, columns: dict[str, int], parent: np.ndarray) -> np.ndarray:
+    '''Events of the `events` chunk inside `gate` and its `parent` mask.'''
+    match gate:
+        case ThresholdGate():
+            return parent & _between(events[:, columns[gate.channel]], gate.min, gate.max)
+        case RectangleGate():
+            return (
+                parent
+                & _between(events[:, columns[gate.x_channel]], gate.x_min, gate.x_max)
+                & _between(events[:, columns[gate.y_channel]], gate.y_min, gate.y_max)
+            )
+        case PolygonGate():
+            # point-in-polygon is the costly test, so only run it on the parent's events
+            indices = np.flatnonzero(parent)
+            points = events[np.ix_(indices, [columns[gate.x_channel], columns[gate.y_channel]])]
+            mask = np.zeros(len(events), dtype=bool)
+            mask[indices] = Path(gate.vertices).contains_points(points)
+            return mask
+
+def gate_events(gates: list[Gate], events: np.ndarray, channels: list[str]) -> dict[str, int]:
+    '''Number of events in every gate, evaluated chunk by chunk over a (memory-mapped) event array.'''
+    columns = {name: index for index, name in enumerate(channels)}
+    counts = dict.fromkeys((gate.name for gate in gates), 0)
+    for start in range(0, len(events), CHUNK_EVENTS):
+        chunk = np.asarray(events[start:start + CHUNK_EVENTS])
+        masks = {}
+        for gate in gates:
+            parent = masks[gate.parent] if gate.parent else np.ones(len(chunk), dtype=bool)
+            masks[gate.name] = gate_mask(gate, chunk, columns, parent)
+            counts[gate.name] += int(np.count_nonzero(masks[gate.name]))
+    return counts
+
+def _gate_file(path: str, channels: list[str], gates: list[dict]) -> dict[str, int]:
+    gates = GatingStrategyForm(name='', gates=gates).gates
+    return gate_events(gates, np.load(path, mmap_mode='r'), channels)
+
+def gate_files(gates: list[Gate], files: list[tuple[str, list[str]]], workers: int | None = None) -> list[dict[str, int]]:
+    '''Gate counts of every (path, channel names) event file, across a process pool.'''
+    gate_dicts = [gate.model_dump() for gate in gates]
+    if workers == 1:
+        return [_gate_file(path, channels, gate_dicts) for path, channels in files]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_gate_file, path, channels, gate_dicts) for path, channels in files]
+        return [future.result() for future in futures]
+
+def apply_gating_strategy(strategy: GatingStrategy, session: Session, sample_ids: list[int] | None = None, workers: int | None = None) -> dict[int, dict[str, int]]:
+    '''
+    Gate the event data of `sample_ids` (default: every sample with events)
+    and write the population counts back to the samples. Returns the
+    population counts per sample id.
+    '''
+    from app.database import replace_sample_counts
+
+    query = select(EventFile)
+    if sample_ids is not None:
+        query = query.where(EventFile.sample_id.in_(sample_ids))
+    event_files = session.exec(query).all()
+    gates = strategy_gates(strategy)
+    gate_counts = gate_files(
+        gates,
+        [(event_file.path, [channel['name'] for channel in event_file.channels]) for event_file in event_files],
+        workers,
+    )
+    population_counts = {
+        event_file.sample_id: {gate.population: counts[gate.name] for gate in gates if gate.population}
+        for event_file, counts in zip(event_files, gate_counts)
+    }
+    replace_sample_counts(session, population_counts)
+    return population_counts
+
+def benchmark(num_samples: int = 100, num_events: int = 1_000_000, workers: int | None = None):
+    '''Time gating of synthetic event files, sequentially and across a process pool.'''
+    channels = ['FSC-A', 'SSC-A', 'CD3', 'CD4', 'CD8', 'CD19', 'CD56', 'CD14']
+    gates = GatingStrategyForm(name='benchmark', gates=[
+        {'kind': 'polygon', 'name': 'cells', 'x_channel': 'FSC-A', 'y_channel': 'SSC-A',
+         'vertices': [(0.1, 0.05), (0.95, 0.1), (0.9, 0.9), (0.2, 0.8)]},
+        {'kind': 'threshold', 'name': 'b', 'parent': 'cells', 'channel': 'CD19', 'min': 0.7, 'population': 'b_cell'},
+        {'kind': 'threshold', 'name': 't', 'parent': 'cells', 'channel': 'CD3', 'min': 0.5},
+        {'kind': 'rectangle', 'name': 'cd4', 'parent': 't', 'x_channel': 'CD4', 'y_channel': 'CD8', 'x_min': 0.5, 'y_max': 0.5, 'population': 'cd4_t_cell'},
+        {'kind': 'rectangle', 'name': 'cd8', 'parent': 't', 'x_channel': 'CD4', 'y_channel': 'CD8', 'x_max': 0.5, 'y_min': 0.5, 'population': 'cd8_t_cell'},
+        {'kind': 'threshold', 'name': 'nk', 'parent': 'cells', 'channel': 'CD56', 'min': 0.8, 'population': 'nk_cell'},
+        {'kind': 'threshold', 'name': 'monocyte', 'parent': 'cells', 'channel': 'CD14', 'min': 0.8, 'population': 'monocyte'},
+    ]).gates
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        files = []
+        for index in range(num_samples):
+            path = os.path.join(directory, f'sample_{index}.npy')
+            events = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(num_events, len(channels)))
+            for start in range(0, num_events, CHUNK_EVENTS):
+                events[start:start + CHUNK_EVENTS] = rng.random((min(CHUNK_EVENTS, num_events - start), len(channels)), dtype=np.float32)
+            events.flush()
+            del events
+            files.append((path, channels))
+        for label, pool_workers in (('sequential', 1), (f'process pool ({workers or os.cpu_count()} workers)', workers)):
+            start = time.perf_counter()
+            gate_files(gates, files, pool_workers)
+            elapsed = time.perf_counter() - start
+            print(f'{label}: {elapsed:.2f}s for {num_samples} samples x {num_events} events ({num_samples * num_events / elapsed / 1e6:.1f}M events/s)')
+
+if __name__ == '__main__':
+    usage = 'Usage: python -m app.gating apply <strategy.json> [sample id ...] | benchmark [samples] [events]'
+    if len(sys.argv) < 2 or sys.argv[1] not in ('apply', 'benchmark'):
+        sys.exit(usage)
+    if sys.argv[1] == 'benchmark':
+        benchmark(*(int(value) for value in sys.argv[2:4]))
+    else:
+        from app.database import engine
+
+        if len(sys.argv) < 3:
+            sys.exit(usage)
+        with open(sys.argv[2]) as strategy_file:
+            form = GatingStrategyForm.model_validate_json(strategy_file.read())
+        with Session(engine) as session:
+            strategy = session.exec(select(GatingStrategy).where(GatingStrategy.name == form.name)).first() or GatingStrategy(name=form.name)
+            strategy.gates = [gate.model_dump() for gate in form.gates]
+            session.add(strategy)
+            session.commit()
+            counts = apply_gating_strategy(strategy, session, [int(value) for value in sys.argv[3:]] or None)
+        print(f'Gated {len(counts)} samples with strategy {form.name!r}.')
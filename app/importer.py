@@ -0,0 +1,239 @@
+'''
+Import of per-run CSV files, in the format of cell-count.csv, from a
+directory, once or by watching it.
+
+Files are hashed and parsed by a process pool. This process is the only
+writer: it validates the files, creates missing projects and subjects and
+inserts the samples as their parses complete (see app/ingest.py), in batches of
+files per transaction. Each loaded file is recorded in the `ImportedFile`
+manifest in the same transaction as its samples, so an interrupted import
+resumes where it stopped, and a file loaded before, even under another
+name, is skipped.
+'''
+import hashlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from itertools import islice
+from typing import Iterator, Literal
+
+import pandas as pd
+import pydantic
+from sqlmodel import Session, select
+
+from app.database import METADATA_COLUMNS, bump_data_version, engine, get_population_columns, init_db
+from app.ingest import IngestError, RowError, insert_samples, invalidate_name_maps, prepare_samples, read_upload
+from app.models import ImportedFile
+from app.qc import refresh_sample_qc
+
+# files written and committed together, up to a number of rows
+BATCH_FILES = 50
+BATCH_ROWS = 50_000
+# files modified more recently than this may still be being written
+SETTLE_SECONDS = 2.0
+
+@dataclass
+class ParsedFile:
+    path: str
+    size: int
+    mtime_ns: int
+    sha256: str
+    frame: pd.DataFrame | None = None
+    error: str | None = None
+
+class FileReport(pydantic.BaseModel):
+    path: str
+    status: Literal['imported', 'skipped', 'failed']
+    rows: int = 0
+    inserted: int = 0
+    errors: list[RowError] = []
+    message: str | None = None
+
+def scan_directory(directory: str) -> list[str]:
+    '''CSV files of `directory` that are no longer being written, in name order.'''
+    now = time.time()
+    paths = []
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.is_file() and entry.name.lower().endswith('.csv') and now - entry.stat().st_mtime >= SETTLE_SECONDS:
+            paths.append(entry.path)
+    return paths
+
+def parse_file(path: str) -> ParsedFile:
+    '''Hash and read one file; runs in the worker processes.'''
+    stat = os.stat(path)
+    with open(path, 'rb') as file:
+        content = file.read()
+    parsed = ParsedFile(path=path, size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=hashlib.sha256(content).hexdigest())
+    try:
+        frame = read_upload(io.BytesIO(content), path)
+    except IngestError as error:
+        parsed.error = str(error)
+        return parsed
+    missing = [column for column in METADATA_COLUMNS if column not in frame.columns]
+    if missing:
+        parsed.error = f'Missing columns: {", ".join(missing)}'
+    elif not get_population_columns(list(frame.columns)):
+        parsed.error = 'No population count columns found'
+    else:
+        parsed.frame = frame
+    return parsed
+
+def write_batch(batch: list[ParsedFile], session: Session) -> list[FileReport]:
+    '''
+    Insert the valid rows of several parsed files at once and record them
+    in the manifest. Validation and the rollup and statistics updates have
+    a fixed cost per call, so files are written together. Does not commit.
+    '''
+    # files can measure different populations; a population missing from a file is left empty
+    frame = pd.concat([parsed.frame for parsed in batch], ignore_index=True).fillna('')
+    clean, errors = prepare_samples(frame, session)
+    insert_samples(clean, session)
+    inserted = pd.Series(True, index=frame.index)
+    inserted[~frame.index.isin(clean.index)] = False
+
+    reports = []
+    start = 0
+    for parsed in batch:
+        end = start + len(parsed.frame)
+        num_inserted = int(inserted.iloc[start:end].sum())
+        session.add(ImportedFile(
+            sha256=parsed.sha256,
+            path=parsed.path,
+            size=parsed.size,
+            mtime_ns=parsed.mtime_ns,
+            num_rows=len(parsed.frame),
+            num_inserted=num_inserted,
+            num_rejected=len(parsed.frame) - num_inserted,
+        ))
+        reports.append(FileReport(
+            path=parsed.path,
+            status='imported',
+            rows=len(parsed.frame),
+            inserted=num_inserted,
+            # row numbers of the batch back to row numbers of the file
+            errors=[error.model_copy(update={'row': error.row - start}) for error in errors if start < error.row <= end],
+        ))
+        start = end
+    return reports
+
+def parse_files(executor: ProcessPoolExecutor, paths: list[str], window: int) -> Iterator[ParsedFile]:
+    '''
+    Parses of `paths` in order of completion. At most `window` files are
+    submitted and not yet consumed, so the parsed frames held at once are
+    bounded by the window rather than by the directory.
+    '''
+    remaining = iter(paths)
+    pending = {executor.submit(parse_file, path) for path in islice(remaining, window)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        # keep the workers busy while this process writes
+        pending |= {executor.submit(parse_file, path) for path in islice(remaining, len(done))}
+        while done:
+            yield done.pop().result()
+
+def import_directory(directory: str, workers: int | None = None) -> list[FileReport]:
+    '''Import the files of `directory` not in the manifest yet, parsing them across `workers` processes.'''
+    reports = []
+    with Session(engine) as session:
+        # unchanged files are recognized without reading them; moved or copied ones by their hash
+        known = set(session.exec(select(ImportedFile.path, ImportedFile.size, ImportedFile.mtime_ns)).all())
+        hashes = set(session.exec(select(ImportedFile.sha256)).all())
+        paths = []
+        for path in scan_directory(directory):
+            stat = os.stat(path)
+            if (path, stat.st_size, stat.st_mtime_ns) in known:
+                reports.append(FileReport(path=path, status='skipped', message='Already imported'))
+            else:
+                paths.append(path)
+        if not paths:
+            return reports
+
+        batch: list[ParsedFile] = []
+
+        def commit_batch():
+            reports.extend(write_batch(batch, session))
+            bump_data_version(session)
+            session.commit()
+            batch.clear()
+
+        executor = None
+        try:
+            if workers == 1:
+                results = (parse_file(path) for path in paths)
+            else:
+                executor = ProcessPoolExecutor(max_workers=workers)
+                results = parse_files(executor, paths, 2 * (workers or os.cpu_count() or 1))
+            # this process writes while the workers keep parsing
+            for parsed in results:
+                if parsed.error:
+                    reports.append(FileReport(path=parsed.path, status='failed', message=parsed.error))
+                elif parsed.sha256 in hashes:
+                    reports.append(FileReport(path=parsed.path, status='skipped', message='Same content as an imported file'))
+                else:
+                    hashes.add(parsed.sha256)
+                    batch.append(parsed)
+                    if len(batch) >= BATCH_FILES or sum(len(parsed.frame) for parsed in batch) >= BATCH_ROWS:
+                        commit_batch()
+            if batch:
+                commit_batch()
+            if any(report.status == 'imported' for report in reports):
+                # scores the new samples once per run rather than per batch
+                refresh_sample_qc(session)
+                session.commit()
+        except BaseException:
+            session.rollback()
+            # the cached maps may hold projects and subjects of the rolled back transaction
+            invalidate_name_maps()
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+    return reports
+
+def print_reports(reports: list[FileReport]):
+    for report in reports:
+        if report.status == 'imported':
+            print(f'{report.path}: {report.inserted} of {report.rows} rows imported')
+            for error in report.errors:
+                print(f'  row {error.row}, {error.column}: {error.message}')
+        elif report.status == 'failed':
+            print(f'{report.path}: failed, {report.message}')
+
+def watch_directory(directory: str, workers: int | None = None, interval: float = 5.0):
+    '''Import new files of `directory` every `interval` seconds until interrupted.'''
+    while True:
+        print_reports(import_directory(directory, workers))
+        time.sleep(interval)
+
+if __name__ == '__main__':
+    usage = 'Usage: python -m app.importer <directory> [--watch] [--workers N] [--interval SECONDS]'
+    arguments = sys.argv[1:]
+    if not arguments or arguments[0].startswith('--') or not os.path.isdir(arguments[0]):
+        sys.exit(usage)
+    options = {'--workers': None, '--interval': '5'}
+    for option in options:
+        if option in arguments:
+            index = arguments.index(option)
+            if index + 1 >= len(arguments):
+                sys.exit(usage)
+            options[option] = arguments[index + 1]
+    workers = int(options['--workers']) if options['--workers'] else None
+    init_db()
+    if '--watch' in arguments:
+        try:
+            watch_directory(arguments[0], workers, float(options['--interval']))
+        except KeyboardInterrupt:
+            pass
+    else:
+        start = time.perf_counter()
+        reports = import_directory(arguments[0], workers)
+        print_reports(reports)
+        imported = [report for report in reports if report.status == 'imported']
+        print(
+            f'{len(imported)} files imported ({sum(report.inserted for report in imported)} samples), '
+            f'{sum(report.status == "skipped" for report in reports)} skipped, '
+            f'{sum(report.status == "failed" for report in reports)} failed in {time.perf_counter() - start:.2f}s.'
+        )
@@ -0,0 +1,267 @@
+'''
+Bulk ingestion of samples from CSV or JSON-lines uploads.
+
+Rows are validated as whole columns with pandas, project and subject
+names are resolved through maps cached per data version, and every
+valid row is inserted in batches within a single transaction. Uploads
+in the format of cell-count.csv also describe their subjects, which are
+checked for valid values and consistency across rows before new ones are
+created. Invalid rows are skipped and reported with the row number,
+column and reason.
+'''
+from typing import BinaryIO
+
+import numpy as np
+import pandas as pd
+import pydantic
+from sqlmodel import Session, select
+
+from app.analytics import read_frame
+from app.cache import VersionedCache
+from app.database import bump_data_version, get_data_version, get_or_create_populations, get_population_columns
+from app.models import chunked, Project, ResponseEnum, Sample, SampleCount, SexEnum, Subject
+from app.qc import refresh_sample_qc
+from app.rollups import update_rollups
+from app.running_stats import update_dataset_statistics
+
+SAMPLE_COLUMNS = ['sample', 'project', 'subject', 'sample_type', 'time_from_treatment_start']
+# uploads in the format of cell-count.csv also describe the subjects, which are created when new
+SUBJECT_COLUMNS = ['condition', 'age', 'sex', 'treatment', 'response']
+# rows per INSERT statement, below SQLite's bound parameter limit
+BATCH_SIZE = 5_000
+
+class IngestError(ValueError):
+    pass
+
+class RowError(pydantic.BaseModel):
+    # 1-based data row of the upload (the CSV header is not counted)
+    row: int
+    column: str
+    message: str
+
+# rows failing a check: (mask over the upload's rows, column, message)
+Check = tuple[pd.Series, str, str]
+
+class IngestReport(pydantic.BaseModel):
+    total_rows: int
+    inserted: int
+    errors: list[RowError]
+
+_name_maps = VersionedCache()
+
+def get_name_maps(session: Session) -> tuple[dict[str, int], dict[str, int]]:
+    '''Project and subject ids by name, cached until the data version changes.'''
+    def compute():
+        projects = dict(session.exec(select(Project.name, Project.id)).all())
+        subjects = dict(session.exec(select(Subject.name, Subject.id)).all())
+        return projects, subjects
+    return _name_maps.get_or_compute('names', get_data_version(session), compute)
+
+def invalidate_name_maps():
+    '''Forget the cached maps, after inserting projects or subjects within a transaction.'''
+    _name_maps.invalidate()
+
+def read_upload(file: BinaryIO, filename: str) -> pd.DataFrame:
+    '''Rows of a CSV or JSON-lines (.jsonl/.ndjson/.json) upload, as stripped strings ('' when missing).'''
+    try:
+        if filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+            frame = pd.read_json(file, lines=True, dtype=False)
+        else:
+            frame = pd.read_csv(file, dtype=str, keep_default_na=False)
+    except ValueError as error:
+        raise IngestError(f'Could not read {filename}: {error}')
+    frame.columns = [str(column).strip() for column in frame.columns]
+    return frame.astype(object).where(frame.notna(), '').astype(str).apply(lambda column: column.str.strip())
+
+def _parse_integers(values: pd.Series) -> tuple[pd.Series, pd.Series]:
+    '''Integer values (NaN when missing) and a mask of non-empty values that are not non-negative integers.'''
+    numbers = pd.to_numeric(values.where(values != ''), errors='coerce')
+    invalid = (values != '') & (numbers.isna() | (numbers < 0) | (numbers != np.floor(numbers)))
+    return numbers.where(~invalid), invalid
+
+def check_subjects(frame: pd.DataFrame, session: Session) -> tuple[list[Check], pd.DataFrame]:
+    '''
+    Check the subject attributes of every row at once: values must be
+    valid, agree across the rows of a subject and match the subject when
+    it already exists. Returns the checks and the subjects to create, one
+    row per new subject whose rows all passed.
+    '''
+    subjects = frame['subject']
+    ages, invalid_age = _parse_integers(frame['age'])
+    checks = [
+        (frame['condition'] == '', 'condition', 'Condition is required'),
+        (frame['treatment'] == '', 'treatment', 'Treatment is required'),
+        (frame['age'] == '', 'age', 'Age is required'),
+        (invalid_age, 'age', 'Must be a non-negative integer'),
+        (~frame['sex'].isin([SexEnum.MALE.value, SexEnum.FEMALE.value]), 'sex', "Must be 'M' or 'F'"),
+        (~frame['response'].isin(['', ResponseEnum.YES.value, ResponseEnum.NO.value]), 'response', "Must be 'yes', 'no' or empty"),
+    ]
+    # every row of a subject must describe it the same way
+    named = subjects != ''
+    for column in SUBJECT_COLUMNS:
+        variants = frame[named].groupby('subject')[column].nunique()
+        conflicting = subjects.isin(variants.index[variants > 1])
+        checks.append((conflicting, column, 'Conflicts with other rows of this subject'))
+
+    existing = read_frame(
+        session,
+        select(Subject.name, Subject.condition, Subject.age, Subject.sex, Subject.treatment, Subject.response)
+        .where(Subject.name.in_(subjects[named].unique().tolist())),
+        ['subject', *SUBJECT_COLUMNS],
+        analytical=False,
+    ).set_index('subject')
+    if not existing.empty:
+        existing['age'] = existing['age'].astype(str)
+        existing['response'] = existing['response'].fillna('')
+        for column in SUBJECT_COLUMNS:
+            stored = subjects.map(existing[column])
+            checks.append((stored.notna() & (stored != frame[column]), column, 'Differs from the existing subject'))
+
+    rejected = _rejected(checks, len(frame))
+    subject_rejected = pd.Series(rejected, index=frame.index).groupby(subjects).transform('any').to_numpy()
+    new = named.to_numpy() & ~subject_rejected & ~subjects.isin(existing.index).to_numpy()
+    new_subjects = frame.loc[new, ['subject', *SUBJECT_COLUMNS]].drop_duplicates('subject').assign(age=ages[new].astype('Int64'))
+    return checks, new_subjects
+
+def create_projects_and_subjects(project_names: list[str], new_subjects: pd.DataFrame, session: Session):
+    '''Insert the projects among `project_names` that do not exist yet and `new_subjects`. Does not commit.'''
+    existing_projects = set(session.exec(select(Project.name).where(Project.name.in_(project_names))).all())
+    new_projects = [name for name in project_names if name not in existing_projects]
+    connection = session.connection()
+    if new_projects:
+        connection.execute(Project.__table__.insert(), [{'name': name, 'num_samples': 0} for name in new_projects])
+    if not new_subjects.empty:
+        connection.execute(Subject.__table__.insert(), [
+            {
+                'name': row.subject,
+                'condition': row.condition,
+                'age': int(row.age),
+                'sex': SexEnum(row.sex),
+                'treatment': row.treatment,
+                'response': ResponseEnum(row.response) if row.response else None,
+            }
+            for row in new_subjects.itertuples()
+        ])
+    if new_projects or not new_subjects.empty:
+        invalidate_name_maps()
+
+def _rejected(checks: list[Check], size: int) -> np.ndarray:
+    rejected = np.zeros(size, dtype=bool)
+    for mask, _, _ in checks:
+        rejected |= mask.to_numpy()
+    return rejected
+
+def prepare_samples(frame: pd.DataFrame, session: Session) -> tuple[pd.DataFrame, list[RowError]]:
+    '''
+    Validate an upload as `validate_samples` does. Uploads that also
+    describe subjects (the format of cell-count.csv) have their subject
+    attributes checked too, and their new projects and valid new subjects
+    are created first. Does not commit.
+    '''
+    if not all(column in frame.columns for column in SUBJECT_COLUMNS):
+        return validate_samples(frame, session)
+    missing = [column for column in SAMPLE_COLUMNS if column not in frame.columns]
+    if missing:
+        raise IngestError(f'Missing columns: {", ".join(missing)}')
+    checks, new_subjects = check_subjects(frame, session)
+    accepted = ~_rejected(checks, len(frame))
+    create_projects_and_subjects(frame.loc[accepted & (frame['project'] != ''), 'project'].unique().tolist(), new_subjects, session)
+    return validate_samples(frame, session, checks)
+
+def validate_samples(frame: pd.DataFrame, session: Session, checks: list[Check] | None = None) -> tuple[pd.DataFrame, list[RowError]]:
+    '''
+    Check every row of an upload at once. Returns the valid rows, resolved
+    to sample columns and one count column per population, with the errors
+    of the rejected rows (including those of earlier `checks`).
+    '''
+    missing = [column for column in SAMPLE_COLUMNS if column not in frame.columns]
+    if missing:
+        raise IngestError(f'Missing columns: {", ".join(missing)}')
+    population_columns = get_population_columns(list(frame.columns))
+    if not population_columns:
+        raise IngestError('No population count columns found')
+    project_ids, subject_ids = get_name_maps(session)
+
+    subject_rejected = _rejected(checks, len(frame)) if checks else np.zeros(len(frame), dtype=bool)
+    checks = list(checks or [])
+    names = frame['sample']
+    existing = set()
+    for chunk in chunked(names.unique().tolist()):
+        existing.update(session.exec(select(Sample.name).where(Sample.name.in_(chunk))).all())
+    checks += [
+        (names == '', 'sample', 'Sample name is required'),
+        (names.duplicated() & (names != ''), 'sample', 'Duplicate sample name in upload'),
+        (names.isin(existing), 'sample', 'A sample with this name already exists'),
+    ]
+    resolved = pd.DataFrame({
+        'name': names,
+        'project_id': frame['project'].map(project_ids),
+        'subject_id': frame['subject'].map(subject_ids),
+        'type': frame['sample_type'],
+    })
+    checks += [
+        (resolved['project_id'].isna(), 'project', 'Unknown project'),
+        # rows whose subject attributes were rejected already explain why it is unknown
+        (resolved['subject_id'].isna() & ~subject_rejected, 'subject', 'Unknown subject'),
+        (resolved['type'] == '', 'sample_type', 'Sample type is required'),
+    ]
+    resolved['time_from_treatment_start'], invalid = _parse_integers(frame['time_from_treatment_start'])
+    checks += [
+        (invalid, 'time_from_treatment_start', 'Must be a non-negative integer'),
+        (frame['time_from_treatment_start'] == '', 'time_from_treatment_start', 'Time from treatment start is required'),
+    ]
+    for column in population_columns:
+        resolved[column], invalid = _parse_integers(frame[column])
+        checks.append((invalid, column, 'Count must be a non-negative integer'))
+
+    errors = [
+        RowError(row=row + 1, column=column, message=message)
+        for mask, column, message in checks
+        for row in np.flatnonzero(mask.to_numpy())
+    ]
+    errors.sort(key=lambda error: error.row)
+    return resolved[~_rejected(checks, len(frame))], errors
+
+def insert_samples(clean: pd.DataFrame, session: Session) -> list[int]:
+    '''
+    Insert validated rows (see `validate_samples`) with their counts in
+    batches, keeping rollups and dataset statistics in sync. Does not
+    commit.
+    '''
+    if clean.empty:
+        return []
+    population_columns = [column for column in clean.columns if column not in ('name', 'project_id', 'subject_id', 'type', 'time_from_treatment_start')]
+    populations = get_or_create_populations(session, population_columns)
+    rows = clean[['name', 'project_id', 'subject_id', 'type', 'time_from_treatment_start']].astype(
+        {'project_id': int, 'subject_id': int, 'time_from_treatment_start': int}
+    ).to_dict('records')
+    # Core executemany rather than the ORM's bulk insert, which is several times slower;
+    # names are unique, so the new ids are read back by name
+    connection = session.connection()
+    for batch in chunked(rows, BATCH_SIZE):
+        connection.execute(Sample.__table__.insert(), batch)
+    new_ids = {}
+    for chunk in chunked(clean['name'].tolist()):
+        new_ids.update(connection.execute(select(Sample.name, Sample.id).where(Sample.name.in_(chunk))).fetchall())
+    sample_ids = clean['name'].map(new_ids).tolist()
+    counts = clean[population_columns].set_axis(sample_ids).rename(columns={name: populations[name].id for name in population_columns})
+    counts = counts.stack().dropna().astype(int).rename_axis(['sample_id', 'population_id']).rename('count').reset_index()
+    for batch in chunked(counts.to_dict('records'), BATCH_SIZE):
+        connection.execute(SampleCount.__table__.insert(), batch)
+    update_rollups(session, sample_ids)
+    update_dataset_statistics(session, sample_ids)
+    return sample_ids
+
+def ingest_samples(file: BinaryIO, filename: str, session: Session) -> IngestReport:
+    '''Validate an upload and insert its valid rows in one transaction, then score them for QC (see app/qc.py).'''
+    frame = read_upload(file, filename)
+    clean, errors = prepare_samples(frame, session)
+    sample_ids = insert_samples(clean, session)
+    if sample_ids:
+        bump_data_version(session)
+    session.commit()
+    if sample_ids:
+        # after the commit, as QC reads the committed data on the analytics backend
+        refresh_sample_qc(session)
+        session.commit()
+    return IngestReport(total_rows=len(frame), inserted=len(sample_ids), errors=errors)
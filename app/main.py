@@ -1,21 +1,22 @@
 from fastapi import APIRouter
-from fastui import AnyComponent, FastUI
+from fastapi.responses import Response
+from fastui import FastUI
 from fastui import components as c
 
-from .shared import base_page
+from .shared import base_page, cached_page
 
 router = APIRouter()
 
 @router.get("/", response_model=FastUI, response_model_exclude_none=True)
-def api_index() -> list[AnyComponent]:
-    return base_page(
+def api_index() -> Response:
+    return cached_page('index', lambda: base_page(
         c.Heading(text='Cytometry Manager', level=2),
         c.Paragraph(text='Welcome to the Cytometry Manager! Choose a page in the navigation bar to get started.'),
-    )
+    ))
 
 @router.get("/help/", response_model=FastUI, response_model_exclude_none=True)
-def help_page() -> list[AnyComponent]:
-    return base_page(
+def help_page() -> Response:
+    return cached_page('help', lambda: base_page(
         c.Markdown(
             text="""\
 # Help
@@ -32,6 +33,11 @@ Links are provided in table entries to make it easy to examine related data.
 #### Add/remove samples
 
 To manually enter a new sample, visit the Samples page and click "New Sample".
+Enter the cell counts one population per line, by name or by the label shown in tables, e.g. `b_cell: 10908` or `B Cell: 10908`.
+Populations are not fixed: every CSV column other than the sample, subject and project metadata is imported as a population, and new population names are registered by CSV and bulk uploads (the form only accepts existing populations).
+To add many samples at once, click "Bulk upload" and choose a CSV or JSON-lines file with the columns `sample`, `project`, `subject`, `sample_type` and `time_from_treatment_start`, plus one column per population.
+Rows with errors (e.g. an unknown subject or a negative count) are skipped and listed with their row number, and the other rows are added.
+To delete or update many samples at once, filter the Samples page (or open the samples of a dataset) and click "Bulk edit"; the action applies to the listed sample IDs, or to every sample matching the filters.
 To remove a sample, click the link in the table entry to see the sample details.
 A delete button is available at the bottom.
 
@@ -46,6 +52,9 @@ Essentially, a cohort defines a group of subjects and a dataset defines a group
 This is achieved by storing the intended characteristics of the subjects or samples belonging to a cohort or a dataset, respectively.
 Thus, the subjects or samples belonging to the cohort may actually change if new samples or subjects are added, depending on the characteristics of said subjects or samples.
 
+Cohorts can also be combined into composite cohorts.
+On the Cohorts page, click "New Composite Cohort" and choose two cohorts and a set operation: union, intersection or difference (subjects in the first cohort but not in the other).
+
 ## Analyzing differences in response across cell types
 
 Treatment groups may vary in cell type frequency that correlates with a response to the treatment.
@@ -68,7 +77,9 @@ Either way, to continue with analysis, we need to create a dataset.
 
 A new dataset can be created from the samples section of a given cohort page.
 Click the "New Cohort" button and enter choose any applicable filters.
-For example, Sample Type of PBMC, your cohort name, and time from treatment start of 0.
+For example, Sample Type of PBMC, your cohort name, and a minimum and maximum time from treatment start of 0.
+"Exclude QC-flagged samples" leaves out the outliers found by the QC scoring of samples. Samples loaded from a file are scored as they are loaded; samples entered or edited one at a time are scored by the next QC refresh (`POST /api/samples/qc/refresh`, also run by `POST /api/datasets/refresh`).
+Sample types and projects accept several values, and leaving the maximum time empty includes every later timepoint, so a single dataset can cover a longitudinal analysis.
 
 #### Visualize cell type frequencies and response
 Creating a cohort and a dataset has effectively gathered the set of samples that are appropriate for our analysis.
@@ -79,4 +90,4 @@ Click on "Visualizations" to generate a plot of cell type frequencies given the
 We can also view the samples in our dataset to make sure meet our expectations.
 """
         )
-    )
\ No newline at end of file
+    ))
@@ -1,9 +1,18 @@
-from typing import Literal, Sequence
+from datetime import datetime, timezone
+from typing import Annotated, Literal, Sequence
+from fastapi import UploadFile
+from fastui.forms import FormFile
 from sqlmodel import SQLModel, Relationship
+import numpy as np
+import pandas as pd
 import pydantic
+import sqlalchemy as sa
 import sqlmodel
+import zlib
 from enum import Enum
 
+from app.analytics import read_frame
+
 class SexEnum(str, Enum):
     MALE = 'M'
     FEMALE = 'F'
@@ -19,6 +28,22 @@ class TreatmentEnum(str, Enum):
     PHAUXIMAB = 'phauximab'
     ANY = 'Any'
 
+class CohortOperatorEnum(str, Enum):
+    UNION = 'union'
+    INTERSECTION = 'intersection'
+    DIFFERENCE = 'difference'
+
+class DataVersion(SQLModel, table=True):
+    '''
+    Single-row counter incremented by every write to samples or subjects.
+    Derived results (breakdowns, statistics, images) are keyed by it.
+    Versions restart when the database is recreated, so files derived from
+    it are also keyed by `database_id`, a random token set by `init_db`.
+    '''
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    version: int = 0
+    database_id: str | None = None
+
 class Project(SQLModel, table=True):
     id: int | None = sqlmodel.Field(default=None, primary_key=True)
     name: str
@@ -36,44 +61,187 @@ class Subject(SQLModel, table=True):
     response: ResponseEnum | None = None
     samples: list["Sample"] = Relationship(back_populates="subject")
 
+class Population(SQLModel, table=True):
+    '''
+    A cell population of the marker panel, e.g. `cd8_t_cell`. Populations
+    are registered when first seen in an import, so new panels need no
+    schema or code changes.
+    '''
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    name: str = sqlmodel.Field(index=True, unique=True)
+    label: str
+    counts: list["SampleCount"] = Relationship(back_populates="population")
+
+    @staticmethod
+    def label_for(name: str) -> str:
+        '''Display label for a population name, e.g. `cd8_t_cell` -> `CD8 T Cell`.'''
+        return ' '.join(
+            token.upper() if len(token) <= 2 or any(ch.isdigit() for ch in token) else token.capitalize()
+            for token in name.split('_')
+        )
+
 class Sample(SQLModel, table=True):
+    # composite index covering the predicates compiled by `Dataset.get_conditions`;
+    # ids are never reused, as snapshots and QC results refer to samples by id
+    __table_args__ = (
+        sa.Index('ix_sample_subject_type_time', 'subject_id', 'type', 'time_from_treatment_start'),
+        {'sqlite_autoincrement': True},
+    )
     id: int | None = sqlmodel.Field(default=None, primary_key=True)
     name: str
     subject_id: int | None = sqlmodel.Field(foreign_key="subject.id")
     project_id: int | None = sqlmodel.Field(foreign_key="project.id")
     type: str
     time_from_treatment_start: int
-    b_cell: int
-    cd8_t_cell: int
-    cd4_t_cell: int
-    nk_cell: int
-    monocyte: int
     subject: Subject | None = Relationship(back_populates="samples")
     project: Project | None = Relationship(back_populates="samples")
+    counts: list["SampleCount"] = Relationship(back_populates="sample", cascade_delete=True)
+    event_file: "EventFile" = Relationship(back_populates="sample", cascade_delete=True, sa_relationship_kwargs={'uselist': False})
+
+    def get_population_counts(self) -> dict[str, int]:
+        return {count.population.label: count.count for count in self.counts}
 
     def get_population_frequencies(self) -> dict[str, float]:
         """Calculate the relative frequencies of immune cell populations in this sample."""
-        total_cells = self.b_cell + self.cd8_t_cell + self.cd4_t_cell + self.nk_cell + self.monocyte
-        if total_cells == 0:
-            return {
-                "B Cell": 0.0,
-                "CD8 T Cell": 0.0,
-                "CD4 T Cell": 0.0,
-                "NK Cell": 0.0,
-                "Monocyte": 0.0
-            }
-        return {
-            "B Cell": (self.b_cell / total_cells) * 100,
-            "CD8 T Cell": (self.cd8_t_cell / total_cells) * 100,
-            "CD4 T Cell": (self.cd4_t_cell / total_cells) * 100,
-            "NK Cell": (self.nk_cell / total_cells) * 100,
-            "Monocyte": (self.monocyte / total_cells) * 100
-        }
+        counts = self.get_population_counts()
+        values = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        total_cells = values.sum()
+        frequencies = values / total_cells * 100 if total_cells else np.zeros_like(values)
+        return dict(zip(counts, frequencies.tolist()))
+
+class SampleCount(SQLModel, table=True):
+    '''Cell count of one population in one sample (long format).'''
+    sample_id: int | None = sqlmodel.Field(default=None, foreign_key="sample.id", primary_key=True, ondelete="CASCADE")
+    population_id: int | None = sqlmodel.Field(default=None, foreign_key="population.id", primary_key=True)
+    count: int
+    sample: Sample | None = Relationship(back_populates="counts")
+    population: Population | None = Relationship(back_populates="counts")
+
+class EventFile(SQLModel, table=True):
+    '''Event-level data of a sample, parsed from an FCS file into a memory-mapped array (see app/fcs.py).'''
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    sample_id: int | None = sqlmodel.Field(default=None, foreign_key="sample.id", unique=True, ondelete="CASCADE")
+    path: str = ''
+    filename: str = ''
+    fcs_version: str = ''
+    num_events: int = 0
+    # one {'name', 'stain', 'bits', 'range'} entry per column of the event array
+    channels: list[dict] = sqlmodel.Field(default_factory=list, sa_column=sa.Column(sa.JSON))
+    sample: Sample | None = Relationship(back_populates="event_file")
+
+class ImportedFile(SQLModel, table=True):
+    '''Manifest of the files loaded by the directory importer (see app/importer.py), by content hash.'''
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    sha256: str = sqlmodel.Field(unique=True)
+    path: str
+    size: int
+    mtime_ns: int
+    imported_at: datetime = sqlmodel.Field(default_factory=lambda: datetime.now(timezone.utc))
+    num_rows: int = 0
+    num_inserted: int = 0
+    num_rejected: int = 0
+
+class GatingStrategy(SQLModel, table=True):
+    '''Hierarchy of gates deriving population counts from event data (see app/gating.py).'''
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    name: str = sqlmodel.Field(unique=True)
+    # gate definitions in evaluation order, parents first
+    gates: list[dict] = sqlmodel.Field(default_factory=list, sa_column=sa.Column(sa.JSON))
+
+def chunked(values: Sequence, size: int = 10_000):
+    '''Split `values` into slices that stay below SQLite's bound parameter limit in IN lists.'''
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def get_frequency_matrix(session: sqlmodel.Session, conditions: list, analytical: bool = False) -> pd.DataFrame:
+    '''
+    Relative frequency (%) of every population for the samples matching
+    `conditions` (predicates on `Sample`), as a sample id x population label
+    frame. Counts are read in one query and normalized with vectorized
+    operations, whatever the number of populations. Populations a sample
+    has no count for are NaN. With `analytical`, the query runs on the
+    configured analytics backend (see app/analytics.py).
+    '''
+    query = (
+        sqlmodel.select(SampleCount.sample_id, Population.label, SampleCount.count)
+        .join(Population, SampleCount.population_id == Population.id)
+        .join(Sample, SampleCount.sample_id == Sample.id)
+        .where(*conditions)
+        .order_by(SampleCount.sample_id, Population.id)
+    )
+    counts = read_frame(session, query, ['sample_id', 'population', 'count'], analytical)
+    labels = read_frame(session, sqlmodel.select(Population.label).order_by(Population.id), ['label'], analytical)['label']
+    matrix = counts.pivot(index='sample_id', columns='population', values='count').astype(np.float64)
+    # populations not measured in a sample stay NaN rather than counting as 0%
+    matrix = matrix.reindex(columns=[label for label in labels if label in matrix.columns])
+    matrix.columns.name = None
+    totals = matrix.sum(axis=1)
+    frequencies = matrix.div(totals.replace(0, np.nan), axis=0) * 100
+    # samples without any cells get 0% for every measured population
+    return frequencies.mask(frequencies.isna() & matrix.notna(), 0.0)
+
+def get_sample_responses(session: sqlmodel.Session, conditions: list, analytical: bool = False) -> pd.Series:
+    '''Subject response ('yes', 'no' or None) of the samples matching `conditions`, indexed by sample id.'''
+    query = (
+        sqlmodel.select(Sample.id, Subject.response)
+        .join(Subject, Sample.subject_id == Subject.id)
+        .where(*conditions)
+    )
+    return read_frame(session, query, ['sample_id', 'response'], analytical).set_index('sample_id')['response']
+
+class PopulationRollup(SQLModel, table=True):
+    '''
+    Running count, sum and sum of squares of a population's frequency (%)
+    over all samples sharing the same key. Maintained incrementally on
+    every sample write (see app/rollups.py) so that summaries read a
+    handful of groups instead of scanning the sample table.
+    '''
+    project_id: int = sqlmodel.Field(foreign_key="project.id", primary_key=True)
+    condition: str = sqlmodel.Field(primary_key=True)
+    sex: str = sqlmodel.Field(primary_key=True)
+    treatment: str = sqlmodel.Field(primary_key=True)
+    response: str = sqlmodel.Field(primary_key=True)
+    sample_type: str = sqlmodel.Field(primary_key=True)
+    time_from_treatment_start: int = sqlmodel.Field(primary_key=True)
+    population: str = sqlmodel.Field(primary_key=True)
+    count: int = 0
+    sum: float = 0.0
+    sum_of_squares: float = 0.0
+
+class SampleQC(SQLModel, table=True):
+    '''
+    Outlier scores of a sample within the samples of its project and
+    sample type (see app/qc.py). Samples without a row are scored by the
+    next QC refresh.
+    '''
+    sample_id: int = sqlmodel.Field(foreign_key="sample.id", primary_key=True, ondelete="CASCADE")
+    # the group the sample was scored in, to notice samples moved to another one
+    project_id: int = sqlmodel.Field(index=True)
+    sample_type: str
+    total_count: int
+    # modified z-scores, None when the group is too small or has no spread
+    total_z: float | None = None
+    # z-score of the population whose frequency is the most extreme
+    max_z: float | None = None
+    population: str | None = None
+    flagged: bool = sqlmodel.Field(default=False, index=True)
+
+class QCBaseline(SQLModel, table=True):
+    '''Median and MAD of a QC metric over the samples of a project and sample type.'''
+    project_id: int = sqlmodel.Field(primary_key=True)
+    sample_type: str = sqlmodel.Field(primary_key=True)
+    # log total count (`app.qc.TOTAL_METRIC`) or a population label
+    metric: str = sqlmodel.Field(primary_key=True)
+    median: float
+    mad: float
+    num_samples: int
 
 class Cohort(SQLModel, table=True):
     '''
     A collection of qualifiers for dynamically defining a set of subjects.
     In other words, a set of criteria for selecting subjects in the database.
+    A composite cohort instead combines two existing cohorts with a set
+    operation (union, intersection or difference).
     '''
     id: int | None = sqlmodel.Field(default=None, primary_key=True)
     name: str
@@ -81,18 +249,90 @@ class Cohort(SQLModel, table=True):
     sex: SexEnum | None = sqlmodel.Field(default=SexEnum.ANY)
     treatment: TreatmentEnum | None = sqlmodel.Field(default=TreatmentEnum.ANY)
     # response: ResponseEnum | None = sqlmodel.Field(default=ResponseEnum.ANY)
+    operator: CohortOperatorEnum | None = None
+    left_cohort_id: int | None = sqlmodel.Field(default=None, foreign_key="cohort.id")
+    right_cohort_id: int | None = sqlmodel.Field(default=None, foreign_key="cohort.id")
     datasets: list["Dataset"] = Relationship(back_populates="cohort")
 
-    def get_subjects(self, session: sqlmodel.Session) -> Sequence[Subject]:
-        query = sqlmodel.select(Subject)
+    def is_composite(self) -> bool:
+        return self.operator is not None
+
+    def get_conditions(self) -> list:
+        '''SQL predicates on `Subject` for a (non-composite) cohort.'''
+        conditions = []
         if self.condition and self.condition != 'Any':
-            query = query.where(Subject.condition == self.condition)
+            conditions.append(Subject.condition == self.condition)
         if self.sex and self.sex != SexEnum.ANY:
-            query = query.where(Subject.sex == self.sex)
+            conditions.append(Subject.sex == self.sex)
         if self.treatment and self.treatment != TreatmentEnum.ANY:
-            query = query.where(Subject.treatment == self.treatment)
+            conditions.append(Subject.treatment == self.treatment)
         #if self.response and self.response != ResponseEnum.ANY:
-        #    query = query.where(Subject.response == self.response)
+        #    conditions.append(Subject.response == self.response)
+        return conditions
+
+    def get_subject_mask(self, session: sqlmodel.Session, size: int | None = None) -> np.ndarray:
+        '''
+        Boolean mask indexed by subject id, True for members of this cohort.
+        Each non-composite operand costs one id-only query; composite cohorts
+        are then evaluated with vectorized set operations on the masks.
+        '''
+        if size is None:
+            max_id = session.exec(sqlmodel.select(sqlmodel.func.max(Subject.id))).one()
+            size = (max_id or 0) + 1
+        if not self.is_composite():
+            subject_ids = session.exec(sqlmodel.select(Subject.id).where(*self.get_conditions())).all()
+            mask = np.zeros(size, dtype=bool)
+            mask[np.fromiter(subject_ids, dtype=np.int64, count=len(subject_ids))] = True
+            return mask
+        left = session.get(Cohort, self.left_cohort_id)
+        right = session.get(Cohort, self.right_cohort_id)
+        if not left or not right:
+            raise ValueError(f'Composite cohort {self.name!r} refers to a missing cohort')
+        left_mask = left.get_subject_mask(session, size)
+        right_mask = right.get_subject_mask(session, size)
+        match self.operator:
+            case CohortOperatorEnum.UNION:
+                return left_mask | right_mask
+            case CohortOperatorEnum.INTERSECTION:
+                return left_mask & right_mask
+            case CohortOperatorEnum.DIFFERENCE:
+                return left_mask & ~right_mask
+            case _:
+                raise ValueError(f'Invalid operator {self.operator!r}')
+
+    def get_subject_ids(self, session: sqlmodel.Session) -> list[int]:
+        return np.flatnonzero(self.get_subject_mask(session)).tolist()
+
+    def get_subject_query(self, session: sqlmodel.Session):
+        '''
+        SELECT of the ids of the members of this cohort, for use in IN
+        predicates. Composite cohorts nest their operands' queries rather
+        than binding one parameter per subject, which SQLite bounds.
+        '''
+        if not self.is_composite():
+            return sqlmodel.select(Subject.id).where(*self.get_conditions())
+        left = session.get(Cohort, self.left_cohort_id)
+        right = session.get(Cohort, self.right_cohort_id)
+        if not left or not right:
+            raise ValueError(f'Composite cohort {self.name!r} refers to a missing cohort')
+        in_left = Subject.id.in_(left.get_subject_query(session))
+        in_right = Subject.id.in_(right.get_subject_query(session))
+        match self.operator:
+            case CohortOperatorEnum.UNION:
+                return sqlmodel.select(Subject.id).where(sa.or_(in_left, in_right))
+            case CohortOperatorEnum.INTERSECTION:
+                return sqlmodel.select(Subject.id).where(in_left, in_right)
+            case CohortOperatorEnum.DIFFERENCE:
+                return sqlmodel.select(Subject.id).where(in_left, sa.not_(in_right))
+            case _:
+                raise ValueError(f'Invalid operator {self.operator!r}')
+
+    def get_subjects(self, session: sqlmodel.Session) -> Sequence[Subject]:
+        query = sqlmodel.select(Subject)
+        if self.is_composite():
+            query = query.where(Subject.id.in_(self.get_subject_query(session)))
+        else:
+            query = query.where(*self.get_conditions())
         return session.exec(query).all()
 
 class Dataset(SQLModel, table=True):
@@ -105,28 +345,151 @@ class Dataset(SQLModel, table=True):
     name: str
     cohort_id: int = sqlmodel.Field(foreign_key="cohort.id")
     cohort: Cohort | None = Relationship(back_populates="datasets")
-    sample_type: str
-    time_from_treatment_start: int
+    # empty/None filters mean 'Any'
+    sample_types: list[str] | None = sqlmodel.Field(default=None, sa_column=sa.Column(sa.JSON))
+    project_ids: list[int] | None = sqlmodel.Field(default=None, sa_column=sa.Column(sa.JSON))
+    min_time_from_treatment_start: int | None = None
+    max_time_from_treatment_start: int | None = None
+    # leave out the samples flagged by QC (see app/qc.py)
+    exclude_flagged: bool = False
 
-    def get_samples(self, session: sqlmodel.Session) -> Sequence[Sample]:
-        query = sqlmodel.select(Sample)
+    def get_conditions(self, session: sqlmodel.Session) -> list:
+        '''
+        SQL predicates on `Sample` selecting the samples of this dataset.
+        Only IN lists and range comparisons are used so that SQLite can
+        use the (subject_id, type, time_from_treatment_start) index.
+        '''
+        conditions = []
         cohort = session.get(Cohort, self.cohort_id)
         if cohort:
-            dataset_subjects = cohort.get_subjects(session)
-            subject_ids = [subject.id for subject in dataset_subjects]
-            query = query.where(Sample.subject_id.in_(subject_ids))
-        if self.sample_type:
-            query = query.where(Sample.type == self.sample_type)
-        if self.time_from_treatment_start:
-            query = query.where(Sample.time_from_treatment_start == self.time_from_treatment_start)
+            conditions.append(Sample.subject_id.in_(cohort.get_subject_query(session)))
+        if self.sample_types:
+            conditions.append(Sample.type.in_(self.sample_types))
+        if self.project_ids:
+            conditions.append(Sample.project_id.in_(self.project_ids))
+        # compare against None so that a bound of 0 (baseline) is not ignored
+        if self.min_time_from_treatment_start is not None:
+            conditions.append(Sample.time_from_treatment_start >= self.min_time_from_treatment_start)
+        if self.max_time_from_treatment_start is not None:
+            conditions.append(Sample.time_from_treatment_start <= self.max_time_from_treatment_start)
+        if self.exclude_flagged:
+            conditions.append(Sample.id.not_in(sqlmodel.select(SampleQC.sample_id).where(SampleQC.flagged)))
+        return conditions
+
+    def get_samples(self, session: sqlmodel.Session) -> Sequence[Sample]:
+        query = sqlmodel.select(Sample).where(*self.get_conditions(session))
         return session.exec(query).all()
 
+    def get_sample_mask(self, snapshot, session: sqlmodel.Session, subject_masks: dict[int, np.ndarray] | None = None) -> np.ndarray:
+        '''
+        Boolean mask over the rows of a `ColumnarSnapshot` (app/columnar.py),
+        equivalent to `get_conditions` but evaluated on the column arrays.
+        `subject_masks` memoizes cohort subject masks by cohort id, so that
+        masking many datasets of the same cohorts queries each cohort once.
+        '''
+        mask = np.ones(len(snapshot), dtype=bool)
+        cohort = session.get(Cohort, self.cohort_id)
+        if cohort:
+            if subject_masks is None:
+                subject_mask = cohort.get_subject_mask(session)
+            else:
+                if cohort.id not in subject_masks:
+                    subject_masks[cohort.id] = cohort.get_subject_mask(session)
+                subject_mask = subject_masks[cohort.id]
+            subject_ids = np.asarray(snapshot.subject_id)
+            in_range = (subject_ids >= 0) & (subject_ids < len(subject_mask))
+            mask &= in_range & subject_mask[np.where(in_range, subject_ids, 0)]
+        if self.sample_types:
+            type_codes = [code for code, sample_type in enumerate(snapshot.sample_types) if sample_type in self.sample_types]
+            mask &= np.isin(snapshot.type_code, type_codes)
+        if self.project_ids:
+            mask &= np.isin(snapshot.project_id, self.project_ids)
+        if self.min_time_from_treatment_start is not None:
+            mask &= snapshot.time_from_treatment_start >= self.min_time_from_treatment_start
+        if self.max_time_from_treatment_start is not None:
+            mask &= snapshot.time_from_treatment_start <= self.max_time_from_treatment_start
+        if self.exclude_flagged:
+            flagged = session.exec(sqlmodel.select(SampleQC.sample_id).where(SampleQC.flagged)).all()
+            mask &= ~np.isin(snapshot.sample_id, np.fromiter(flagged, dtype=np.int64, count=len(flagged)))
+        return mask
+
+    def describe_sample_types(self) -> str:
+        return ', '.join(self.sample_types) if self.sample_types else 'Any'
+
+    def describe_time_range(self) -> str:
+        low, high = self.min_time_from_treatment_start, self.max_time_from_treatment_start
+        if low is None and high is None:
+            return 'Any'
+        if low == high:
+            return str(low)
+        return f"{'' if low is None else low}–{'' if high is None else high}"
+
+
+class DatasetVersion(SQLModel, table=True):
+    '''
+    Per-dataset counter incremented by every write to samples the dataset
+    selects (see app/running_stats.py). Results derived from a single
+    dataset are keyed by it, so they survive writes to other samples. The
+    dataset's analyses are stale until `refreshed_version` catches up (see
+    app/refresh.py).
+    '''
+    dataset_id: int = sqlmodel.Field(foreign_key="dataset.id", primary_key=True)
+    version: int = 1
+    refreshed_version: int = 0
+
+class DatasetSnapshot(SQLModel, table=True):
+    '''
+    Frozen membership of a dataset: the ids of the samples it selected at
+    `data_version`, so that an analysis can be reproduced after samples
+    are added or removed. The sorted ids are stored delta-encoded and
+    zlib-compressed, a few bytes per sample.
+    '''
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    dataset_id: int = sqlmodel.Field(foreign_key="dataset.id", index=True)
+    name: str
+    created_at: datetime = sqlmodel.Field(default_factory=lambda: datetime.now(timezone.utc))
+    data_version: int
+    num_samples: int
+    encoded_sample_ids: bytes = sqlmodel.Field(sa_column=sa.Column(sa.LargeBinary, nullable=False))
+
+    @staticmethod
+    def encode_sample_ids(sample_ids: np.ndarray) -> bytes:
+        # gaps between sorted ids are mostly 1, so the deltas compress to almost nothing
+        return zlib.compress(np.diff(np.unique(sample_ids).astype('<i8'), prepend=0).tobytes())
+
+    def get_sample_ids(self) -> np.ndarray:
+        return np.cumsum(np.frombuffer(zlib.decompress(self.encoded_sample_ids), dtype='<i8'))
+
+    def get_sample_mask(self, snapshot) -> np.ndarray:
+        '''Boolean mask over the rows of a `ColumnarSnapshot`, whose rows are sorted by sample id.'''
+        sample_ids = self.get_sample_ids()
+        rows = np.searchsorted(snapshot.sample_id, sample_ids)
+        found = rows < len(snapshot)
+        found[found] = snapshot.sample_id[rows[found]] == sample_ids[found]
+        mask = np.zeros(len(snapshot), dtype=bool)
+        mask[rows[found]] = True
+        return mask
+
+class DatasetStatistic(SQLModel, table=True):
+    '''
+    Running mean and sum of squared deviations (Welford) of a population's
+    frequency (%) over the samples of a dataset, per response group.
+    Maintained on every sample write (see app/running_stats.py).
+    '''
+    dataset_id: int = sqlmodel.Field(foreign_key="dataset.id", primary_key=True)
+    response: str = sqlmodel.Field(primary_key=True)
+    population: str = sqlmodel.Field(primary_key=True)
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+
 
 # NOTE: use Literal here instead of enums from models.py to allow for JSON schema 'placeholder' to take effect
 ResponseType = Literal['yes', 'no']
 TreatmentType = Literal['miraclib', 'phauximab'] # TODO: should be dynamic later
 SexType = Literal['M', 'F']
 SampleType = Literal['PBMC', 'WB'] # TODO: should be dynamic later
+CohortOperatorType = Literal['union', 'intersection', 'difference']
 
 class SubjectFilterForm(pydantic.BaseModel):
     sex: SexType | None = pydantic.Field(json_schema_extra={'placeholder': 'Filter by Sex...'})
@@ -145,11 +508,68 @@ class SampleForm(SQLModel, table=False):
     name: str
     type: str
     time_from_treatment_start: int
-    b_cell: int
-    cd8_t_cell: int
-    cd4_t_cell: int
-    nk_cell: int
-    monocyte: int
+    counts: str = pydantic.Field(
+        title="Cell counts",
+        description="One 'population: count' per line, e.g. 'b_cell: 10908' or 'B Cell: 10908'. New populations are registered by importing a CSV file.",
+        json_schema_extra={"format": "textarea"},
+    )
+
+    @pydantic.field_validator('counts')
+    @classmethod
+    def validate_counts(cls, value: str) -> str:
+        cls.parse_counts(value)
+        return value
+
+    @staticmethod
+    def parse_counts(value: str) -> dict[str, int]:
+        counts = {}
+        for entry in value.replace(',', '\n').splitlines():
+            if not entry.strip():
+                continue
+            name, separator, count = entry.replace('=', ':').partition(':')
+            if not separator or not count.strip().isdigit():
+                raise ValueError(f'Expected "population: count" with a non-negative count, got {entry.strip()!r}')
+            counts[name.strip()] = int(count)
+        if not counts:
+            raise ValueError('At least one population count is required')
+        return counts
+
+    def get_counts(self) -> dict[str, int]:
+        return self.parse_counts(self.counts)
+
+class EventFileForm(pydantic.BaseModel):
+    file: Annotated[UploadFile, FormFile(accept='.fcs')] = pydantic.Field(title="FCS File")
+
+class BulkSampleForm(pydantic.BaseModel):
+    file: Annotated[UploadFile, FormFile(accept='.csv,.jsonl,.ndjson,.json')] = pydantic.Field(title="CSV or JSON-lines File")
+
+class BulkSampleActionForm(pydantic.BaseModel):
+    action: Literal['delete', 'update']
+    sample_ids: str | None = pydantic.Field(default=None, title="Sample IDs", json_schema_extra={"format": "textarea", "placeholder": "All samples matching the current filters"})
+    type: SampleType | None = pydantic.Field(default=None, title="Set Sample Type", json_schema_extra={"placeholder": "Unchanged"})
+    time_from_treatment_start: int | None = pydantic.Field(default=None, title="Set Time From Treatment Start", json_schema_extra={"placeholder": "Unchanged"})
+    project_id: str | None = pydantic.Field(default=None, title="Set Project", json_schema_extra={"search_url": "/api/search/projects", "placeholder": "Unchanged"})
+    subject_id: str | None = pydantic.Field(default=None, title="Set Subject", json_schema_extra={"search_url": "/api/search/subjects", "placeholder": "Unchanged"})
+
+    def get_sample_ids(self) -> list[int]:
+        return [int(value) for value in (self.sample_ids or '').replace(',', ' ').split()]
+
+    def get_values(self) -> dict:
+        '''Columns to set on the samples, skipping the fields left unchanged.'''
+        values = {
+            'type': self.type,
+            'time_from_treatment_start': self.time_from_treatment_start,
+            'project_id': int(self.project_id) if self.project_id else None,
+            'subject_id': int(self.subject_id) if self.subject_id else None,
+        }
+        return {column: value for column, value in values.items() if value is not None}
+
+    @pydantic.field_validator('sample_ids')
+    @classmethod
+    def validate_sample_ids(cls, value: str | None) -> str | None:
+        if value and not all(token.isdigit() for token in value.replace(',', ' ').split()):
+            raise ValueError('Enter sample IDs separated by commas, spaces or new lines')
+        return value
 
 class SubjectForm(pydantic.BaseModel):
     name: str
@@ -166,8 +586,27 @@ class CohortForm(pydantic.BaseModel):
     treatment: TreatmentType | None = pydantic.Field(default=None, json_schema_extra={"placeholder": "Any"})
     # response: str | None = pydantic.Field(default=None, json_schema_extra={"placeholder": "Any"})
 
+class CompositeCohortForm(pydantic.BaseModel):
+    name: str
+    # strings in the JSON schema, which FastUI only renders as search selects; submitted values are validated as ids
+    left_cohort_id: int = pydantic.Field(title="Cohort", json_schema_extra={"search_url": "/api/search/cohorts", "type": "string"})
+    operator: CohortOperatorType
+    right_cohort_id: int = pydantic.Field(title="Other Cohort", json_schema_extra={"search_url": "/api/search/cohorts", "type": "string"})
+
+class DatasetSnapshotForm(pydantic.BaseModel):
+    name: str = pydantic.Field(title="Snapshot Name")
+
 class DatasetForm(pydantic.BaseModel):
     name: str
     cohort_id: str = pydantic.Field(title="Cohort", json_schema_extra={"search_url": "/api/search/cohorts"})
-    sample_type: SampleType
-    time_from_treatment_start: int
\ No newline at end of file
+    sample_types: list[SampleType] | None = pydantic.Field(default=None, title="Sample Types", json_schema_extra={"placeholder": "Any"})
+    project_ids: list[str] | None = pydantic.Field(default=None, title="Projects", json_schema_extra={"search_url": "/api/search/projects", "placeholder": "Any"})
+    min_time_from_treatment_start: int | None = pydantic.Field(default=None, json_schema_extra={"placeholder": "Any"})
+    max_time_from_treatment_start: int | None = pydantic.Field(default=None, json_schema_extra={"placeholder": "Any"})
+    exclude_flagged: bool = pydantic.Field(default=False, title="Exclude QC-flagged samples")
+
+    @pydantic.field_validator('sample_types', 'project_ids', mode='before')
+    @classmethod
+    def single_value_as_list(cls, value):
+        # form data carries a single selected option as a plain string
+        return [value] if isinstance(value, str) else value
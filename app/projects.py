@@ -1,30 +1,120 @@
-from fastapi import APIRouter
+from typing import Literal
+
+from fastapi import APIRouter, Query
+from fastapi.responses import Response
 from fastui import AnyComponent, FastUI
 from fastui import components as c
 from fastui.components.display import DisplayMode, DisplayLookup
 from fastui.events import GoToEvent, BackEvent
-from sqlmodel import select
+from pydantic import BaseModel, Field, field_validator
+from sqlmodel import Session, select
 
-from .shared import base_page
+from .shared import page_response, paginate
 from .models import Project
 from .database import SessionDep
+from .rollups import summarize_rollups
 
 router = APIRouter()
 
+class ProjectRow(BaseModel):
+    id: int
+    name: str
+    num_samples: int
+
 @router.get("/", response_model=FastUI, response_model_exclude_none=True)
-def api_index(session: SessionDep, page: int = 1) -> list[AnyComponent]:
+def api_index(session: SessionDep, page: int = 1) -> Response:
     page_size = 20
-    projects = session.exec(select(Project)).all()
-    return base_page(
+    rows, num_projects = paginate(session, select(Project.id, Project.name, Project.num_samples).order_by(Project.id), page, page_size)
+    return page_response(
         c.Heading(text='Projects', level=2),
+        c.Button(text='Summary statistics', on_click=GoToEvent(url='/projects/summary')),
         c.Table(
-            data=projects[(page - 1) * page_size : page * page_size],
-            data_model=Project,
+            data=[ProjectRow(**row._asdict()) for row in rows],
+            data_model=ProjectRow,
             columns=[
                 DisplayLookup(field='name', on_click=GoToEvent(url='/samples/?project_id={id}')),
                 DisplayLookup(field='num_samples', title='Samples'),
             ]
         ),
-        c.Pagination(page=page, page_size=page_size, total=len(projects)),
+        c.Pagination(page=page, page_size=page_size, total=num_projects),
+    )
+
+SummaryGroup = Literal['project', 'condition', 'sex', 'treatment', 'response', 'sample_type', 'time_from_treatment_start']
+
+class SummaryForm(BaseModel):
+    group_by: list[SummaryGroup] | None = Field(default=None, title='Group by', json_schema_extra={'placeholder': 'Group by...'})
+    project_id: str | None = Field(default=None, json_schema_extra={'search_url': '/api/search/projects', 'placeholder': 'Filter by Project...'})
+
+    @field_validator('group_by', mode='before')
+    @classmethod
+    def single_value_as_list(cls, value):
+        return [value] if isinstance(value, str) else value
+
+class RollupSummaryRow(BaseModel):
+    project: str | None = None
+    condition: str | None = None
+    sex: str | None = None
+    treatment: str | None = None
+    response: str | None = None
+    sample_type: str | None = None
+    time_from_treatment_start: int | None = None
+    population: str
+    count: int
+    mean: float
+    std: float | None = None
+
+def summary_table(
+        session: Session,
+        group_by: list[str],
+        filters: dict[str, str | int] | None = None,
+    ) -> AnyComponent:
+    '''Table of population frequency mean/std per group, read from the rollups.'''
+    rollup_keys = ['project_id' if group == 'project' else group for group in group_by]
+    summary = summarize_rollups(session, rollup_keys, filters)
+    project_names = dict(session.exec(select(Project.id, Project.name)).all())
+    rows = []
+    for record in summary.to_dict('records'):
+        if 'project_id' in record:
+            record['project'] = project_names.get(record.pop('project_id'))
+        record['mean'] = round(record['mean'], 2)
+        record['std'] = None if record['std'] != record['std'] else round(record['std'], 2) # NaN for single samples
+        rows.append(RollupSummaryRow(**record))
+    return c.Table(
+        data=rows,
+        data_model=RollupSummaryRow,
+        no_data_message='No samples match.',
+        columns=[
+            *(DisplayLookup(field=group) for group in group_by),
+            DisplayLookup(field='population'),
+            DisplayLookup(field='count', title='Samples'),
+            DisplayLookup(field='mean', title='Mean (%)'),
+            DisplayLookup(field='std', title='Std (%)'),
+        ],
     )
 
+@router.get("/summary", response_model=FastUI, response_model_exclude_none=True)
+def summary_page(
+        session: SessionDep,
+        group_by: list[SummaryGroup] | None = Query(default=None),
+        project_id: int | None = None,
+    ) -> Response:
+    group_by = group_by or ['treatment', 'response', 'time_from_treatment_start']
+    filter_form_initial = {'group_by': group_by}
+    filters = {}
+    if project_id:
+        project = session.get(Project, project_id)
+        filter_form_initial['project_id'] = {'value': project_id, 'label': project.name if project else project_id}
+        filters['project_id'] = project_id
+    return page_response(
+        c.Heading(text='Summary statistics', level=2),
+        c.Paragraph(text='Relative frequency of each population, aggregated over all samples in each group.'),
+        c.ModelForm(
+            model=SummaryForm,
+            submit_url='.',
+            initial=filter_form_initial,
+            method='GOTO',
+            submit_on_change=True,
+            display_mode='inline',
+        ),
+        summary_table(session, group_by, filters),
+    )
@@ -0,0 +1,250 @@
+'''
+Quality control of samples by robust outlier detection.
+
+Samples are compared with the other samples of their project and sample
+type. Each metric, the log total count and the frequency of every
+population, gets a modified z-score, 0.6745 * (x - median) / MAD
+(Iglewicz and Hoaglin), computed with NumPy over the group's frequency
+matrix (read from the columnar snapshot, see app/columnar.py, when a
+whole group is scored). Samples with a very low total count or an
+extreme population frequency are flagged.
+
+The median and MAD of every group are stored in `QCBaseline`. A refresh
+scores the samples without a `SampleQC` row (new, or whose counts,
+project or sample type changed) against the stored baselines, and only
+recomputes a group's baseline, rescoring all of its samples, when the
+group has changed size by more than REBASELINE_FRACTION. Datasets with
+`exclude_flagged` leave out flagged samples in SQL (see
+`Dataset.get_conditions`).
+'''
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import pydantic
+from sqlmodel import Session, delete, func, or_, select
+
+from app.analytics import read_frame
+from app.columnar import get_snapshot
+from app.database import bump_data_version, engine, init_db
+from app.models import chunked, get_frequency_matrix, Dataset, QCBaseline, Sample, SampleCount, SampleQC
+from app.running_stats import bump_dataset_versions, recompute_dataset_statistics
+
+TOTAL_METRIC = 'log10 total count'
+# modified z-score beyond which a sample is an outlier
+THRESHOLD = 3.5
+# groups smaller than this are not scored, their median and MAD are not meaningful
+MIN_GROUP_SIZE = 10
+# relative change in the size of a group that triggers a new baseline
+REBASELINE_FRACTION = 0.1
+
+class QCReport(pydantic.BaseModel):
+    scored: int
+    rebaselined_groups: int
+    flagged: int
+    # samples whose flag changed
+    changed: int
+    seconds: float
+
+class FlaggedSample(pydantic.BaseModel):
+    sample_id: int
+    name: str
+    project_id: int
+    sample_type: str
+    total_count: int
+    total_z: float | None = None
+    max_z: float | None = None
+    population: str | None = None
+
+def read_metrics(session: Session, sample_ids: list[int]) -> tuple[pd.DataFrame, pd.Series]:
+    '''
+    QC metrics of `sample_ids`, the log total count then the frequency of
+    every population, and their total counts. Samples without counts have
+    a total of 0.
+    '''
+    frequencies, totals = [], []
+    for chunk in chunked(sample_ids):
+        frequencies.append(get_frequency_matrix(session, [Sample.id.in_(chunk)]))
+        totals.append(read_frame(
+            session,
+            select(SampleCount.sample_id, func.sum(SampleCount.count)).where(SampleCount.sample_id.in_(chunk)).group_by(SampleCount.sample_id),
+            ['sample_id', 'total'],
+            analytical=False,
+        ).set_index('sample_id')['total'])
+    index = pd.Index(sample_ids, name='sample_id')
+    total = (pd.concat(totals).reindex(index) if totals else pd.Series(index=index, dtype=np.float64)).fillna(0).astype(np.int64)
+    metrics = pd.concat(frequencies).reindex(index) if frequencies else pd.DataFrame(index=index)
+    metrics.insert(0, TOTAL_METRIC, np.log10(total + 1.0))
+    return metrics, total
+
+def read_group_metrics(session: Session, project_id: int, sample_type: str) -> tuple[pd.DataFrame, pd.Series]:
+    '''`read_metrics` of every sample of a project and sample type, from the columnar snapshot.'''
+    snapshot = get_snapshot(session)
+    type_codes = [code for code, name in enumerate(snapshot.sample_types) if name == sample_type]
+    mask = (snapshot.project_id == project_id) & np.isin(snapshot.type_code, type_codes)
+    counts = snapshot.counts[mask]
+    total = pd.Series(np.where(counts < 0, 0, counts).sum(axis=1, dtype=np.int64), index=pd.Index(snapshot.sample_id[mask], name='sample_id'))
+    metrics = snapshot.frequencies(mask)
+    metrics.insert(0, TOTAL_METRIC, np.log10(total + 1.0))
+    return metrics, total
+
+def compute_baseline(metrics: pd.DataFrame) -> pd.DataFrame:
+    '''Median and MAD of every metric, ignoring samples that do not measure it.'''
+    values = metrics.to_numpy(dtype=np.float64)
+    # a population no sample of the group measures has an all-NaN column, whose median is NaN
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(values, axis=0)
+        mad = np.nanmedian(np.abs(values - median), axis=0)
+    return pd.DataFrame({'median': median, 'mad': mad}, index=metrics.columns)
+
+def score_samples(metrics: pd.DataFrame, totals: pd.Series, baseline: pd.DataFrame, num_samples: int) -> pd.DataFrame:
+    '''
+    Modified z-scores of `metrics` against `baseline` (see `read_metrics`
+    and `compute_baseline`), with the most extreme population of every
+    sample and its flag, one row per sample.
+    '''
+    values = metrics.to_numpy(dtype=np.float64)
+    z = np.full(values.shape, np.nan)
+    if num_samples >= MIN_GROUP_SIZE:
+        baseline = baseline.reindex(metrics.columns)
+        median, mad = baseline['median'].to_numpy(), baseline['mad'].to_numpy()
+        with np.errstate(all='ignore'):
+            z = np.where(mad > 0, 0.6745 * (values - median) / mad, np.nan)
+    total_z = z[:, 0]
+    # a trailing NaN column keeps the argmax defined for samples (or panels) without populations
+    population_z = np.column_stack([z[:, 1:], np.full(len(z), np.nan)])
+    populations = np.append(np.asarray(metrics.columns[1:], dtype=object), None)
+    extreme = np.argmax(np.where(np.isnan(population_z), -1.0, np.abs(population_z)), axis=1)
+    max_z = population_z[np.arange(len(z)), extreme]
+    with np.errstate(invalid='ignore'):
+        flagged = (total_z < -THRESHOLD) | (np.abs(max_z) > THRESHOLD)
+    return pd.DataFrame({
+        'sample_id': metrics.index,
+        'total_count': totals.to_numpy(),
+        'total_z': total_z,
+        'max_z': max_z,
+        'population': np.where(np.isnan(max_z), None, populations[extreme]),
+        'flagged': flagged,
+    })
+
+def _insert_scores(session: Session, project_id: int, sample_type: str, scores: pd.DataFrame):
+    columns = ['sample_id', 'project_id', 'sample_type', 'total_count', 'total_z', 'max_z', 'population', 'flagged']
+    rows = scores.assign(project_id=project_id, sample_type=sample_type)[columns].astype(object)
+    rows = rows.where(rows.notna(), None)
+    # plain tuples through the driver; a million rows of Core parameter processing takes seconds
+    session.connection().exec_driver_sql(
+        f'INSERT INTO sampleqc ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+        list(rows.itertuples(index=False, name=None)),
+    )
+
+def refresh_sample_qc(session: Session, full: bool = False) -> QCReport:
+    '''
+    Score the samples without QC results and rebaseline the groups that
+    changed size (every group with `full`). When flags change, the
+    statistics of the datasets excluding flagged samples are recomputed.
+    Does not commit.
+    '''
+    start = time.perf_counter()
+    # samples deleted outside the application leave their rows behind; moved samples are scored in their new group
+    session.exec(delete(SampleQC).where(SampleQC.sample_id.not_in(select(Sample.id))))
+    moved = (
+        select(SampleQC.sample_id)
+        .join(Sample, Sample.id == SampleQC.sample_id)
+        .where(or_(Sample.project_id != SampleQC.project_id, Sample.type != SampleQC.sample_type))
+    )
+    session.exec(delete(SampleQC).where(SampleQC.sample_id.in_(moved)))
+    previously_flagged = set(session.exec(select(SampleQC.sample_id).where(SampleQC.flagged)).all())
+
+    sizes = {
+        (project_id, sample_type): count
+        for project_id, sample_type, count in session.exec(
+            select(Sample.project_id, Sample.type, func.count(Sample.id))
+            .where(Sample.project_id.is_not(None))
+            .group_by(Sample.project_id, Sample.type)
+        ).all()
+    }
+    baselines = read_frame(
+        session,
+        select(QCBaseline.project_id, QCBaseline.sample_type, QCBaseline.metric, QCBaseline.median, QCBaseline.mad, QCBaseline.num_samples),
+        ['project_id', 'sample_type', 'metric', 'median', 'mad', 'num_samples'],
+        analytical=False,
+    )
+    baseline_sizes = baselines.groupby(['project_id', 'sample_type'])['num_samples'].first().to_dict()
+    for project_id, sample_type in set(baseline_sizes) - set(sizes):
+        session.exec(delete(QCBaseline).where(QCBaseline.project_id == project_id, QCBaseline.sample_type == sample_type))
+    rebaseline = [
+        group for group, size in sizes.items()
+        if full or group not in baseline_sizes or abs(size - baseline_sizes[group]) > REBASELINE_FRACTION * baseline_sizes[group]
+    ]
+
+    scored = 0
+    for project_id, sample_type in rebaseline:
+        metrics, totals = read_group_metrics(session, project_id, sample_type)
+        baseline = compute_baseline(metrics)
+        session.exec(delete(QCBaseline).where(QCBaseline.project_id == project_id, QCBaseline.sample_type == sample_type))
+        session.exec(delete(SampleQC).where(SampleQC.project_id == project_id, SampleQC.sample_type == sample_type))
+        session.add_all([
+            QCBaseline(project_id=project_id, sample_type=sample_type, metric=metric, median=median, mad=mad, num_samples=len(metrics))
+            for metric, median, mad in baseline.dropna().itertuples()
+        ])
+        _insert_scores(session, project_id, sample_type, score_samples(metrics, totals, baseline, len(metrics)))
+        scored += len(metrics)
+
+    pending = read_frame(
+        session,
+        select(Sample.id, Sample.project_id, Sample.type)
+        .outerjoin(SampleQC, SampleQC.sample_id == Sample.id)
+        .where(SampleQC.sample_id.is_(None), Sample.project_id.is_not(None))
+        .order_by(Sample.id),
+        ['sample_id', 'project_id', 'sample_type'],
+        analytical=False,
+    )
+    for (project_id, sample_type), rows in pending.groupby(['project_id', 'sample_type']):
+        group = baselines[(baselines['project_id'] == project_id) & (baselines['sample_type'] == sample_type)]
+        metrics, totals = read_metrics(session, rows['sample_id'].tolist())
+        baseline = group.set_index('metric')[['median', 'mad']]
+        _insert_scores(session, int(project_id), sample_type, score_samples(metrics, totals, baseline, int(group['num_samples'].max())))
+        scored += len(rows)
+
+    flagged = set(session.exec(select(SampleQC.sample_id).where(SampleQC.flagged)).all())
+    changed = len(flagged ^ previously_flagged)
+    if changed:
+        datasets = session.exec(select(Dataset).where(Dataset.exclude_flagged)).all()
+        for dataset in datasets:
+            recompute_dataset_statistics(dataset, session)
+        bump_dataset_versions(session, [dataset.id for dataset in datasets])
+        if datasets:
+            # the samples these datasets select changed without a write to samples
+            bump_data_version(session)
+    return QCReport(
+        scored=scored,
+        rebaselined_groups=len(rebaseline),
+        flagged=len(flagged),
+        changed=changed,
+        seconds=time.perf_counter() - start,
+    )
+
+def get_flagged_samples(session: Session) -> list[FlaggedSample]:
+    rows = session.exec(
+        select(SampleQC, Sample.name)
+        .join(Sample, Sample.id == SampleQC.sample_id)
+        .where(SampleQC.flagged)
+        .order_by(SampleQC.project_id, SampleQC.sample_type, SampleQC.sample_id)
+    ).all()
+    return [FlaggedSample(name=name, **qc.model_dump(exclude={'flagged'})) for qc, name in rows]
+
+if __name__ == '__main__':
+    init_db()
+    with Session(engine) as session:
+        report = refresh_sample_qc(session, full='--full' in sys.argv)
+        session.commit()
+        for sample in get_flagged_samples(session):
+            reason = 'low total count' if sample.total_z is not None and sample.total_z < -THRESHOLD else f'{sample.population} frequency'
+            print(f'{sample.name} (project {sample.project_id}, {sample.sample_type}): {reason}')
+    print(
+        f'{report.scored} samples scored ({report.rebaselined_groups} groups rebaselined), '
+        f'{report.flagged} flagged, {report.changed} changed in {report.seconds:.2f}s.'
+    )
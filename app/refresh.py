@@ -0,0 +1,111 @@
+'''
+Refresh of the analyses of datasets whose samples changed.
+
+Every write to samples bumps the version of the datasets selecting them
+(see `DatasetVersion` and app/running_stats.py), so a dataset is stale
+when its version is ahead of the version its analyses were last
+refreshed at. Refreshing recomputes the statistics of the stale datasets
+only, then renders their images across a process pool; other datasets
+keep their results.
+'''
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pydantic
+from sqlmodel import Session, select, update
+
+from app.columnar import get_snapshot
+from app.database import engine
+from app.models import Dataset, DatasetVersion
+from app.qc import refresh_sample_qc
+from app.running_stats import recompute_dataset_statistics
+from app.visualizations import get_dataset_png
+
+class StaleDataset(pydantic.BaseModel):
+    dataset_id: int
+    name: str
+    version: int
+    refreshed_version: int
+
+class RefreshReport(pydantic.BaseModel):
+    refreshed: list[StaleDataset]
+    # datasets written to during the refresh, which stay stale
+    still_stale: list[int]
+    seconds: float
+
+def get_stale_datasets(session: Session, refresh_all: bool = False) -> list[StaleDataset]:
+    query = (
+        select(Dataset.id, Dataset.name, DatasetVersion.version, DatasetVersion.refreshed_version)
+        .join(DatasetVersion, DatasetVersion.dataset_id == Dataset.id)
+        .order_by(Dataset.id)
+    )
+    if not refresh_all:
+        query = query.where(DatasetVersion.version != DatasetVersion.refreshed_version)
+    return [
+        StaleDataset(dataset_id=id, name=name, version=version, refreshed_version=refreshed_version)
+        for id, name, version, refreshed_version in session.exec(query).all()
+    ]
+
+def _render_image(dataset_id: int):
+    with Session(engine) as session:
+        get_dataset_png(session.get(Dataset, dataset_id), session)
+
+def refresh_stale_analyses(session: Session, workers: int | None = None, refresh_all: bool = False) -> RefreshReport:
+    '''
+    Refresh the QC flags of samples, then recompute the statistics and
+    images of the stale datasets (of every dataset with `refresh_all`). Statistics are written by this process,
+    images are rendered by `workers` processes (1 renders them here).
+    '''
+    start = time.perf_counter()
+    # new QC flags make the datasets excluding flagged samples stale
+    refresh_sample_qc(session)
+    session.commit()
+    stale = get_stale_datasets(session, refresh_all)
+    if not stale:
+        return RefreshReport(refreshed=[], still_stale=[], seconds=time.perf_counter() - start)
+
+    for entry in stale:
+        recompute_dataset_statistics(session.get(Dataset, entry.dataset_id), session)
+    session.commit()
+
+    dataset_ids = [entry.dataset_id for entry in stale]
+    # build the columnar files once, before the workers map them
+    get_snapshot(session)
+    if workers == 1:
+        for dataset_id in dataset_ids:
+            _render_image(dataset_id)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_render_image, dataset_ids))
+
+    still_stale = []
+    for entry in stale:
+        # a write during the refresh bumped the version again; leave that dataset stale
+        result = session.exec(
+            update(DatasetVersion)
+            .where(DatasetVersion.dataset_id == entry.dataset_id, DatasetVersion.version == entry.version)
+            .values(refreshed_version=entry.version)
+        )
+        if result.rowcount == 0:
+            still_stale.append(entry.dataset_id)
+    session.commit()
+    return RefreshReport(refreshed=stale, still_stale=still_stale, seconds=time.perf_counter() - start)
+
+if __name__ == '__main__':
+    usage = 'Usage: python -m app.refresh [--all] [--workers N]'
+    arguments = sys.argv[1:]
+    refresh_all = '--all' in arguments
+    workers = None
+    if '--workers' in arguments:
+        index = arguments.index('--workers')
+        if index + 1 >= len(arguments) or not arguments[index + 1].isdigit():
+            sys.exit(usage)
+        workers = int(arguments[index + 1])
+    with Session(engine) as session:
+        report = refresh_stale_analyses(session, workers, refresh_all)
+    for entry in report.refreshed:
+        print(f'Refreshed dataset {entry.dataset_id} ({entry.name}) at version {entry.version}.')
+    if report.still_stale:
+        print(f'Changed during the refresh, still stale: {", ".join(map(str, report.still_stale))}')
+    print(f'{len(report.refreshed)} datasets refreshed in {report.seconds:.2f}s.')
@@ -0,0 +1,114 @@
+from enum import Enum
+
+import numpy as np
+import pandas as pd
+from sqlmodel import Session, func, select
+
+from app.analytics import read_frame
+from app.models import PopulationRollup, Sample, Subject, chunked, get_frequency_matrix
+
+UNKNOWN = 'unknown'
+ROLLUP_KEYS = ['project_id', 'condition', 'sex', 'treatment', 'response', 'sample_type', 'time_from_treatment_start']
+
+def group_value(value) -> str:
+    if isinstance(value, Enum):
+        return value.value
+    return value if value else UNKNOWN
+
+def _rollup_deltas(session: Session, sample_ids: list[int]) -> pd.DataFrame:
+    '''Count, sum and sum of squares of the frequencies of `sample_ids`, per rollup key and population.'''
+    parts = []
+    for chunk in chunked(sample_ids):
+        conditions = [Sample.id.in_(chunk)]
+        frequencies = get_frequency_matrix(session, conditions)
+        keys = read_frame(
+            session,
+            select(
+                Sample.id, Sample.project_id, Subject.condition, Subject.sex, Subject.treatment,
+                Subject.response, Sample.type, Sample.time_from_treatment_start,
+            )
+            .outerjoin(Subject, Sample.subject_id == Subject.id)
+            .where(*conditions),
+            ['sample_id', *ROLLUP_KEYS],
+            analytical=False,
+        ).set_index('sample_id')
+        for key in ['condition', 'sex', 'treatment', 'response']:
+            keys[key] = keys[key].map(group_value)
+        frequencies = frequencies.rename_axis(columns='population').stack().dropna().rename('frequency').reset_index()
+        parts.append(frequencies.join(keys, on='sample_id'))
+    if not parts:
+        return pd.DataFrame()
+    frequencies = pd.concat(parts)
+    frequencies['square'] = frequencies['frequency'] ** 2
+    return frequencies.groupby([*ROLLUP_KEYS, 'population']).agg(
+        count=('frequency', 'count'),
+        sum=('frequency', 'sum'),
+        sum_of_squares=('square', 'sum'),
+    )
+
+def update_rollups(session: Session, sample_ids: list[int], sign: int = 1):
+    '''
+    Add (sign=1) or remove (sign=-1) the contribution of `sample_ids` to the
+    population rollups. The samples and their counts must be in the
+    database (flushed when adding, not yet deleted when removing). Deltas
+    are aggregated per group first, so a batch touches each affected rollup
+    row once. Does not commit.
+    '''
+    deltas = _rollup_deltas(session, sample_ids)
+    if deltas.empty:
+        return
+    # load the affected projects' rollups at once rather than one lookup per group
+    project_ids = deltas.index.get_level_values('project_id').unique().tolist()
+    rollups = {
+        tuple(getattr(rollup, key) for key in deltas.index.names): rollup
+        for rollup in session.exec(select(PopulationRollup).where(PopulationRollup.project_id.in_(project_ids))).all()
+    }
+    for primary_key, delta in deltas.iterrows():
+        primary_key = tuple(value.item() if isinstance(value, np.generic) else value for value in primary_key)
+        rollup = rollups.get(primary_key)
+        if rollup is None:
+            rollup = PopulationRollup(**dict(zip(deltas.index.names, primary_key)))
+        rollup.count += sign * int(delta['count'])
+        rollup.sum += sign * delta['sum']
+        rollup.sum_of_squares += sign * delta['sum_of_squares']
+        if rollup.count <= 0:
+            if rollup in session:
+                session.delete(rollup)
+        else:
+            session.add(rollup)
+
+def summarize_rollups(
+        session: Session,
+        group_by: list[str],
+        filters: dict[str, str | int] | None = None,
+    ) -> pd.DataFrame:
+    '''
+    Mean and standard deviation of every population's frequency, grouped by
+    any of `ROLLUP_KEYS`. Reads only the rollup table, so the cost depends on
+    the number of groups, not the number of samples.
+    '''
+    group_columns = [getattr(PopulationRollup, key) for key in group_by]
+    query = select(
+        *group_columns,
+        PopulationRollup.population,
+        func.sum(PopulationRollup.count),
+        func.sum(PopulationRollup.sum),
+        func.sum(PopulationRollup.sum_of_squares),
+    )
+    for key, value in (filters or {}).items():
+        query = query.where(getattr(PopulationRollup, key) == value)
+    query = query.group_by(*group_columns, PopulationRollup.population).order_by(*group_columns, PopulationRollup.population)
+    summary = read_frame(session, query, [*group_by, 'population', 'count', 'sum', 'sum_of_squares'])
+    count = summary['count'].astype(float)
+    summary['mean'] = summary['sum'] / count
+    # sample variance from the moments; clip tiny negatives caused by rounding
+    variance = (summary['sum_of_squares'] - summary['sum'] ** 2 / count) / (count - 1)
+    summary['std'] = np.sqrt(variance.clip(lower=0)).where(count > 1)
+    return summary.drop(columns=['sum', 'sum_of_squares'])
+
+def rebuild_rollups(session: Session):
+    '''Recompute all rollups from the sample table. Does not commit.'''
+    for rollup in session.exec(select(PopulationRollup)).all():
+        session.delete(rollup)
+    session.flush()
+    update_rollups(session, session.exec(select(Sample.id)).all())
@@ -0,0 +1,236 @@
+import math
+
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+from sqlmodel import Session, delete, select, update
+
+from app.analytics import read_frame
+from app.models import Cohort, Dataset, DatasetStatistic, DatasetVersion, Sample, Subject, chunked, get_frequency_matrix, get_sample_responses
+from app.rollups import group_value
+
+class PopulationStatistic(BaseModel):
+    response: str
+    population: str
+    count: int
+    mean: float
+    std: float | None = None
+
+class _SampleBatch:
+    '''
+    Columns of a batch of samples laid out like a `ColumnarSnapshot`
+    (app/columnar.py), so that `Dataset.get_sample_mask` finds the members
+    of every dataset among them without a query per dataset.
+    '''
+    def __init__(self, samples: pd.DataFrame):
+        self.sample_id = samples['sample_id'].to_numpy(dtype=np.int64)
+        self.subject_id = samples['subject_id'].fillna(-1).to_numpy(dtype=np.int64)
+        self.project_id = samples['project_id'].fillna(-1).to_numpy(dtype=np.int64)
+        sample_types, type_codes = np.unique(samples['type'].to_numpy(dtype=str), return_inverse=True)
+        self.sample_types: list[str] = sample_types.tolist()
+        self.type_code = type_codes
+        self.time_from_treatment_start = samples['time_from_treatment_start'].to_numpy(dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.sample_id)
+
+def _frequency_frame(session: Session, conditions: list, analytical: bool = False) -> pd.DataFrame:
+    '''Frequencies of the samples matching `conditions` in long format, one row per sample and population, with the response group.'''
+    frequencies = get_frequency_matrix(session, conditions, analytical)
+    if frequencies.empty:
+        return pd.DataFrame(columns=['sample_id', 'population', 'frequency', 'response'])
+    responses = get_sample_responses(session, conditions, analytical).map(group_value)
+    frequencies = frequencies.rename_axis(columns='population').stack().dropna().rename('frequency').reset_index()
+    frequencies['response'] = frequencies['sample_id'].map(responses)
+    return frequencies
+
+def _aggregate(frequencies: pd.DataFrame, keys: list[str]) -> pd.DataFrame:
+    '''Count, mean and M2 of a `_frequency_frame` per `keys`.'''
+    grouped = frequencies.groupby(keys)['frequency']
+    count = grouped.count()
+    return pd.DataFrame({'count': count, 'mean': grouped.mean(), 'm2': grouped.var(ddof=0) * count})
+
+def _aggregate_frequencies(session: Session, conditions: list, analytical: bool = False) -> pd.DataFrame:
+    '''Count, mean and M2 of the frequencies of the samples matching `conditions`, per response and population.'''
+    frequencies = _frequency_frame(session, conditions, analytical)
+    if frequencies.empty:
+        return pd.DataFrame(columns=['count', 'mean', 'm2'])
+    return _aggregate(frequencies, ['response', 'population'])
+
+def _merge(statistic: DatasetStatistic, count: int, mean: float, m2: float, sign: int):
+    '''
+    Merge (sign=1) or unmerge (sign=-1) a batch's count/mean/M2 into
+    `statistic`, using the pairwise form of Welford's update.
+    '''
+    if sign > 0:
+        total = statistic.count + count
+        delta = mean - statistic.mean
+        statistic.m2 += m2 + delta ** 2 * statistic.count * count / total
+        statistic.mean += delta * count / total
+        statistic.count = total
+        return
+    remaining = statistic.count - count
+    if remaining <= 0:
+        statistic.count, statistic.mean, statistic.m2 = 0, 0.0, 0.0
+        return
+    remaining_mean = (statistic.count * statistic.mean - count * mean) / remaining
+    delta = mean - remaining_mean
+    statistic.m2 = max(statistic.m2 - m2 - delta ** 2 * remaining * count / statistic.count, 0.0)
+    statistic.mean = remaining_mean
+    statistic.count = remaining
+
+def _combine(batches: list[pd.DataFrame]) -> pd.DataFrame:
+    '''Pairwise-merge the count/mean/M2 aggregates of several batches.'''
+    combined = batches[0].copy()
+    for batch in batches[1:]:
+        combined = combined.reindex(combined.index.union(batch.index)).fillna(0.0)
+        batch = batch.reindex(combined.index).fillna(0.0)
+        total = combined['count'] + batch['count']
+        delta = batch['mean'] - combined['mean']
+        combined['m2'] += batch['m2'] + delta ** 2 * combined['count'] * batch['count'] / total
+        combined['mean'] += delta * batch['count'] / total
+        combined['count'] = total
+    return combined
+
+def get_dataset_version(session: Session, dataset_id: int) -> int:
+    dataset_version = session.get(DatasetVersion, dataset_id)
+    return dataset_version.version if dataset_version else 0
+
+def bump_dataset_versions(session: Session, dataset_ids: list[int]):
+    '''Mark the analyses of `dataset_ids` stale. Call as part of a write, before committing.'''
+    if dataset_ids:
+        session.exec(
+            update(DatasetVersion)
+            .where(DatasetVersion.dataset_id.in_(dataset_ids))
+            .values(version=DatasetVersion.version + 1)
+        )
+
+def _batch_subject_masks(session: Session, datasets: list[Dataset], cohorts: dict[int, Cohort], batch: _SampleBatch) -> dict[int, np.ndarray]:
+    '''
+    Subject masks (see `Cohort.get_subject_mask`) of the cohorts of
+    `datasets`, restricted to the subjects of `batch`: one query per cohort
+    however many datasets share it, and none over the other subjects.
+    '''
+    subject_ids = np.unique(batch.subject_id[batch.subject_id >= 0]).tolist()
+    masks = {}
+    for cohort_id in {dataset.cohort_id for dataset in datasets}:
+        cohort = cohorts.get(cohort_id)
+        if cohort:
+            members = session.exec(select(Subject.id).where(Subject.id.in_(subject_ids), Subject.id.in_(cohort.get_subject_query(session)))).all()
+            masks[cohort_id] = np.zeros(max(subject_ids, default=-1) + 1, dtype=bool)
+            masks[cohort_id][list(members)] = True
+    return masks
+
+def update_dataset_statistics(session: Session, sample_ids: list[int], sign: int = 1):
+    '''
+    Fold `sample_ids` into (sign=1) or out of (sign=-1) the running statistics of
+    every dataset they belong to, and bump the version of those datasets.
+    Membership is resolved for all datasets at once on the samples' columns
+    (see `Dataset.get_sample_mask`), and the frequencies of the samples are
+    read and aggregated in one pass. The samples must exist in the database
+    (flushed when adding, not yet deleted when removing). Does not commit.
+    '''
+    if not sample_ids:
+        return
+    datasets = session.exec(select(Dataset)).all()
+    if not datasets:
+        return
+    # held for the whole update: the identity map only keeps objects referenced elsewhere,
+    # so the `session.get` of every dataset's cohort (and composite operands) would query again
+    cohorts = {cohort.id: cohort for cohort in session.exec(select(Cohort)).all()}
+    affected, batches = set(), []
+    for chunk in chunked(sample_ids):
+        batch = _SampleBatch(read_frame(
+            session,
+            select(Sample.id, Sample.subject_id, Sample.project_id, Sample.type, Sample.time_from_treatment_start).where(Sample.id.in_(chunk)),
+            ['sample_id', 'subject_id', 'project_id', 'type', 'time_from_treatment_start'],
+            analytical=False,
+        ))
+        subject_masks = _batch_subject_masks(session, datasets, cohorts, batch)
+        masks = [dataset.get_sample_mask(batch, session, subject_masks) for dataset in datasets]
+        members = pd.DataFrame({
+            'dataset_id': np.repeat([dataset.id for dataset in datasets], [np.count_nonzero(mask) for mask in masks]),
+            'sample_id': np.concatenate([batch.sample_id[mask] for mask in masks]),
+        })
+        if members.empty:
+            continue
+        affected.update(members['dataset_id'].unique().tolist())
+        # the batch's frequencies are read and aggregated once, for all datasets
+        frequencies = _frequency_frame(session, [Sample.id.in_(members['sample_id'].unique().tolist())])
+        if not frequencies.empty:
+            batches.append(_aggregate(members.merge(frequencies, on='sample_id'), ['dataset_id', 'response', 'population']))
+    bump_dataset_versions(session, sorted(affected))
+    if not batches:
+        return
+    batch = batches[0] if len(batches) == 1 else _combine(batches)
+    statistics = {
+        (statistic.dataset_id, statistic.response, statistic.population): statistic
+        for statistic in session.exec(select(DatasetStatistic).where(DatasetStatistic.dataset_id.in_(sorted(affected)))).all()
+    }
+    for (dataset_id, response, population), count, mean, m2 in batch.itertuples():
+        statistic = statistics.get((int(dataset_id), response, population))
+        if statistic is None:
+            statistic = DatasetStatistic(dataset_id=int(dataset_id), response=response, population=population)
+        _merge(statistic, int(count), float(mean), float(m2), sign)
+        session.add(statistic)
+
+def compute_dataset_statistics(dataset: Dataset, session: Session, analytical: bool = False) -> list[DatasetStatistic]:
+    '''Statistics of `dataset` computed from scratch from its samples.'''
+    aggregates = _aggregate_frequencies(session, dataset.get_conditions(session), analytical)
+    return [
+        DatasetStatistic(
+            dataset_id=dataset.id,
+            response=response,
+            population=population,
+            count=int(row['count']),
+            mean=float(row['mean']),
+            m2=float(row['m2']),
+        )
+        for (response, population), row in aggregates.iterrows()
+    ]
+
+def recompute_dataset_statistics(dataset: Dataset, session: Session):
+    '''Replace the running statistics of `dataset` with a full recompute. Does not commit.'''
+    session.exec(delete(DatasetStatistic).where(DatasetStatistic.dataset_id == dataset.id))
+    for statistic in compute_dataset_statistics(dataset, session):
+        session.add(statistic)
+
+def get_dataset_statistics(dataset: Dataset, session: Session) -> list[PopulationStatistic]:
+    statistics = session.exec(
+        select(DatasetStatistic)
+        .where(DatasetStatistic.dataset_id == dataset.id, DatasetStatistic.count > 0)
+        .order_by(DatasetStatistic.population, DatasetStatistic.response)
+    ).all()
+    return [
+        PopulationStatistic(
+            response=statistic.response,
+            population=statistic.population,
+            count=statistic.count,
+            mean=statistic.mean,
+            std=math.sqrt(statistic.m2 / (statistic.count - 1)) if statistic.count > 1 else None,
+        )
+        for statistic in statistics
+    ]
+
+def check_dataset_statistics(dataset: Dataset, session: Session) -> float:
+    '''
+    Largest relative difference in count, mean or M2 between the running
+    statistics of `dataset` and a full recompute (0.0 when consistent).
+    '''
+    stored = {
+        (statistic.response, statistic.population): statistic
+        for statistic in session.exec(
+            select(DatasetStatistic).where(DatasetStatistic.dataset_id == dataset.id, DatasetStatistic.count > 0)
+        ).all()
+    }
+    expected = {
+        (statistic.response, statistic.population): statistic
+        for statistic in compute_dataset_statistics(dataset, session, analytical=True)
+    }
+    empty = DatasetStatistic(dataset_id=dataset.id, response='', population='')
+    difference = 0.0
+    for key in stored.keys() | expected.keys():
+        a, b = stored.get(key, empty), expected.get(key, empty)
+        for stored_value, expected_value in ((a.count, b.count), (a.mean, b.mean), (a.m2, b.m2)):
+            difference = max(difference, abs(stored_value - expected_value) / max(abs(expected_value), 1.0))
+    return difference
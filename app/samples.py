@@ -1,19 +1,103 @@
-from typing import Annotated
-from fastapi import APIRouter, HTTPException
+import json
+from functools import lru_cache
+from urllib.parse import urlencode
+from typing import Annotated, Sequence
+from fastapi import APIRouter, File, HTTPException, UploadFile
+from fastapi.responses import Response
 from fastui import AnyComponent, FastUI
 from fastui import components as c
 from fastui.events import PageEvent, GoToEvent, BackEvent
 from fastui.components.display import DisplayLookup
 from fastui.forms import fastui_form
-from pydantic import BaseModel, Field
-from sqlmodel import select
+from pydantic import BaseModel, Field, create_model
+from sqlmodel import Session, select
 
-from .shared import base_page
-from .models import Project, Sample, SampleForm
-from .database import SessionDep, add_sample
+from .shared import cached_component, form_error, page_response, paginate
+from .models import BulkSampleActionForm, BulkSampleForm, Dataset, EventFileForm, Population, Project, ResponseEnum, ResponseType, Sample, SampleCount, SampleForm, SampleQC, SexEnum, SexType, Subject
+from .database import SessionDep, add_sample, delete_samples, remove_sample, update_samples
+from .fcs import FCSError, ingest_fcs
+from .ingest import IngestError, RowError, ingest_samples
+from .qc import THRESHOLD, FlaggedSample, QCReport, get_flagged_samples, refresh_sample_qc
 
 router = APIRouter()
 
+@lru_cache
+def sample_row_model(population_ids: tuple[int, ...]) -> type[BaseModel]:
+    '''Row model for sample tables, with one count column per population of the panel.'''
+    return create_model(
+        'SampleRow',
+        id=(int, ...),
+        name=(str, ...),
+        type=(str, ...),
+        time_from_treatment_start=(int, ...),
+        **{f'population_{population_id}': (int | None, None) for population_id in population_ids},
+    )
+
+def sample_table(session: Session, samples: Sequence[Sample], no_data_message: str) -> c.Table:
+    '''Table of `samples` (one page) with their population counts.'''
+    populations = session.exec(select(Population).order_by(Population.id)).all()
+    row_model = sample_row_model(tuple(population.id for population in populations))
+    counts = session.exec(
+        select(SampleCount).where(SampleCount.sample_id.in_([sample.id for sample in samples]))
+    ).all()
+    sample_counts = {sample.id: {} for sample in samples}
+    for count in counts:
+        sample_counts[count.sample_id][f'population_{count.population_id}'] = count.count
+    return c.Table(
+        data=[
+            row_model(
+                id=sample.id,
+                name=sample.name,
+                type=sample.type,
+                time_from_treatment_start=sample.time_from_treatment_start,
+                **sample_counts[sample.id],
+            )
+            for sample in samples
+        ],
+        data_model=row_model,
+        no_data_message=no_data_message,
+        columns=[
+            DisplayLookup(
+                field='name', 
+                on_click=GoToEvent(url='/samples/{id}'),
+            ),
+            DisplayLookup(field='type'),
+            DisplayLookup(field='time_from_treatment_start'),
+            *(DisplayLookup(field=f'population_{population.id}', title=population.label) for population in populations),
+        ],
+    )
+
+def sample_filter_conditions(project_id: int | None, sample_type: str | None, sample_name: str | None) -> list:
+    '''Predicates on `Sample` for the filters of the samples page.'''
+    conditions = []
+    if project_id:
+        conditions.append(Sample.project_id == project_id)
+    if sample_type:
+        conditions.append(Sample.type == sample_type)
+    if sample_name:
+        conditions.append(Sample.name.ilike(f"{sample_name}%"))
+    return conditions
+
+def bulk_action_modal(submit_url: str, cached: bool = True) -> list[AnyComponent]:
+    '''
+    Button and modal to delete or update, at once, the samples selected by
+    `submit_url`'s query. Pass `cached=False` when the query holds free text.
+    '''
+    return [
+        c.Button(text='Bulk edit', named_style='secondary', on_click=PageEvent(name='modal-bulk-action')),
+        cached_component(f'modal-bulk-action:{submit_url}' if cached else None, lambda: c.Modal(
+            title='Delete or update samples',
+            body=[
+                c.Paragraph(text=(
+                    'Applies to the listed sample IDs, or to every sample matching the current filters if none are given. '
+                    'Deleting cannot be undone.'
+                )),
+                c.ModelForm(model=BulkSampleActionForm, submit_url=submit_url),
+            ],
+            open_trigger=PageEvent(name='modal-bulk-action'),
+        )),
+    ]
+
 class FilterForm(BaseModel):
     # country: str = Field(json_schema_extra={'search_url': '/api/forms/search', 'placeholder': 'Filter by Country...'})
     project_id: str | None = Field(json_schema_extra={'search_url': '/api/search/projects', 'placeholder': 'Filter by Project...'})
@@ -27,7 +111,7 @@ def samples_index(
         project_id: int | None = None,
         sample_type: str | None = None,
         sample_name: str | None = None
-    ) -> list[AnyComponent]:
+    ) -> Response:
     page_size = 20
 
     project_name = None
@@ -43,29 +127,28 @@ def samples_index(
     if sample_name:
         filter_form_initial['sample_name'] = {'value': sample_name, 'label': sample_name}
     
-    query = select(Sample)
-    if project_id:
-        query = query.where(Sample.project_id == project_id)
-    if sample_type:
-        query = query.where(Sample.type == sample_type)
-    if sample_name:
-        query = query.where(Sample.name.ilike(f"{sample_name}%"))
-    
-    samples = session.exec(query).all()
+    query = select(Sample).where(*sample_filter_conditions(project_id, sample_type, sample_name)).order_by(Sample.id)
+    samples, num_samples = paginate(session, query, page, page_size)
 
-    return base_page(
+    return page_response(
         c.Heading(text='Samples', level=2),
         c.Button(text='New sample', on_click=PageEvent(name='modal-new-sample')),
-        c.Paragraph(text=f'Showing {len(samples)} samples'),
-        c.ModelForm(
+        c.Button(text='Bulk upload', named_style='secondary', on_click=PageEvent(name='modal-bulk-samples')),
+        *bulk_action_modal('/api/samples/bulk-action?' + urlencode({
+            name: value for name, value in
+            {'project_id': project_id, 'sample_type': sample_type, 'sample_name': sample_name}.items() if value
+        }), cached=not sample_name),
+        c.Paragraph(text=f'Showing {num_samples} samples'),
+        # typed names would flood the cache
+        cached_component(None if sample_name else f'sample-filters:{json.dumps(filter_form_initial, sort_keys=True)}', lambda: c.ModelForm(
             model=FilterForm,
             submit_url='.',
             initial=filter_form_initial,
             method='GOTO',
             submit_on_change=True,
             display_mode='inline',
-        ),
-        c.Modal(
+        )),
+        cached_component('modal-new-sample', lambda: c.Modal(
             title='Add new sample',
             body=[
                 c.ModelForm(
@@ -84,47 +167,176 @@ def samples_index(
                 c.Button(text='Submit', on_click=PageEvent(name='post-new-sample')),
             ],
             open_trigger=PageEvent(name='modal-new-sample'),
-        ),
-        c.Table(
-            data=samples[(page - 1) * page_size : page * page_size],
-            data_model=Sample,
-            no_data_message="No samples found. Are filters applied?",
-            columns=[
-                DisplayLookup(
-                    field='name', 
-                    on_click=GoToEvent(url='/samples/{id}'),
-                ),
-                DisplayLookup(field='type'),
-                DisplayLookup(field='time_from_treatment_start'),
-                DisplayLookup(field='b_cell'),
-                DisplayLookup(field='cd8_t_cell'),
-                DisplayLookup(field='cd4_t_cell'),
-                DisplayLookup(field='nk_cell'),
-                DisplayLookup(field='monocyte'),
+        )),
+        cached_component('modal-bulk-samples', lambda: c.Modal(
+            title='Upload samples',
+            body=[
+                c.Markdown(text=(
+                    'One row per sample with the columns `sample`, `project`, `subject`, `sample_type` and '
+                    '`time_from_treatment_start` (projects and subjects by name), plus one count column per population. '
+                    'Rows with errors are skipped and listed after the upload.'
+                )),
+                c.ModelForm(model=BulkSampleForm, submit_url='/api/samples/bulk'),
             ],
-        ),
-        c.Pagination(page=page, page_size=page_size, total=len(samples)),
+            open_trigger=PageEvent(name='modal-bulk-samples'),
+        )),
+        sample_table(session, samples, "No samples found. Are filters applied?"),
+        c.Pagination(page=page, page_size=page_size, total=num_samples),
     )
 
 @router.post("/new", response_model=FastUI, response_model_exclude_none=True)
 def submit_sample(form: Annotated[SampleForm, fastui_form(SampleForm)], session: SessionDep) -> list[AnyComponent]:
-    add_sample(form, session)
+    try:
+        add_sample(form, session)
+    except ValueError as error:
+        raise form_error('counts', str(error))
     return [c.FireEvent(event=PageEvent(name='modal-new-sample', clear=True))]
 
+@router.post("/bulk", response_model=FastUI, response_model_exclude_none=True)
+def submit_samples(file: Annotated[UploadFile, File()], session: SessionDep) -> list[AnyComponent]:
+    # see `upload_events` on why the file is not taken through `fastui_form`
+    try:
+        report = ingest_samples(file.file, file.filename, session)
+    except IngestError as error:
+        raise form_error('file', str(error))
+    max_errors = 100
+    return [
+        c.Paragraph(text=f'Added {report.inserted} of {report.total_rows} samples, {len(report.errors)} errors.'),
+        c.Table(
+            data=report.errors[:max_errors],
+            data_model=RowError,
+            no_data_message='No errors.',
+            columns=[
+                DisplayLookup(field='row'),
+                DisplayLookup(field='column'),
+                DisplayLookup(field='message'),
+            ],
+        ),
+        *([c.Text(text=f'Showing the first {max_errors} errors.')] if len(report.errors) > max_errors else []),
+    ]
+
+@router.post("/bulk-action", response_model=FastUI, response_model_exclude_none=True)
+def submit_bulk_action(
+        form: Annotated[BulkSampleActionForm, fastui_form(BulkSampleActionForm)],
+        session: SessionDep,
+        project_id: int | None = None,
+        sample_type: str | None = None,
+        sample_name: str | None = None,
+        dataset_id: int | None = None,
+        sex: SexType | None = None,
+        response: ResponseType | None = None,
+    ) -> list[AnyComponent]:
+    conditions = sample_filter_conditions(project_id, sample_type, sample_name)
+    if dataset_id is not None:
+        dataset = session.get(Dataset, dataset_id)
+        if not dataset:
+            raise HTTPException(status_code=404, detail=f"Dataset {dataset_id} not found")
+        conditions += dataset.get_conditions(session)
+    # the subject filters of the dataset samples tab
+    subject_conditions = []
+    if sex:
+        subject_conditions.append(Subject.sex == SexEnum(sex))
+    if response:
+        subject_conditions.append(Subject.response == ResponseEnum(response))
+    if subject_conditions:
+        conditions.append(Sample.subject_id.in_(select(Subject.id).where(*subject_conditions)))
+    if form.get_sample_ids():
+        conditions.append(Sample.id.in_(form.get_sample_ids()))
+    if not conditions:
+        raise form_error('sample_ids', 'Enter sample IDs or apply a filter first, bulk actions never apply to all samples')
+    if form.action == 'delete':
+        return [c.Paragraph(text=f'Deleted {delete_samples(session, conditions)} samples.')]
+    values = form.get_values()
+    if not values:
+        raise form_error('type', 'Choose at least one value to set')
+    if 'project_id' in values and not session.get(Project, values['project_id']):
+        raise form_error('project_id', 'Project not found')
+    if 'subject_id' in values and not session.get(Subject, values['subject_id']):
+        raise form_error('subject_id', 'Subject not found')
+    return [c.Paragraph(text=f'Updated {update_samples(session, conditions, values)} samples.')]
+
+class SampleCountRow(BaseModel):
+    population: str
+    count: int
+    frequency: float
+
+class ChannelRow(BaseModel):
+    name: str
+    stain: str | None = None
+    range: float | None = None
+
+def event_file_section(sample: Sample) -> list[AnyComponent]:
+    '''Event-level data of a sample, with a form to upload (or replace) its FCS file.'''
+    components = [c.Heading(text='Events', level=4)]
+    if sample.event_file:
+        components += [
+            c.Paragraph(text=f'{sample.event_file.num_events} events from {sample.event_file.filename} ({sample.event_file.fcs_version})'),
+            c.Table(
+                data=[ChannelRow(**channel) for channel in sample.event_file.channels],
+                data_model=ChannelRow,
+                columns=[
+                    DisplayLookup(field='name'),
+                    DisplayLookup(field='stain'),
+                    DisplayLookup(field='range'),
+                ],
+            ),
+        ]
+    else:
+        components.append(c.Paragraph(text='No event-level data uploaded for this sample.'))
+    components.append(c.ModelForm(model=EventFileForm, submit_url=f'/api/samples/{sample.id}/events'))
+    return components
+
+@router.get('/qc', response_model=list[FlaggedSample])
+def flagged_samples(session: SessionDep) -> list[FlaggedSample]:
+    '''Samples flagged as outliers by the last QC refresh.'''
+    return get_flagged_samples(session)
+
+@router.post('/qc/refresh', response_model=QCReport)
+def refresh_qc(session: SessionDep, full: bool = False) -> QCReport:
+    '''Score new and changed samples, rebaselining the groups that changed size (every group with `full`).'''
+    report = refresh_sample_qc(session, full)
+    session.commit()
+    return report
+
+def qc_paragraph(sample: Sample, session: Session) -> c.Paragraph:
+    qc = session.get(SampleQC, sample.id)
+    if qc is None:
+        return c.Paragraph(text='QC: not scored yet.')
+    if not qc.flagged:
+        return c.Paragraph(text='QC: passed.')
+    if qc.total_z is not None and qc.total_z < -THRESHOLD:
+        return c.Paragraph(text=f'QC: flagged, low total count ({qc.total_count}, z = {qc.total_z:.1f}).')
+    return c.Paragraph(text=f'QC: flagged, extreme {qc.population} frequency (z = {qc.max_z:.1f}).')
 
 @router.get("/{id}", response_model=FastUI, response_model_exclude_none=True)
-def view_sample(id: str, session: SessionDep) -> list[AnyComponent]:
+def view_sample(id: str, session: SessionDep) -> Response:
     sample = session.exec(select(Sample).where(Sample.id == id)).first()
     if not sample:
-        return base_page(
+        return page_response(
             c.Heading(text='Sample Not Found', level=2),
             c.Text(text='The requested sample does not exist.'),
         )
-    return base_page(
+    sample_counts = sample.get_population_counts()
+    return page_response(
         c.Heading(text='Details for ' + sample.name),
         c.Details(
             data=sample,
         ),
+        qc_paragraph(sample, session),
+        c.Heading(text='Cell counts', level=4),
+        c.Table(
+            data=[
+                SampleCountRow(population=population, count=sample_counts[population], frequency=round(frequency, 2))
+                for population, frequency in sample.get_population_frequencies().items()
+            ],
+            data_model=SampleCountRow,
+            columns=[
+                DisplayLookup(field='population'),
+                DisplayLookup(field='count'),
+                DisplayLookup(field='frequency', title='Frequency (%)'),
+            ],
+        ),
+        *event_file_section(sample),
         c.Modal(
             title='Delete Sample',
             body=[
@@ -151,6 +363,20 @@ def view_sample(id: str, session: SessionDep) -> list[AnyComponent]:
         ),
     )
 
+@router.post("/{id}/events", response_model=FastUI, response_model_exclude_none=True)
+def upload_events(id: int, file: Annotated[UploadFile, File()], session: SessionDep) -> list[AnyComponent]:
+    # the file is taken directly rather than through `fastui_form(EventFileForm)`,
+    # which closes uploads before the endpoint runs
+
+    sample = session.exec(select(Sample).where(Sample.id == id)).first()
+    if not sample:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    try:
+        ingest_fcs(sample, file.file, file.filename, session)
+    except (FCSError, KeyError) as error:
+        raise form_error('file', f'Missing FCS keyword {error}' if isinstance(error, KeyError) else str(error))
+    return [c.FireEvent(event=GoToEvent(url=f'/samples/{id}'))]
+
 # there's no way to do DELETE with FastUI, so we use a hack. Only exception is 
 # ServerLoad (only when sse=True, see https://github.com/pydantic/FastUI/issues/351), 
 # but then it fires immediately, not just when triggered
@@ -160,8 +386,7 @@ def delete_sample(id: int, session: SessionDep) -> list[AnyComponent]:
     db_sample = session.exec(select(Sample).where(Sample.id == id)).first()
     if not db_sample:
         raise HTTPException(status_code=404, detail="Sample not found")
-    session.delete(db_sample)
-    session.commit()
+    remove_sample(db_sample, session)
     return [
         c.FireEvent(event=PageEvent(name='modal-delete-sample', clear=True)),
         c.FireEvent(event=GoToEvent(url='/samples/'))
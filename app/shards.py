@@ -0,0 +1,274 @@
+'''
+Optional sharded layout for very large deployments: one SQLite file per
+project holding its samples, counts and event files, and a catalog
+database with everything else (projects, subjects, populations, cohorts,
+datasets and derived tables).
+
+Each shard connection attaches the catalog, so the statements built for
+the single-file schema (e.g. `Dataset.get_conditions`) run unchanged on a
+shard: `sample` resolves to the shard and `subject` to the catalog.
+Dataset and cohort queries fan out over the shards they can match across
+a thread pool (SQLite releases the GIL while it runs a query) and the
+partial results are merged. Cross-project queries can instead run on one
+federated connection, which attaches every shard under temporary views
+with the names of the sharded tables; SQLite bounds the number of attached
+databases (10 by default), so larger layouts must fan out.
+
+Samples of different projects live in different files, so writes to
+different projects do not wait on one lock; only the allocation of sample
+ids and project counts touches the catalog, in short transactions.
+
+The web application keeps serving from db.sqlite3. A layout is built from
+it with `python -m app.shards split`; rollups, dataset statistics and
+versions are copied to the catalog as of the split and are not maintained
+by `write_samples`.
+'''
+import os
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from sqlmodel import Session, create_engine, func, select
+
+from app.analytics import read_frame
+from app.database import DB_FILE
+from app.models import chunked, get_frequency_matrix, get_sample_responses, Cohort, Dataset, EventFile, Population, Project, Sample, SampleCount
+
+SHARD_DIR = 'shards'
+CATALOG_FILE = 'catalog.sqlite3'
+# tables split by project, in dependency order
+SHARDED_TABLES = [Sample.__table__, SampleCount.__table__, EventFile.__table__]
+# rows per INSERT statement, below SQLite's bound parameter limit
+BATCH_SIZE = 5_000
+
+def _attach(dbapi_connection, path: str, name: str):
+    # the path is bound, it may contain quotes; `name` is always generated here
+    dbapi_connection.execute(f'ATTACH DATABASE ? AS {name}', (path,))
+
+class ShardedDatabase:
+    '''Catalog and per-project shard databases of a sharded layout in `directory`.'''
+    def __init__(self, directory: str = SHARD_DIR):
+        self.directory = directory
+        self.catalog_path = os.path.join(directory, CATALOG_FILE)
+        if not os.path.exists(self.catalog_path):
+            raise FileNotFoundError(f'No sharded layout in {directory}; create one with `python -m app.shards split`.')
+        self.catalog = create_engine(f'sqlite:///{self.catalog_path}')
+        self.shard_paths = {
+            int(match.group(1)): os.path.join(directory, entry)
+            for entry in sorted(os.listdir(directory))
+            if (match := re.fullmatch(r'project_(\d+)\.sqlite3', entry))
+        }
+        self._shard_engines: dict[int, sa.Engine] = {}
+        self._federated: sa.Engine | None = None
+
+    @staticmethod
+    def shard_file(project_id: int) -> str:
+        return f'project_{project_id}.sqlite3'
+
+    def shard(self, project_id: int) -> sa.Engine:
+        '''Engine of a project's shard, with the catalog attached.'''
+        if project_id not in self._shard_engines:
+            path = os.path.join(self.directory, self.shard_file(project_id))
+            engine = create_engine(f'sqlite:///{path}')
+            sa.event.listen(engine, 'connect', lambda dbapi_connection, _: _attach(dbapi_connection, self.catalog_path, 'catalog'))
+            with engine.begin() as connection:
+                for table in SHARDED_TABLES:
+                    table.create(connection, checkfirst=True)
+            self._shard_engines[project_id] = engine
+            self.shard_paths[project_id] = path
+        return self._shard_engines[project_id]
+
+    def federated(self) -> sa.Engine:
+        '''Engine of the catalog with every shard attached and unioned under the names of the sharded tables.'''
+        if self._federated is None:
+            limit = sqlite3.connect(':memory:').getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+            if len(self.shard_paths) > limit:
+                raise ValueError(f'{len(self.shard_paths)} shards exceed the limit of {limit} attached databases; use fan_out instead')
+            project_ids = sorted(self.shard_paths)
+
+            def connect(dbapi_connection, _):
+                for project_id in project_ids:
+                    _attach(dbapi_connection, self.shard_paths[project_id], f'shard_{project_id}')
+                # temporary views shadow the tables of the same name in the catalog
+                for table in SHARDED_TABLES:
+                    union = ' UNION ALL '.join(f'SELECT * FROM shard_{project_id}.{table.name}' for project_id in project_ids)
+                    dbapi_connection.execute(f'CREATE TEMP VIEW {table.name} AS {union}')
+
+            self._federated = create_engine(f'sqlite:///{self.catalog_path}')
+            sa.event.listen(self._federated, 'connect', connect)
+        return self._federated
+
+    def fan_out(self, query, project_ids: list[int] | None = None, workers: int | None = None) -> list:
+        '''
+        Results of `query(session)` on the shards of `project_ids` (default:
+        every shard), run across `workers` threads (1 runs them here), in
+        project id order.
+        '''
+        project_ids = sorted(self.shard_paths if project_ids is None else set(project_ids) & set(self.shard_paths))
+        engines = [self.shard(project_id) for project_id in project_ids]
+
+        def run(engine):
+            with Session(engine) as session:
+                return query(session)
+
+        if workers == 1 or len(engines) <= 1:
+            return [run(engine) for engine in engines]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, engines))
+
+    def get_dataset_frequencies(self, dataset: Dataset, catalog_session: Session, workers: int | None = None) -> tuple[pd.DataFrame, pd.Series]:
+        '''
+        Frequency matrix and responses of the samples of `dataset` (see
+        `get_frequency_matrix`), fanned out over the shards of its projects.
+        '''
+        # built once from the catalog, whose subjects every shard attaches
+        conditions = dataset.get_conditions(catalog_session)
+        parts = self.fan_out(
+            lambda session: (get_frequency_matrix(session, conditions), get_sample_responses(session, conditions)),
+            dataset.project_ids or None,
+            workers,
+        )
+        labels = catalog_session.exec(select(Population.label).order_by(Population.id)).all()
+        frequencies = [part for part, _ in parts if not part.empty]
+        if not frequencies:
+            return pd.DataFrame(columns=[]), pd.Series(dtype=object)
+        matrix = pd.concat(frequencies)
+        matrix = matrix.reindex(columns=[label for label in labels if label in matrix.columns])
+        return matrix, pd.concat([responses for _, responses in parts])
+
+    def count_cohort_samples(self, cohort: Cohort, catalog_session: Session, workers: int | None = None) -> pd.DataFrame:
+        '''Number of samples of the subjects of `cohort` per project, sample type and timepoint, over every shard.'''
+        # resolved against the catalog, which every shard attaches
+        members = Sample.subject_id.in_(cohort.get_subject_query(catalog_session))
+        statement = (
+            select(Sample.project_id, Sample.type, Sample.time_from_treatment_start, func.count(Sample.id))
+            .where(members)
+            .group_by(Sample.project_id, Sample.type, Sample.time_from_treatment_start)
+        )
+        columns = ['project_id', 'sample_type', 'time_from_treatment_start', 'samples']
+        parts = self.fan_out(lambda session: read_frame(session, statement, columns, analytical=False), workers=workers)
+        # groups include the project, so the partial counts never overlap
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+
+    def _allocate_sample_ids(self, project_id: int, count: int) -> int:
+        '''First of `count` new sample ids, counting them in the project. A short catalog transaction.'''
+        with self.catalog.begin() as connection:
+            connection.exec_driver_sql('CREATE TABLE IF NOT EXISTS shardsequence (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL)')
+            first = connection.exec_driver_sql(
+                "UPDATE shardsequence SET next_id = next_id + ? WHERE name = 'sample' RETURNING next_id - ?", (count, count)
+            ).scalar()
+            if first is None:
+                raise ValueError('Sample id sequence missing from the catalog; was it created by `split_database`?')
+            connection.execute(sa.update(Project).where(Project.id == project_id).values(num_samples=Project.num_samples + count))
+        return first
+
+    def _release_sample_ids(self, project_id: int, first: int, count: int):
+        '''Undo `_allocate_sample_ids` after the shard write failed.'''
+        with self.catalog.begin() as connection:
+            # the ids are handed back unless another allocation followed, then they are skipped
+            connection.exec_driver_sql(
+                "UPDATE shardsequence SET next_id = ? WHERE name = 'sample' AND next_id = ?", (first, first + count)
+            )
+            connection.execute(sa.update(Project).where(Project.id == project_id).values(num_samples=Project.num_samples - count))
+
+    def write_samples(self, clean: pd.DataFrame, populations: dict[str, int]) -> list[int]:
+        '''
+        Insert rows shaped like the output of `app.ingest.validate_samples`
+        into the shard of their project, one transaction per shard.
+        `populations` maps the count columns to population ids. Returns the
+        new sample ids in row order. When a shard write fails, its id
+        allocation and project count are rolled back in the catalog; the
+        shards written before it stay committed.
+        '''
+        population_columns = list(populations)
+        sample_ids = pd.Series(0, index=clean.index, dtype=np.int64)
+        for project_id, rows in clean.groupby('project_id'):
+            project_id = int(project_id)
+            first = self._allocate_sample_ids(project_id, len(rows))
+            ids = np.arange(first, first + len(rows))
+            sample_ids[rows.index] = ids
+            samples = rows[['name', 'project_id', 'subject_id', 'type', 'time_from_treatment_start']].astype(
+                {'project_id': int, 'subject_id': int, 'time_from_treatment_start': int}
+            ).assign(id=ids).to_dict('records')
+            counts = rows[population_columns].set_axis(ids).rename(columns=populations)
+            counts = counts.stack().dropna().astype(int).rename_axis(['sample_id', 'population_id']).rename('count').reset_index()
+            try:
+                with self.shard(project_id).begin() as connection:
+                    for batch in chunked(samples, BATCH_SIZE):
+                        connection.execute(Sample.__table__.insert(), batch)
+                    for batch in chunked(counts.to_dict('records'), BATCH_SIZE):
+                        connection.execute(SampleCount.__table__.insert(), batch)
+            except BaseException:
+                self._release_sample_ids(project_id, first, len(rows))
+                raise
+        return sample_ids.tolist()
+
+def split_database(source: str = DB_FILE, directory: str = SHARD_DIR) -> ShardedDatabase:
+    '''
+    Build a sharded layout in `directory` from the single-file database
+    `source`, which is left unchanged. Sample ids are preserved.
+    '''
+    catalog_path = os.path.join(directory, CATALOG_FILE)
+    if os.path.exists(catalog_path):
+        raise FileExistsError(f'{catalog_path} already exists')
+    os.makedirs(directory, exist_ok=True)
+    with sqlite3.connect(source) as source_connection:
+        unassigned = source_connection.execute('SELECT count(*) FROM sample WHERE project_id IS NULL').fetchone()[0]
+        if unassigned:
+            raise ValueError(f'{unassigned} samples have no project and cannot be assigned to a shard')
+        project_ids = [row[0] for row in source_connection.execute('SELECT id FROM project ORDER BY id')]
+        next_id = source_connection.execute('SELECT coalesce(max(id), 0) + 1 FROM sample').fetchone()[0]
+        # ids of deleted samples are not reused either (see `Sample`)
+        if source_connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+            sequence = source_connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'sample'").fetchone()
+            next_id = max(next_id, sequence[0] + 1 if sequence else 0)
+        catalog = sqlite3.connect(catalog_path)
+        source_connection.backup(catalog)
+    # the sharded tables (and the triggers counting samples with them) leave the catalog
+    for table in reversed(SHARDED_TABLES):
+        catalog.execute(f'DROP TABLE {table.name}')
+    catalog.execute('CREATE TABLE shardsequence (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL)')
+    catalog.execute("INSERT INTO shardsequence VALUES ('sample', ?)", (next_id,))
+    catalog.commit()
+    catalog.execute('VACUUM')
+    catalog.close()
+
+    shards = ShardedDatabase(directory)
+    for project_id in project_ids:
+        with shards.shard(project_id).connect() as connection:
+            connection.exec_driver_sql('ATTACH DATABASE ? AS source', (source,))
+            for table in SHARDED_TABLES:
+                columns = ', '.join(column.name for column in table.columns)
+                selected = {
+                    'sample': 'project_id = ?',
+                    'samplecount': 'sample_id IN (SELECT id FROM main.sample)',
+                    'eventfile': 'sample_id IN (SELECT id FROM main.sample)',
+                }[table.name]
+                connection.exec_driver_sql(
+                    f'INSERT INTO main.{table.name} ({columns}) SELECT {columns} FROM source.{table.name} WHERE {selected}',
+                    (project_id,) if '?' in selected else (),
+                )
+            connection.commit()
+            connection.exec_driver_sql('DETACH DATABASE source')
+    return shards
+
+if __name__ == '__main__':
+    usage = 'Usage: python -m app.shards split [source] [directory] | info [directory]'
+    if len(sys.argv) < 2 or sys.argv[1] not in ('split', 'info'):
+        sys.exit(usage)
+    if sys.argv[1] == 'split':
+        source = sys.argv[2] if len(sys.argv) > 2 else DB_FILE
+        directory = sys.argv[3] if len(sys.argv) > 3 else SHARD_DIR
+        start = time.perf_counter()
+        shards = split_database(source, directory)
+        print(f'Split {source} into {len(shards.shard_paths)} project shards in {directory} in {time.perf_counter() - start:.2f}s.')
+    else:
+        shards = ShardedDatabase(sys.argv[2] if len(sys.argv) > 2 else SHARD_DIR)
+        counts = shards.fan_out(lambda session: session.exec(select(func.count(Sample.id))).one())
+        for (project_id, path), count in zip(sorted(shards.shard_paths.items()), counts):
+            print(f'project {project_id}: {count} samples, {os.path.getsize(path) / 1e6:.1f} MB ({path})')
@@ -1,14 +1,101 @@
-from fastui import AnyComponent
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+from fastui import AnyComponent, FastUI
 from fastui import components as c
 from fastui.events import GoToEvent
+from sqlmodel import Session, func, select
+
+# serialized JSON of static component trees, built once per process; keys may
+# embed request parameters (e.g. a form's submit URL), so the oldest are evicted
+_fragments: OrderedDict[str, str] = OrderedDict()
+_fragments_lock = threading.Lock()
+MAX_FRAGMENTS = 1024
+_SUB_TYPE = 'cached-component'
+_PLACEHOLDER = re.compile(rb'\{"data":"([^"\\]*(?:\\.[^"\\]*)*)","subType":"' + _SUB_TYPE.encode() + rb'","type":"Custom"\}')
+
+def dump_json(component: AnyComponent | FastUI) -> bytes:
+    return component.model_dump_json(by_alias=True, exclude_none=True).encode()
+
+def cached_component(key: str | None, build: Callable[[], AnyComponent]) -> AnyComponent:
+    '''
+    Placeholder for a component that does not change between requests (a
+    modal with a form, the navbar). Its JSON is built on first use and
+    carried by the placeholder, a custom component of its own sub type,
+    then spliced in by `components_response`, so its pydantic models, and
+    the JSON schema of forms, are not rebuilt and re-serialized per
+    request. A placeholder returned without `components_response` shows
+    up as an unsupported custom component. Without a key, e.g. when the
+    component embeds text typed by the user, the component is built for
+    this response and returned as is.
+    '''
+    if key is None:
+        return build()
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    with _fragments_lock:
+        fragment = _fragments.get(digest)
+        if fragment is not None:
+            _fragments.move_to_end(digest)
+    if fragment is None:
+        # built outside the lock; concurrent requests may both build it
+        fragment = dump_json(build()).decode()
+        with _fragments_lock:
+            _fragments[digest] = fragment
+            if len(_fragments) > MAX_FRAGMENTS:
+                _fragments.popitem(last=False)
+    return c.Custom(data=fragment, sub_type=_SUB_TYPE)
+
+def components_response(components: list[AnyComponent]) -> Response:
+    '''
+    FastUI JSON response for `components`, with cached components spliced
+    in. Returning a response also skips FastAPI's validation of the
+    returned tree against `response_model=FastUI`.
+    '''
+    content = _PLACEHOLDER.sub(
+        # the placeholder's data is the fragment's JSON as a JSON string
+        lambda match: json.loads(b'"' + match.group(1) + b'"').encode(),
+        dump_json(FastUI(root=components)),
+    )
+    # the pattern relies on pydantic's field order; a placeholder left behind must not reach the browser
+    if b'"subType":"' + _SUB_TYPE.encode() + b'"' in content:
+        raise RuntimeError('Cached component placeholder left in the response')
+    return Response(content=content, media_type='application/json')
+
+def page_response(*components: AnyComponent, title: str | None = None) -> Response:
+    return components_response(base_page(*components, title=title))
+
+_pages: dict[str, bytes] = {}
+
+def cached_page(key: str, build: Callable[[], list[AnyComponent]]) -> Response:
+    '''Response for a page whose content never changes, serialized once per process.'''
+    if key not in _pages:
+        _pages[key] = components_response(build()).body
+    return Response(content=_pages[key], media_type='application/json')
+
+def form_error(field: str, message: str) -> HTTPException:
+    '''Error in the same shape as FastUI's own validation errors, so the message shows up on the form.'''
+    return HTTPException(status_code=422, detail={'form': [{'type': 'value_error', 'loc': [field], 'msg': message}]})
+
+def paginate(session: Session, query, page: int, page_size: int) -> tuple[list, int]:
+    '''One page of `query`'s rows and the total number of rows, counted in SQL.'''
+    total = session.exec(select(func.count()).select_from(query.order_by(None).subquery())).one()
+    rows = session.exec(query.limit(page_size).offset((page - 1) * page_size)).all()
+    return rows, total
 
 def base_page(
     *components: AnyComponent, title: str | None = None # , logged_in: bool = False
 ) -> list[AnyComponent]:
+    '''Page layout; the result must be returned through `components_response` (see `page_response`).'''
     portal_name = "Cytometry Manager"
     return [
         c.PageTitle(text=f"{portal_name} — {title}" if title else portal_name),
-        c.Navbar(
+        cached_component('navbar', lambda: c.Navbar(
             title=portal_name,
             title_event=GoToEvent(url="/"),
             start_links=[
@@ -61,15 +148,15 @@ def base_page(
             #        on_click=GoToEvent(url="/users/create"),
             #    )
             #],
-        ),
+        )),
         c.Page(
             components=[
                 *((c.Heading(text=title),) if title else ()),
                 *components,
             ],
         ),
-        c.Footer(
+        cached_component('footer', lambda: c.Footer(
             extra_text=portal_name,
             links=[],
-        ),
+        )),
     ]
\ No newline at end of file
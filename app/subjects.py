@@ -1,18 +1,51 @@
+import json
 from typing import Annotated, Literal
 from fastapi import APIRouter
+from fastapi.responses import Response
 from fastui import AnyComponent, FastUI
 from fastui import components as c
 from fastui.components.display import DisplayMode, DisplayLookup
 from fastui.events import GoToEvent, BackEvent, PageEvent
 from fastui.forms import fastui_form
-from sqlmodel import select
+from pydantic import BaseModel
+from sqlmodel import Session, select
 
-from .shared import base_page
-from .models import Subject, SubjectForm, SubjectFilterForm, CohortForm
+from .shared import cached_component, page_response, paginate
+from .models import ResponseEnum, SexEnum, Subject, SubjectForm, SubjectFilterForm, CohortForm
 from .database import SessionDep, add_subject
 
 router = APIRouter()
 
+class SubjectRow(BaseModel):
+    '''Columns shown in subject tables.'''
+    id: int
+    name: str
+    sex: SexEnum
+    response: ResponseEnum | None = None
+    treatment: str
+    age: int
+    condition: str
+
+SUBJECT_ROW_COLUMNS = [Subject.id, Subject.name, Subject.sex, Subject.response, Subject.treatment, Subject.age, Subject.condition]
+
+def subject_table(session: Session, conditions: list, page: int, page_size: int, no_data_message: str) -> tuple[c.Table, int]:
+    '''One page of the subjects matching `conditions`, and their total number.'''
+    rows, total = paginate(session, select(*SUBJECT_ROW_COLUMNS).where(*conditions).order_by(Subject.id), page, page_size)
+    table = c.Table(
+        data=[SubjectRow(**row._asdict()) for row in rows],
+        data_model=SubjectRow,
+        no_data_message=no_data_message,
+        columns=[
+            DisplayLookup(field='name', on_click=GoToEvent(url='/subjects/{id}')),
+            DisplayLookup(field='sex'),
+            DisplayLookup(field='response'),
+            DisplayLookup(field='treatment'),
+            DisplayLookup(field='age'),
+            DisplayLookup(field='condition'),
+        ]
+    )
+    return table, total
+
 @router.get("/", response_model=FastUI, response_model_exclude_none=True)
 def api_index(
         session: SessionDep, 
@@ -21,7 +54,7 @@ def api_index(
         sex: str | None = None,
         treatment: str | None = None,
         name: str | None = None,
-    ) -> list[AnyComponent]:
+    ) -> Response:
     page_size = 20
 
     filter_form_initial = {}
@@ -37,18 +70,18 @@ def api_index(
     cohort_form_initial = filter_form_initial.copy()
     cohort_form_initial.pop('name', None)
 
-    query = select(Subject)
+    conditions = []
     if sex:
-        query = query.where(Subject.sex == sex)
+        conditions.append(Subject.sex == sex)
     if response:
-        query = query.where(Subject.response == response)
+        conditions.append(Subject.response == response)
     if treatment:
-        query = query.where(Subject.treatment == treatment)
+        conditions.append(Subject.treatment == treatment)
     if name:
-        query = query.where(Subject.name.ilike(f"{name}%"))
-    subjects = session.exec(query).all()
+        conditions.append(Subject.name.ilike(f"{name}%"))
+    table, num_subjects = subject_table(session, conditions, page, page_size, "No subjects found. Are filters applied?")
 
-    return base_page(
+    return page_response(
         c.Div(
             components=[
                 c.Heading(text='Subjects', level=2),
@@ -67,10 +100,10 @@ def api_index(
                     on_click=GoToEvent(url='/subjects/'),
                     class_name='+ ms-2',
                 ),
-                c.Paragraph(text=f'Showing {len(subjects)} subjects'),
+                c.Paragraph(text=f'Showing {num_subjects} subjects'),
             ]
         ),
-        c.Modal(
+        cached_component(f'modal-new-cohort:{json.dumps(cohort_form_initial, sort_keys=True)}', lambda: c.Modal(
             title="New Cohort",
             body=[
                 # c.Paragraph(text=f'Save this cohort of {len(subjects)} subjects'), # TODO: include this when the below issue is resolved.
@@ -94,30 +127,19 @@ def api_index(
                 c.Button(text='Submit', on_click=PageEvent(name='post-new-cohort')),
             ],
             open_trigger=PageEvent(name='modal-new-cohort'),
-        ),
-        c.ModelForm(
+        )),
+        # typed names would flood the cache
+        cached_component(None if name else f'subject-filters:{json.dumps(filter_form_initial, sort_keys=True)}', lambda: c.ModelForm(
             model=SubjectFilterForm,
             submit_url='.',
             initial=filter_form_initial,
             method='GOTO',
             submit_on_change=True,
             display_mode='inline',
-        ),
-        c.Table(
-            data=subjects[(page - 1) * page_size : page * page_size],
-            data_model=Subject,
-            no_data_message="No subjects found. Are filters applied?",
-            columns=[
-                DisplayLookup(field='name', on_click=GoToEvent(url='/subjects/{id}')),
-                DisplayLookup(field='sex'),
-                DisplayLookup(field='response'),
-                DisplayLookup(field='treatment'),
-                DisplayLookup(field='age'),
-                DisplayLookup(field='condition'),
-            ]
-        ),
-        c.Pagination(page=page, page_size=page_size, total=len(subjects)),
-        c.Modal(
+        )),
+        table,
+        c.Pagination(page=page, page_size=page_size, total=num_subjects),
+        cached_component('modal-new-subject', lambda: c.Modal(
             title="New Subject",
             body=[
                 c.ModelForm(
@@ -136,7 +158,7 @@ def api_index(
                 c.Button(text='Submit', on_click=PageEvent(name='post-new-subject')),
             ],
             open_trigger=PageEvent(name='modal-new-subject'),
-        )
+        ))
     )
 
 @router.post("/new", response_model=FastUI, response_model_exclude_none=True)
@@ -145,14 +167,14 @@ def new_subject(form: Annotated[SubjectForm, fastui_form(SubjectForm)], session:
     return [c.FireEvent(event=PageEvent(name='modal-new-subject', clear=True))]
 
 @router.get("/{id}", response_model=FastUI, response_model_exclude_none=True)
-def subject_view(id: int, session: SessionDep) -> list[AnyComponent]:
+def subject_view(id: int, session: SessionDep) -> Response:
     subject = session.get(Subject, id)
     if not subject:
-        return base_page(
+        return page_response(
             c.Heading(text='Subject not found', level=2),
             c.Paragraph(text='The requested subject does not exist.')
         )
-    return base_page(
+    return page_response(
         c.Heading(text=f'Subject: {subject.name}', level=2),
         c.Details(data=subject)
     )
\ No newline at end of file
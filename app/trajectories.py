@@ -0,0 +1,201 @@
+'''
+Longitudinal analysis of population frequencies per subject.
+
+The samples of a cohort are pivoted from the columnar snapshot (see
+app/columnar.py) into a subjects x timepoints x populations array of
+frequencies. Samples sharing a subject and timepoint (e.g. PBMC and WB)
+are averaged. Deltas are taken from each subject's baseline, its earliest
+timepoint with a measurement, and trends are summarized per response with
+NumPy reductions over the subject axis, so the cost is linear in the
+number of samples.
+'''
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pydantic
+from sqlmodel import Session
+
+from app.cache import VersionedCache
+from app.columnar import get_snapshot
+from app.database import get_data_version
+from app.models import Cohort
+from app.rollups import UNKNOWN
+
+@dataclass
+class Trajectories:
+    subject_ids: np.ndarray  # (subjects,)
+    responses: np.ndarray  # (subjects,) response of each subject, UNKNOWN when not recorded
+    timepoints: np.ndarray  # (timepoints,) sorted time from treatment start
+    populations: list[str]
+    frequencies: np.ndarray  # (subjects, timepoints, populations), NaN where not measured
+    baseline: np.ndarray  # (subjects, populations)
+    deltas: np.ndarray  # (subjects, timepoints, populations), frequency minus baseline
+    slopes: np.ndarray  # (subjects, populations), least-squares change in frequency per time unit
+
+def pivot_trajectories(
+        subject_ids: np.ndarray,
+        times: np.ndarray,
+        frequencies: np.ndarray,
+        responses: np.ndarray,
+        populations: list[str],
+    ) -> Trajectories:
+    '''
+    Pivot one row per sample (subject id, time, frequency per population,
+    response) into per-subject trajectories.
+    '''
+    if len(subject_ids) == 0:
+        # no samples, e.g. an empty cohort; argmax is undefined over no timepoints
+        cube = np.empty((0, 0, len(populations)))
+        by_population = np.empty((0, len(populations)))
+        return Trajectories(np.array([], dtype=np.int64), np.array([], dtype=object), np.array([], dtype=np.int64), populations, cube, by_population, cube, by_population)
+    subjects, subject_index = np.unique(subject_ids, return_inverse=True)
+    timepoints, time_index = np.unique(times, return_inverse=True)
+    num_subjects, num_times = len(subjects), len(timepoints)
+    cell = subject_index * num_times + time_index
+
+    # mean of the samples in every (subject, timepoint) cell, one bincount per population
+    measured = ~np.isnan(frequencies)
+    values = np.where(measured, frequencies, 0.0)
+    size = num_subjects * num_times
+    cube = np.empty((size, len(populations)))
+    for column in range(len(populations)):
+        totals = np.bincount(cell, weights=values[:, column], minlength=size)
+        counts = np.bincount(cell, weights=measured[:, column], minlength=size)
+        with np.errstate(invalid='ignore'):
+            cube[:, column] = totals / counts
+    cube = cube.reshape(num_subjects, num_times, len(populations))
+
+    valid = ~np.isnan(cube)
+    first = np.argmax(valid, axis=1)
+    baseline = np.take_along_axis(cube, first[:, None, :], axis=1)[:, 0, :]
+    deltas = cube - baseline[:, None, :]
+
+    # least-squares slope over each subject's measured timepoints
+    t = np.broadcast_to(timepoints[None, :, None].astype(np.float64), cube.shape)
+    n = valid.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_mean = np.where(valid, t, 0.0).sum(axis=1) / n
+        y_mean = np.where(valid, cube, 0.0).sum(axis=1) / n
+        t_centered = np.where(valid, t - t_mean[:, None, :], 0.0)
+        covariance = (t_centered * np.where(valid, cube - y_mean[:, None, :], 0.0)).sum(axis=1)
+        variance = (t_centered ** 2).sum(axis=1)
+        slopes = np.where(variance > 0, covariance / variance, np.nan)
+
+    subject_responses = np.full(num_subjects, UNKNOWN, dtype=object)
+    subject_responses[subject_index] = np.where(pd.isna(responses), UNKNOWN, responses)
+    return Trajectories(subjects, subject_responses, timepoints, populations, cube, baseline, deltas, slopes)
+
+_trajectory_cache = VersionedCache()
+
+def get_cohort_trajectories(cohort: Cohort, session: Session, sample_type: str | None = None) -> Trajectories:
+    '''Trajectories of the subjects of `cohort`, cached until the data version changes.'''
+    def compute():
+        snapshot = get_snapshot(session)
+        subject_mask = cohort.get_subject_mask(session)
+        subject_ids = np.asarray(snapshot.subject_id)
+        in_range = (subject_ids >= 0) & (subject_ids < len(subject_mask))
+        mask = in_range & subject_mask[np.where(in_range, subject_ids, 0)]
+        if sample_type:
+            type_codes = [code for code, name in enumerate(snapshot.sample_types) if name == sample_type]
+            mask &= np.isin(snapshot.type_code, type_codes)
+        return pivot_trajectories(
+            subject_ids[mask],
+            np.asarray(snapshot.time_from_treatment_start)[mask],
+            snapshot.frequencies(mask).to_numpy(),
+            snapshot.response(mask).to_numpy(),
+            snapshot.populations,
+        )
+    return _trajectory_cache.get_or_compute((cohort.id, sample_type), get_data_version(session), compute)
+
+class TrajectoryTrend(pydantic.BaseModel):
+    response: str
+    population: str
+    time_from_treatment_start: int
+    subjects: int
+    mean_frequency: float
+    mean_delta: float
+    std_delta: float | None = None
+
+class SlopeTrend(pydantic.BaseModel):
+    response: str
+    population: str
+    subjects: int
+    mean_slope: float
+    std_slope: float | None = None
+
+class SubjectTrajectory(pydantic.BaseModel):
+    subject_id: int
+    response: str
+    # indexed [timepoint][population] like the `timepoints` and `populations` of the summary, null where not measured
+    frequencies: list[list[float | None]]
+    deltas: list[list[float | None]]
+
+class TrajectorySummary(pydantic.BaseModel):
+    cohort_id: int
+    sample_type: str | None = None
+    subjects: int
+    timepoints: list[int]
+    populations: list[str]
+    trends: list[TrajectoryTrend]
+    slopes: list[SlopeTrend]
+
+def _nullable(values: np.ndarray) -> list:
+    return np.where(np.isnan(values), None, values).tolist()
+
+def _group_statistics(values: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Count, mean and sample standard deviation over the first (subject) axis, ignoring NaN.'''
+    count = (~np.isnan(values)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=0) / count
+        std = np.sqrt(np.nansum((values - mean) ** 2, axis=0) / (count - 1))
+    return count, mean, np.where(count > 1, std, np.nan)
+
+def summarize_trajectories(trajectories: Trajectories, cohort_id: int, sample_type: str | None = None) -> TrajectorySummary:
+    '''Mean frequency and delta from baseline per response, timepoint and population, and mean slopes.'''
+    trends, slopes = [], []
+    for response in sorted(set(trajectories.responses)):
+        members = trajectories.responses == response
+        count, mean_delta, std_delta = _group_statistics(trajectories.deltas[members])
+        _, mean_frequency, _ = _group_statistics(trajectories.frequencies[members])
+        for time_index, population_index in zip(*np.nonzero(count)):
+            trends.append(TrajectoryTrend(
+                response=response,
+                population=trajectories.populations[population_index],
+                time_from_treatment_start=int(trajectories.timepoints[time_index]),
+                subjects=int(count[time_index, population_index]),
+                mean_frequency=mean_frequency[time_index, population_index],
+                mean_delta=mean_delta[time_index, population_index],
+                std_delta=_nullable(std_delta[time_index, population_index]),
+            ))
+        count, mean_slope, std_slope = _group_statistics(trajectories.slopes[members])
+        for population_index in np.flatnonzero(count):
+            slopes.append(SlopeTrend(
+                response=response,
+                population=trajectories.populations[population_index],
+                subjects=int(count[population_index]),
+                mean_slope=mean_slope[population_index],
+                std_slope=_nullable(std_slope[population_index]),
+            ))
+    return TrajectorySummary(
+        cohort_id=cohort_id,
+        sample_type=sample_type,
+        subjects=len(trajectories.subject_ids),
+        timepoints=trajectories.timepoints.tolist(),
+        populations=trajectories.populations,
+        trends=trends,
+        slopes=slopes,
+    )
+
+def subject_trajectories(trajectories: Trajectories, offset: int, limit: int) -> list[SubjectTrajectory]:
+    '''Per-subject frequencies and deltas of a slice of the subjects, ordered by subject id.'''
+    rows = slice(offset, offset + limit)
+    return [
+        SubjectTrajectory(subject_id=subject_id, response=response, frequencies=frequencies, deltas=deltas)
+        for subject_id, response, frequencies, deltas in zip(
+            trajectories.subject_ids[rows].tolist(),
+            trajectories.responses[rows],
+            _nullable(trajectories.frequencies[rows]),
+            _nullable(trajectories.deltas[rows]),
+        )
+    ]
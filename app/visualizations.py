@@ -1,5 +1,9 @@
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import HTMLResponse, Response
+from pydantic import BaseModel
+from sqlmodel import Session
+import json
+import os
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -7,46 +11,172 @@ import io
 import matplotlib
 matplotlib.use('Agg')  # Use non-interactive backend
 
-from app.database import SessionDep
-from app.models import Dataset, Subject
+from app.cache import VersionedCache, remove_older_versions, versioned_name
+from app.columnar import get_snapshot
+from app.database import SessionDep, get_database_id
+from app.models import Dataset
+from app.running_stats import get_dataset_version
 
 router = APIRouter()
 
-@router.get("/dataset/{id}")
-def get_dataset_visualization(id: int, session: SessionDep):
+class BoxplotStatistic(BaseModel):
+    population: str
+    response: str
+    count: int
+    q1: float
+    median: float
+    q3: float
+    # most extreme values within 1.5 IQR of the quartiles, as drawn by matplotlib
+    whisker_low: float
+    whisker_high: float
+    outliers: list[float]
+
+def get_melted_frequencies(dataset: Dataset, session: Session) -> pd.DataFrame:
+    '''Long-format Response / Cell_Type / Frequency rows of the dataset's samples with a known response.'''
+    snapshot = get_snapshot(session)
+    mask = dataset.get_sample_mask(snapshot, session)
+    frequencies = snapshot.frequencies(mask).dropna(axis='columns', how='all')
+    data_points = frequencies.assign(Response=snapshot.response(mask)).dropna(subset=['Response'])
+    return pd.melt(data_points, id_vars=['Response'], value_vars=list(frequencies.columns),
+                   var_name='Cell_Type', value_name='Frequency').dropna(subset=['Frequency'])
+
+def boxplot_statistics(melted: pd.DataFrame) -> list[BoxplotStatistic]:
+    '''
+    Quartiles, whiskers and outliers per population and response, computed
+    for every group at once with grouped quantiles and masks.
+    '''
+    if melted.empty:
+        return []
+    keys = ['Cell_Type', 'Response']
+    groups = melted.groupby(keys, sort=True)['Frequency']
+    summary = groups.quantile([0.25, 0.5, 0.75]).unstack().set_axis(['q1', 'median', 'q3'], axis='columns')
+    summary['count'] = groups.size()
+    iqr = summary['q3'] - summary['q1']
+    summary['low_fence'] = summary['q1'] - 1.5 * iqr
+    summary['high_fence'] = summary['q3'] + 1.5 * iqr
+
+    points = melted.join(summary[['low_fence', 'high_fence']], on=keys)
+    inside = points['Frequency'].between(points['low_fence'], points['high_fence'])
+    whiskers = points[inside].groupby(keys)['Frequency'].agg(['min', 'max'])
+    summary['whisker_low'] = whiskers['min']
+    summary['whisker_high'] = whiskers['max']
+    outliers = points[~inside].groupby(keys)['Frequency'].agg(list)
+    summary['outliers'] = outliers.reindex(summary.index).apply(lambda values: values if isinstance(values, list) else [])
+
+    return [
+        BoxplotStatistic(population=population, response=response, **row)
+        for (population, response), row in summary.drop(columns=['low_fence', 'high_fence']).to_dict('index').items()
+    ]
+
+def vega_lite_spec(statistics: list[BoxplotStatistic], title: str) -> dict:
+    '''Vega-Lite spec drawing precomputed boxplots, one box per population and response.'''
+    boxes = [statistic.model_dump(exclude={'outliers'}) for statistic in statistics]
+    outliers = [
+        {'population': statistic.population, 'response': statistic.response, 'value': value}
+        for statistic in statistics
+        for value in statistic.outliers
+    ]
+    x = {'field': 'population', 'type': 'nominal', 'title': 'Cell Type', 'axis': {'labelAngle': -45}}
+    x_offset = {'field': 'response', 'type': 'nominal'}
+    color = {'field': 'response', 'type': 'nominal', 'title': 'Response'}
+    y_title = 'Frequency (%)'
+    return {
+        '$schema': 'https://vega.github.io/schema/vega-lite/v5.json',
+        'title': title,
+        'width': 'container',
+        'height': 300,
+        'layer': [
+            {
+                'data': {'values': boxes},
+                'encoding': {'x': x, 'xOffset': x_offset, 'color': color},
+                'layer': [
+                    {
+                        'mark': {'type': 'rule', 'color': 'black'},
+                        'encoding': {
+                            'y': {'field': 'whisker_low', 'type': 'quantitative', 'title': y_title},
+                            'y2': {'field': 'whisker_high'},
+                        },
+                    },
+                    {
+                        'mark': {'type': 'bar', 'width': {'band': 0.8}, 'stroke': 'black'},
+                        'encoding': {
+                            'y': {'field': 'q1', 'type': 'quantitative'},
+                            'y2': {'field': 'q3'},
+                            'tooltip': [
+                                {'field': 'population'}, {'field': 'response'}, {'field': 'count', 'title': 'Samples'},
+                                {'field': 'median', 'format': '.2f'}, {'field': 'q1', 'format': '.2f'}, {'field': 'q3', 'format': '.2f'},
+                            ],
+                        },
+                    },
+                    {
+                        'mark': {'type': 'tick', 'color': 'black', 'thickness': 2},
+                        'encoding': {'y': {'field': 'median', 'type': 'quantitative'}},
+                    },
+                ],
+            },
+            {
+                'data': {'values': outliers},
+                'mark': {'type': 'point', 'filled': True, 'size': 15},
+                'encoding': {
+                    'x': x,
+                    'xOffset': x_offset,
+                    'color': color,
+                    'y': {'field': 'value', 'type': 'quantitative'},
+                },
+            },
+        ],
+    }
+
+_spec_cache = VersionedCache()
+
+def get_dataset_chart_spec(dataset: Dataset, session: Session) -> dict:
+    def compute():
+        statistics = boxplot_statistics(get_melted_frequencies(dataset, session))
+        return vega_lite_spec(statistics, f'Cell Population Frequencies by Response - Dataset "{dataset.name}"')
+    return _spec_cache.get_or_compute(dataset.id, get_dataset_version(session, dataset.id), compute)
+
+CHART_HTML = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
+<script src="https://cdn.jsdelivr.net/npm/vega-lite@5"></script>
+<script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
+<style>body {{ margin: 0; font-family: sans-serif; }} #chart {{ width: 100%; }}</style>
+</head>
+<body>
+<div id="chart"></div>
+<script>vegaEmbed('#chart', {spec}, {{actions: false}});</script>
+</body>
+</html>
+'''
+
+@router.get("/dataset/{id}/spec")
+def get_dataset_spec(id: int, session: SessionDep) -> dict:
+    '''Vega-Lite spec of the dataset's boxplots, drawn by the browser.'''
     dataset = session.get(Dataset, id)
     if not dataset:
-        # Return a simple error image or raise an HTTP exception
         raise HTTPException(status_code=404, detail=f"Dataset {id} not found")
+    return get_dataset_chart_spec(dataset, session)
+
+@router.get("/dataset/{id}/chart", response_class=HTMLResponse)
+def get_dataset_chart(id: int, session: SessionDep) -> HTMLResponse:
+    '''Standalone page rendering the spec client-side, for embedding in an iframe.'''
+    dataset = session.get(Dataset, id)
+    if not dataset:
+        raise HTTPException(status_code=404, detail=f"Dataset {id} not found")
+    # escape "</" so population names cannot close the script element
+    spec = json.dumps(get_dataset_chart_spec(dataset, session)).replace('</', '<\\/')
+    return HTMLResponse(CHART_HTML.format(spec=spec))
+
+IMAGE_DIR = os.path.join('cache', 'images')
+
+def render_dataset_png(dataset: Dataset, session: Session) -> bytes | None:
+    '''Boxplots of the dataset's frequencies by response as PNG bytes, or None without data.'''
+    melted_df = get_melted_frequencies(dataset, session)
     
-    samples = dataset.get_samples(session)
-    
-    rows_data = []
-    for samp in samples:
-        populations = samp.get_population_frequencies()
-        subject = session.get(Subject, samp.subject_id)
-        response = None
-        if subject:
-            response = subject.response
-        if response:
-            rows_data.append({
-                'B Cell': populations['B Cell'],
-                'Cd8 T Cell': populations['CD8 T Cell'],
-                'Cd4 T Cell': populations['CD4 T Cell'],
-                'Nk Cell': populations['NK Cell'],
-                'Monocyte': populations['Monocyte'],
-                'Response': response.value if response else None
-            })
-    
-    data_points = pd.DataFrame(rows_data)
-    
-    if data_points.empty:
-        raise HTTPException(status_code=404, detail="No data available for visualization")
-    
-    # Melt the dataframe for seaborn - convert from wide to long format
-    cell_types = ['B Cell', 'Cd8 T Cell', 'Cd4 T Cell', 'Nk Cell', 'Monocyte']
-    melted_df = pd.melt(data_points, id_vars=['Response'], value_vars=cell_types, 
-                       var_name='Cell_Type', value_name='Frequency')
+    if melted_df.empty:
+        return None
     
     # Set the style for better-looking plots
     sns.set_style("whitegrid")
@@ -74,13 +204,50 @@ def get_dataset_visualization(id: int, session: SessionDep):
     # Save plot to bytes
     img_buffer = io.BytesIO()
     plt.savefig(img_buffer, format='png', dpi=100, bbox_inches='tight')
-    img_buffer.seek(0)
     
     # Close the figure to free memory
     plt.close(fig)
     
-    return StreamingResponse(
-        img_buffer,
+    return img_buffer.getvalue()
+
+def get_dataset_png(dataset: Dataset, session: Session) -> bytes | None:
+    '''
+    PNG of the dataset, rendered once per dataset version and kept on disk,
+    so the image survives restarts and writes to samples outside the dataset.
+    '''
+    version = get_dataset_version(session, dataset.id)
+    # dataset ids and versions restart when the database is recreated
+    database_id = get_database_id(session)
+    path = os.path.join(IMAGE_DIR, versioned_name(f'dataset_{dataset.id}_', database_id, version, '.png'))
+    if os.path.exists(path):
+        with open(path, 'rb') as image_file:
+            return image_file.read()
+    image = render_dataset_png(dataset, session)
+    if image is None:
+        return None
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as image_file:
+        image_file.write(image)
+    os.replace(temporary_path, path)
+    remove_older_versions(IMAGE_DIR, f'dataset_{dataset.id}_', database_id, version, '.png')
+    return image
+
+@router.get("/dataset/{id}")
+def get_dataset_visualization(id: int, session: SessionDep):
+    '''Server-rendered PNG of the boxplots, for export.'''
+    dataset = session.get(Dataset, id)
+    if not dataset:
+        # Return a simple error image or raise an HTTP exception
+        raise HTTPException(status_code=404, detail=f"Dataset {id} not found")
+    
+    image = get_dataset_png(dataset, session)
+    
+    if image is None:
+        raise HTTPException(status_code=404, detail="No data available for visualization")
+    
+    return Response(
+        image,
         media_type="image/png",
         headers={"Content-Disposition": f"inline; filename=dataset_{id}_visualization.png"}
-    )
\ No newline at end of file
+    )
@@ -1,5 +1,10 @@
 import os
 import sys
+
+if '--in-memory' in sys.argv:
+    # read when the app is imported, including by the reloader's worker process
+    os.environ['CYTOMETRY_IN_MEMORY'] = '1'
+
 import uvicorn
 
 from app.database import init_db, load_csv, DB_FILE, CSV_FILE
@@ -7,10 +12,14 @@ from app.database import init_db, load_csv, DB_FILE, CSV_FILE
 if __name__ == "__main__":
     if not os.path.exists(DB_FILE):
         init_db()
-        load_csv()
-        print(f'Database initialized and CSV "{CSV_FILE}" loaded.')
+        report = load_csv()
+        print(f'Database initialized and CSV "{CSV_FILE}" loaded: {report.inserted} of {report.total_rows} rows.')
+        for error in report.errors:
+            print(f'  row {error.row}, {error.column}: {error.message}')
     else:
-        print(f"Database file '{DB_FILE}' already exists. Skipping initialization and CSV loading.")
+        # adds tables and triggers introduced since the database was created
+        init_db()
+        print(f"Database file '{DB_FILE}' already exists. Skipping CSV loading.")
     uvicorn.run(
         "app:app",
         host="127.0.0.1",